@@ -0,0 +1,2 @@
+# sync_test.py is a manual script that talks to a running NFD: python -m ndngitsync.sync_test
+collect_ignore = ["ndngitsync/sync_test.py"]
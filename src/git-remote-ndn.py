@@ -4,10 +4,11 @@ import sys
 import os
 import asyncio
 import struct
-import pickle
+from ndngitsync.repo import BranchInfo
 from ndngitsync.gitfetcher import GitFetcher, GitProducer, fetch_data_packet
 from ndngitsync.storage import FileStorage
-from pyndn import Face, Name, Interest, Data
+from ndngitsync.asyncface import AsyncFace
+from pyndn import Name, Interest, Data
 from pyndn.security import KeyChain
 from typing import Tuple
 from ndngitsync.config import LOCAL_CMD_PREFIX
@@ -34,19 +35,13 @@ def parse_push(cmd: str, local_repo_path: str) -> Tuple[str, str, bool]:
 
 
 async def run(local_repo_path: str, repo_prefix: str):
-    async def face_loop():
-        nonlocal face, running
-        while running:
-            face.processEvents()
-            await asyncio.sleep(0.01)
-
     options = {'cloning': False}
     running = True
-    face = Face()
+    face = AsyncFace()
     keychain = KeyChain()
     face.setCommandSigningInfo(keychain, keychain.getDefaultCertificateName())
     event_loop = asyncio.get_event_loop()
-    face_task = event_loop.create_task(face_loop())
+    face_task = event_loop.create_task(face.run())
     storage = FileStorage(local_repo_path)
     producer = GitProducer(face, Name(repo_prefix).append("objects"), storage)
     refs = []
@@ -137,7 +132,10 @@ async def run(local_repo_path: str, repo_prefix: str):
                 data = await fetch_data_packet(face, interest)
                 branchinfo = None
                 if isinstance(data, Data):
-                    branchinfo = pickle.loads(data.content.toBytes())
+                    try:
+                        branchinfo = BranchInfo.decode(data.content.toBytes())
+                    except ValueError as e:
+                        print("ERROR Malformed branch-info:", e, file=sys.stderr)
                 if branchinfo is None or 'custodian' not in branchinfo.__dict__:
                     print("ERROR Interest got no response: ", interest.name, file=sys.stderr)
                     print("error refs/heads/{} DISCONNECTED".format(branch))
@@ -179,7 +177,7 @@ async def run(local_repo_path: str, repo_prefix: str):
             pass
 
     producer.cancel()
-    running = False
+    face.stop()
     await face_task
 
 
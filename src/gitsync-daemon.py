@@ -4,7 +4,7 @@ import asyncio
 import logging
 import sys
 from ndngitsync.server import Server
-from pyndn import Face
+from ndngitsync.asyncface import AsyncFace
 from pyndn.security import KeyChain
 
 
@@ -21,20 +21,16 @@ def main():
                         level=logging.INFO)
 
     event_loop = asyncio.get_event_loop()
-    face = Face()
+    face = AsyncFace()
     keychain = KeyChain()
     face.setCommandSigningInfo(keychain, keychain.getDefaultCertificateName())
     server = Server(face, command_prefix)
 
-    async def face_loop():
-        nonlocal face, server
-        while server.running:
-            face.processEvents()
-            await asyncio.sleep(0.01)
-
     try:
-        event_loop.run_until_complete(face_loop())
+        # Returns once the face stops, either through server.stop() or on losing the forwarder
+        event_loop.run_until_complete(face.run())
     finally:
+        server.close()
         event_loop.close()
 
 
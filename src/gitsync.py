@@ -2,26 +2,21 @@
 
 import sys
 import asyncio
+import json
 import struct
 from ndngitsync.gitfetcher import fetch_data_packet
-from pyndn import Face, Name, Interest, Data
+from ndngitsync.asyncface import AsyncFace
+from pyndn import Name, Interest, Data
 from pyndn.security import KeyChain
 from ndngitsync.config import LOCAL_CMD_PREFIX
 
 
 async def run(cmd: str):
-    async def face_loop():
-        nonlocal face, running
-        while running:
-            face.processEvents()
-            await asyncio.sleep(0.01)
-
-    running = True
-    face = Face()
+    face = AsyncFace()
     keychain = KeyChain()
     face.setCommandSigningInfo(keychain, keychain.getDefaultCertificateName())
     event_loop = asyncio.get_event_loop()
-    face_task = event_loop.create_task(face_loop())
+    face_task = event_loop.create_task(face.run())
     Interest.setDefaultCanBePrefix(True)
 
     if cmd == "track-repo":
@@ -66,6 +61,8 @@ async def run(cmd: str):
             repo = sys.argv[2]
             branch = sys.argv[3]
             interest = Interest(Name(LOCAL_CMD_PREFIX).append("mount").append(repo).append(branch))
+            # The daemon answers once the worktree is written
+            interest.interestLifetimeMilliseconds = 60000
             data = await fetch_data_packet(face, interest)
             if isinstance(data, Data):
                 content = data.content.toBytes()
@@ -82,7 +79,9 @@ async def run(cmd: str):
         else:
             repo = sys.argv[2]
             branch = sys.argv[3]
-            interest = Interest(Name(LOCAL_CMD_PREFIX).append("clone").append(repo).append(branch))
+            interest = Interest(Name(LOCAL_CMD_PREFIX).append("update").append(repo).append(branch))
+            # The daemon answers once the worktree is written
+            interest.interestLifetimeMilliseconds = 60000
             data = await fetch_data_packet(face, interest)
             if isinstance(data, Data):
                 content = data.content.toBytes()
@@ -122,10 +121,19 @@ async def run(cmd: str):
                 print("Finished.")
             else:
                 print("error: Couldn't connect to", interest.name.toUri(), file=sys.stderr)
+    elif cmd == "stats":
+        interest = Interest(Name(LOCAL_CMD_PREFIX).append("stats"))
+        interest.mustBeFresh = True
+        data = await fetch_data_packet(face, interest)
+        if isinstance(data, Data):
+            content = data.content.toBytes()
+            print(json.dumps(json.loads(content[4:].decode()), indent=2))
+        else:
+            print("error: Couldn't connect to", interest.name.toUri(), file=sys.stderr)
     else:
         print("Unrecognized command:", cmd, file=sys.stderr)
 
-    running = False
+    face.stop()
     await face_task
 
 
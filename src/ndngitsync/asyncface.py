@@ -0,0 +1,21 @@
+import asyncio
+from pyndn.threadsafe_face import ThreadsafeFace
+
+
+class AsyncFace(ThreadsafeFace):
+    """
+    Face driven by the asyncio event loop. PyNDN's ThreadsafeFace reads the forwarder
+    connection through an asyncio transport and runs delayed calls such as Interest
+    timeouts as loop timers, so an idle face does not wake up at all. run() lasts
+    until stop(), for callers that run the loop until the face is done.
+    """
+    def __init__(self, *args):
+        super().__init__(asyncio.get_event_loop(), *args)
+        self.stop_event = asyncio.Event()
+
+    async def run(self):
+        await self.stop_event.wait()
+
+    def stop(self):
+        self.stop_event.set()
+        self.shutdown()
@@ -0,0 +1,80 @@
+import asyncio
+from pyndn import Data, Interest, Name
+from pyndn.transport.transport import Transport
+from ndngitsync.asyncface import AsyncFace
+from ndngitsync.gitfetcher import fetch_data_packet
+
+
+class PeerTransport(Transport):
+    """
+    Transport whose far end is the test: sent packets are recorded and received ones
+    handed in with receive(). Polling it is an error, since the loop must drive the face.
+    """
+    def __init__(self):
+        self.sent = []
+        self.element_listener = None
+
+    def isLocal(self, connectionInfo):
+        return True
+
+    def isAsync(self):
+        return True
+
+    def connect(self, connectionInfo, elementListener, onConnected):
+        self.element_listener = elementListener
+        onConnected()
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+    def receive(self, wire: bytes):
+        self.element_listener.onReceivedElement(wire)
+
+    def processEvents(self):
+        raise AssertionError("The face was polled")
+
+    def getIsConnected(self):
+        return self.element_listener is not None
+
+    def close(self):
+        self.element_listener = None
+
+
+def sent_interest(transport: PeerTransport) -> Interest:
+    interest = Interest()
+    interest.wireDecode(transport.sent[-1])
+    return interest
+
+
+def test_data_is_delivered_by_the_loop():
+    async def run():
+        transport = PeerTransport()
+        face = AsyncFace(transport, Transport.ConnectionInfo())
+        face_task = asyncio.ensure_future(face.run())
+        fetch = asyncio.ensure_future(fetch_data_packet(face, Interest(Name("/a"))))
+        await asyncio.sleep(0.01)
+        interest = sent_interest(transport)
+        assert interest.name == Name("/a")
+        data = Data(interest.name)
+        data.content = b"content"
+        transport.receive(data.wireEncode().toBytes())
+        data = await fetch
+        face.stop()
+        await face_task
+        assert transport.element_listener is None
+        return data
+
+    assert asyncio.run(run()).content.toBytes() == b"content"
+
+
+def test_interest_timeouts_are_loop_timers():
+    async def run():
+        face = AsyncFace(PeerTransport(), Transport.ConnectionInfo())
+        interest = Interest(Name("/a"))
+        interest.interestLifetimeMilliseconds = 50
+        event_loop = asyncio.get_event_loop()
+        start = event_loop.time()
+        assert await fetch_data_packet(face, interest) is None
+        return event_loop.time() - start
+
+    assert 0.05 <= asyncio.run(run()) < 0.5
@@ -0,0 +1,428 @@
+from typing import Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import stat
+import zlib
+import shutil
+import struct
+import asyncio
+import hashlib
+from .gitobject import decode_object, tree_entries, HASH_LENGTH
+from .storage import IStorage
+
+
+CHECKOUT_WORKERS = 4 * (os.cpu_count() or 1)
+CHECKOUT_CHUNK_SIZE = 64 * 1024
+CHECKOUT_TMP_SUFFIX = ".tmp"
+INDEX_SIGNATURE = b"DIRC"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("!4sII")
+INDEX_ENTRY = struct.Struct("!10I20sH")
+INDEX_NAME_MASK = 0xfff
+MODE_FILE = 0o100644
+MODE_EXECUTABLE = 0o100755
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+# ctime, mtime (seconds, nanoseconds), dev, ino, uid, gid, size
+EMPTY_STAT = (0,) * 9
+GIT_CONFIG = """[core]
+\trepositoryformatversion = 0
+\tfilemode = true
+\tbare = false
+\tlogallrefupdates = true
+[remote "origin"]
+\turl = {remote}
+\tfetch = +refs/heads/*:refs/remotes/origin/*
+[branch "{branch}"]
+\tremote = origin
+\tmerge = refs/heads/{branch}
+"""
+
+_checkout_executor = None
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def get_checkout_executor() -> ThreadPoolExecutor:
+    global _checkout_executor
+    if _checkout_executor is None:
+        _checkout_executor = ThreadPoolExecutor(max_workers=CHECKOUT_WORKERS, thread_name_prefix="checkout")
+    return _checkout_executor
+
+
+def index_stat(st: os.stat_result) -> Tuple[int, ...]:
+    fields = (int(st.st_ctime), st.st_ctime_ns % 1000000000, int(st.st_mtime), st.st_mtime_ns % 1000000000,
+              st.st_dev, st.st_ino, st.st_uid, st.st_gid, st.st_size)
+    return tuple(field & 0xffffffff for field in fields)
+
+
+def index_mode(mode: int) -> int:
+    if stat.S_ISREG(mode):
+        return MODE_EXECUTABLE if mode & 0o111 else MODE_FILE
+    return mode
+
+
+def encode_index(entries: Iterable[Tuple[bytes, int, str, Tuple[int, ...]]]) -> bytes:
+    """
+    Encode (path, mode, hash_name, stat) entries as a version 2 git index
+    """
+    ret = [INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(entries))]
+    for path, mode, hash_name, st in sorted(entries, key=lambda entry: entry[0]):
+        ctime, ctime_ns, mtime, mtime_ns, dev, ino, uid, gid, size = st
+        entry = INDEX_ENTRY.pack(ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size,
+                                 bytes.fromhex(hash_name), min(len(path), INDEX_NAME_MASK)) + path
+        # 1 to 8 NUL bytes, keeping entries 8-byte aligned
+        ret.append(entry + b"\x00" * (8 - len(entry) % 8))
+    ret = b"".join(ret)
+    return ret + hashlib.sha1(ret).digest()
+
+
+def decode_index(raw: bytes) -> List[Tuple[bytes, int, str, Tuple[int, ...]]]:
+    """
+    Decode a version 2 git index into the entries given to encode_index. Extensions are dropped.
+    """
+    if len(raw) < INDEX_HEADER.size + HASH_LENGTH or hashlib.sha1(raw[:-HASH_LENGTH]).digest() != raw[-HASH_LENGTH:]:
+        raise ValueError("Corrupted index")
+    signature, version, count = INDEX_HEADER.unpack_from(raw)
+    if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+        raise ValueError("Unsupported index version {}".format(version))
+    ret = []
+    pos = INDEX_HEADER.size
+    try:
+        for _ in range(count):
+            fields = INDEX_ENTRY.unpack_from(raw, pos)
+            ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size, hash_value, _ = fields
+            name_start = pos + INDEX_ENTRY.size
+            name_end = raw.index(b"\x00", name_start)
+            path = raw[name_start:name_end]
+            pos = name_start + len(path) + 8 - (INDEX_ENTRY.size + len(path)) % 8
+            ret.append((path, mode, hash_value.hex(), (ctime, ctime_ns, mtime, mtime_ns, dev, ino, uid, gid, size)))
+    except struct.error:
+        raise ValueError("Truncated index")
+    return ret
+
+
+def check_name(name: bytes):
+    # Objects come from peers, so never let a tree write outside the worktree
+    if name in (b"", b".", b"..") or b"/" in name or b"\x00" in name or name.lower() == b".git":
+        raise CheckoutError("Unsafe path component: {!r}".format(name))
+
+
+class Checkout:
+    """
+    Materialize a commit as a shallow git worktree, straight from the object store.
+    Files are written by a pool of workers, while the tree is walked in the calling thread.
+    Paths are created without following symlinks: every directory is checked by make_dir
+    before anything is written into it.
+    """
+    def __init__(self, storage: IStorage, work_tree: str):
+        self.storage = storage
+        self.work_tree = os.fsencode(work_tree)
+        self.git_dir = os.path.join(self.work_tree, b".git")
+        # Objects already copied into .git/objects
+        self.written = set()
+        # Index entries by path, new ones only during update, and the writes in progress
+        self.entries = {}
+        self.futures = []
+        # Paths taken out of the index by update, directories ending with "/"
+        self.removed_files = set()
+        self.removed_dirs = []
+
+    def run(self, commit: str, branch: str, remote: str):
+        os.makedirs(os.path.join(self.git_dir, b"objects"), exist_ok=True)
+        tree = self.commit_tree(commit)
+        try:
+            self.add_tree(tree, b"")
+        finally:
+            self.collect()
+        self.write_file(b"index", encode_index(self.entries.values()))
+        self.write_refs(commit, branch, remote)
+
+    def update(self, commit: str, branch: str):
+        """
+        Move the worktree from the commit last checked out to commit, rewriting only what
+        differs between their trees. The worktree mirrors the branch, so local changes to
+        those files are overwritten.
+        """
+        old_commit = self.read_file(os.path.join(b"refs/remotes/origin", branch.encode())).decode().strip()
+        if old_commit == commit:
+            return
+        try:
+            old_entries = decode_index(self.read_file(b"index"))
+        except ValueError as e:
+            raise CheckoutError("Unreadable index: {}".format(e))
+        old_tree = self.parse_commit_tree(self.read_local(old_commit, "commit"), old_commit)
+        tree = self.commit_tree(commit)
+        try:
+            self.diff_tree(old_tree, tree, b"")
+        finally:
+            self.collect()
+        # Unchanged files keep their entries, stat data included, so git need not hash them again
+        removed_dirs = tuple(self.removed_dirs)
+        for entry in old_entries:
+            if entry[0] not in self.removed_files and not entry[0].startswith(removed_dirs):
+                self.entries.setdefault(entry[0], entry)
+        self.write_file(b"index", encode_index(self.entries.values()))
+        head = (commit + "\n").encode()
+        self.write_file(os.path.join(b"refs/heads", branch.encode()), head)
+        self.write_file(os.path.join(b"refs/remotes/origin", branch.encode()), head)
+        # Both commits are now shallow: the old one keeps its missing parents
+        shallow = self.read_file(b"shallow")
+        if head not in shallow.splitlines(keepends=True):
+            self.write_file(b"shallow", shallow + head)
+
+    def loose_path(self, hash_name: str) -> bytes:
+        return os.path.join(self.git_dir, b"objects", hash_name[:2].encode(), hash_name[2:].encode())
+
+    def get_raw(self, hash_name: str) -> bytes:
+        if not self.storage.exists(hash_name):
+            raise CheckoutError("Missing object " + hash_name)
+        return self.storage.get(hash_name)
+
+    def write_loose(self, hash_name: str, raw_data: bytes):
+        path = self.loose_path(hash_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(raw_data)
+
+    @staticmethod
+    def decode_content(raw_data: bytes, hash_name: str, expect_type: str) -> bytes:
+        try:
+            content_type, content = decode_object(raw_data)
+        except (zlib.error, UnicodeDecodeError, ValueError):
+            raise CheckoutError("Corrupted object " + hash_name)
+        if content_type != expect_type:
+            raise CheckoutError("Object {} is a {}, not a {}".format(hash_name, content_type, expect_type))
+        return content
+
+    def read_object(self, hash_name: str, expect_type: str) -> bytes:
+        raw_data = self.get_raw(hash_name)
+        content = self.decode_content(raw_data, hash_name, expect_type)
+        if hash_name not in self.written:
+            self.written.add(hash_name)
+            self.write_loose(hash_name, raw_data)
+        return content
+
+    def read_local(self, hash_name: str, expect_type: str) -> bytes:
+        """
+        Read an object of the current checkout from .git/objects
+        """
+        try:
+            with open(self.loose_path(hash_name), "rb") as f:
+                raw_data = f.read()
+        except FileNotFoundError:
+            raise CheckoutError("Missing local object " + hash_name)
+        return self.decode_content(raw_data, hash_name, expect_type)
+
+    @staticmethod
+    def parse_commit_tree(content: bytes, commit: str) -> str:
+        if not content.startswith(b"tree "):
+            raise CheckoutError("Malformed commit " + commit)
+        return content[5:5 + 2 * HASH_LENGTH].decode("utf-8")
+
+    def commit_tree(self, commit: str) -> str:
+        return self.parse_commit_tree(self.read_object(commit, "commit"), commit)
+
+    @staticmethod
+    def parse_tree(content: bytes, hash_name: str) -> List[Tuple[int, bytes, str]]:
+        try:
+            entries = tree_entries(content)
+        except ValueError:
+            raise CheckoutError("Malformed tree " + hash_name)
+        names = set()
+        for _, name, _ in entries:
+            check_name(name)
+            # A symlink and a directory of the same name could send writes outside the worktree
+            if name in names:
+                raise CheckoutError("Duplicate name {!r} in tree {}".format(name, hash_name))
+            names.add(name)
+        return entries
+
+    def read_tree(self, hash_name: str) -> List[Tuple[int, bytes, str]]:
+        return self.parse_tree(self.read_object(hash_name, "tree"), hash_name)
+
+    def add_tree(self, tree: str, prefix: bytes):
+        for mode, name, hash_name in self.read_tree(tree):
+            self.add_entry(prefix + name, mode, hash_name)
+
+    def make_dir(self, path: bytes):
+        """
+        Create directory path in the worktree, or check that the one there is not a symlink.
+        Its parent has been checked already.
+        """
+        dir_path = os.path.join(self.work_tree, path)
+        try:
+            os.mkdir(dir_path)
+        except FileExistsError:
+            if not stat.S_ISDIR(os.lstat(dir_path).st_mode):
+                raise CheckoutError("Not a directory: " + os.fsdecode(path))
+
+    def add_entry(self, path: bytes, mode: int, hash_name: str):
+        if stat.S_ISDIR(mode):
+            self.make_dir(path)
+            self.add_tree(hash_name, path + b"/")
+        elif mode == MODE_GITLINK:
+            # Submodules are left empty, as git does without --recurse-submodules
+            self.make_dir(path)
+            self.entries[path] = (path, mode, hash_name, EMPTY_STAT)
+        else:
+            write_loose = hash_name not in self.written
+            self.written.add(hash_name)
+            self.futures.append(get_checkout_executor().submit(self.checkout_blob, path, mode,
+                                                               hash_name, write_loose))
+
+    def remove_entry(self, path: bytes, mode: int):
+        file_path = os.path.join(self.work_tree, path)
+        if stat.S_ISDIR(mode) or mode == MODE_GITLINK:
+            shutil.rmtree(file_path, ignore_errors=True)
+            self.removed_dirs.append(path + b"/")
+        else:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+        self.removed_files.add(path)
+
+    def diff_tree(self, old_tree: str, tree: str, prefix: bytes):
+        if old_tree == tree:
+            # Same hash, same content all the way down
+            return
+        old_entries = {name: (mode, hash_name) for mode, name, hash_name
+                       in self.parse_tree(self.read_local(old_tree, "tree"), old_tree)}
+        for mode, name, hash_name in self.read_tree(tree):
+            path = prefix + name
+            old_mode, old_hash = old_entries.pop(name, (None, None))
+            if old_mode == mode and old_hash == hash_name:
+                continue
+            if old_mode is not None and stat.S_ISDIR(old_mode) and stat.S_ISDIR(mode):
+                self.make_dir(path)
+                self.diff_tree(old_hash, hash_name, path + b"/")
+                continue
+            if old_mode is not None:
+                self.remove_entry(path, old_mode)
+            self.add_entry(path, mode, hash_name)
+        for name, (old_mode, _) in old_entries.items():
+            self.remove_entry(prefix + name, old_mode)
+
+    def collect(self):
+        # Never return or raise with a worker still writing into the tree
+        wait(self.futures)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            try:
+                entry = future.result()
+            except (OSError, zlib.error, ValueError) as e:
+                raise CheckoutError(str(e))
+            self.entries[entry[0]] = entry
+
+    def checkout_blob(self, path: bytes, mode: int, hash_name: str,
+                      write_loose: bool) -> Tuple[bytes, int, str, Tuple[int, ...]]:
+        file_path = os.path.join(self.work_tree, path)
+        if mode == MODE_SYMLINK:
+            raw_data = self.get_raw(hash_name)
+            if write_loose:
+                self.write_loose(hash_name, raw_data)
+            if os.path.lexists(file_path):
+                os.unlink(file_path)
+            os.symlink(decode_object(raw_data)[1], file_path)
+            return path, mode, hash_name, index_stat(os.lstat(file_path))
+
+        if not self.storage.exists(hash_name):
+            raise CheckoutError("Missing object " + hash_name)
+        loose = None
+        if write_loose:
+            os.makedirs(os.path.dirname(self.loose_path(hash_name)), exist_ok=True)
+            loose = open(self.loose_path(hash_name), "wb")
+        # A symlink left in place would redirect the write
+        if os.path.islink(file_path):
+            os.unlink(file_path)
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f, self.storage.get_stream(hash_name) as stream:
+                decompressor = zlib.decompressobj()
+                header = b""
+                for raw_chunk in iter(lambda: stream.read(CHECKOUT_CHUNK_SIZE), b""):
+                    if loose is not None:
+                        loose.write(raw_chunk)
+                    while raw_chunk:
+                        data = decompressor.decompress(raw_chunk, CHECKOUT_CHUNK_SIZE)
+                        raw_chunk = decompressor.unconsumed_tail
+                        if header is not None:
+                            # Strip the "blob <size>" header
+                            header += data
+                            header_size = header.find(b"\x00")
+                            if header_size < 0:
+                                continue
+                            data = header[header_size + 1:]
+                            header = None
+                        f.write(data)
+                f.write(decompressor.flush())
+                if mode & 0o111:
+                    st = os.fstat(f.fileno())
+                    os.fchmod(f.fileno(), st.st_mode | (st.st_mode & 0o444) >> 2)
+        finally:
+            if loose is not None:
+                loose.close()
+        return path, index_mode(mode), hash_name, index_stat(os.lstat(file_path))
+
+    def read_file(self, path: bytes) -> bytes:
+        try:
+            with open(os.path.join(self.git_dir, path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise CheckoutError("Missing .git/" + os.fsdecode(path))
+
+    def write_file(self, path: bytes, content: bytes):
+        # Written aside and renamed, as git does, so readers never see half a file
+        path = os.path.join(self.git_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + b".lock", "wb") as f:
+            f.write(content)
+        os.replace(path + b".lock", path)
+
+    def write_refs(self, commit: str, branch: str, remote: str):
+        head = (commit + "\n").encode()
+        self.write_file(b"HEAD", "ref: refs/heads/{}\n".format(branch).encode())
+        self.write_file(os.path.join(b"refs/heads", branch.encode()), head)
+        self.write_file(os.path.join(b"refs/remotes/origin", branch.encode()), head)
+        os.makedirs(os.path.join(self.git_dir, b"refs/tags"), exist_ok=True)
+        # The parents of commit are not in .git/objects
+        self.write_file(b"shallow", head)
+        self.write_file(b"config", GIT_CONFIG.format(remote=remote, branch=branch).encode())
+
+
+def checkout(storage: IStorage, path: str, commit: str, branch: str, remote: str):
+    """
+    Check out commit into path, which must not exist yet and appears only once complete
+    """
+    tmp_path = path + CHECKOUT_TMP_SUFFIX
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    try:
+        Checkout(storage, tmp_path).run(commit, branch, remote)
+        os.rename(tmp_path, path)
+    except (CheckoutError, OSError):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def refresh(storage: IStorage, path: str, commit: str, branch: str, remote: str):
+    """
+    Bring the checkout of branch at path to commit, checking it out if path does not exist
+    """
+    if os.path.isdir(path):
+        Checkout(storage, path).update(commit, branch)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        checkout(storage, path, commit, branch, remote)
+
+
+async def refresh_async(storage: IStorage, path: str, commit: str, branch: str, remote: str):
+    event_loop = asyncio.get_event_loop()
+    await event_loop.run_in_executor(None, refresh, storage, path, commit, branch, remote)
+
+
+async def checkout_async(storage: IStorage, path: str, commit: str, branch: str, remote: str):
+    event_loop = asyncio.get_event_loop()
+    await event_loop.run_in_executor(None, checkout, storage, path, commit, branch, remote)
@@ -0,0 +1,187 @@
+import os
+import shutil
+import stat
+import subprocess
+import pytest
+from ndngitsync.checkout import checkout, refresh, decode_index, CheckoutError, MODE_FILE, MODE_EXECUTABLE, \
+    MODE_SYMLINK, MODE_GITLINK
+
+BRANCH = "master"
+REMOTE = "ndn:/git/repo"
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def index_of(work_tree) -> dict:
+    """
+    path -> (mode, hash_name, stat) from the git index of work_tree
+    """
+    raw = read(os.path.join(work_tree, ".git", "index"))
+    return {path.decode(): (mode, hash_name, st) for path, mode, hash_name, st in decode_index(raw)}
+
+
+def assert_clean(work_tree):
+    # git itself agrees that the worktree matches the index and HEAD
+    if shutil.which("git") is None:
+        return
+    status = subprocess.run(["git", "-C", str(work_tree), "status", "--porcelain"], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    assert status == b""
+
+
+def make_first(objects) -> dict:
+    h = {
+        "keep": objects.blob(b"unchanged\n"),
+        "change": objects.blob(b"old\n"),
+        "gone": objects.blob(b"removed\n"),
+        "run": objects.blob(b"#!/bin/sh\n"),
+        "swap": objects.blob(b"file becoming a directory\n"),
+        "inner": objects.blob(b"inner\n"),
+    }
+    h["dir"] = objects.tree([(b"100644", b"inner", h["inner"]), (b"100644", b"keep", h["keep"])])
+    h["tree"] = objects.tree([
+        (b"100644", b"change", h["change"]),
+        (b"40000", b"dir", h["dir"]),
+        (b"100644", b"gone", h["gone"]),
+        (b"100644", b"keep", h["keep"]),
+        (b"120000", b"link", objects.blob(b"keep")),
+        (b"100755", b"run", h["run"]),
+        (b"160000", b"sub", "ab" * 20),
+        (b"100644", b"swap", h["swap"]),
+    ])
+    h["commit"] = objects.commit(h["tree"])
+    return h
+
+
+def make_second(objects, h: dict) -> dict:
+    """
+    change is edited, gone removed, new added, dir becomes a file and swap a directory;
+    keep and dir/keep stay as they are
+    """
+    h2 = {
+        "change": objects.blob(b"new\n"),
+        "new": objects.blob(b"added\n"),
+        "dir": objects.blob(b"directory becoming a file\n"),
+    }
+    h2["swap"] = objects.tree([(b"100644", b"keep", h["keep"])])
+    h2["tree"] = objects.tree([
+        (b"100644", b"change", h2["change"]),
+        (b"100644", b"dir", h2["dir"]),
+        (b"100644", b"keep", h["keep"]),
+        (b"120000", b"link", objects.blob(b"keep")),
+        (b"100644", b"new", h2["new"]),
+        (b"100755", b"run", h["run"]),
+        (b"160000", b"sub", "ab" * 20),
+        (b"40000", b"swap", h2["swap"]),
+    ])
+    h2["commit"] = objects.commit(h2["tree"], [h["commit"]])
+    return h2
+
+
+def test_checkout_writes_files_and_index(objects, tmp_path):
+    h = make_first(objects)
+    work_tree = str(tmp_path / "wt")
+    checkout(objects.storage, work_tree, h["commit"], BRANCH, REMOTE)
+    assert read(os.path.join(work_tree, "change")) == b"old\n"
+    assert read(os.path.join(work_tree, "dir", "inner")) == b"inner\n"
+    assert os.readlink(os.path.join(work_tree, "link")) == "keep"
+    assert os.stat(os.path.join(work_tree, "run")).st_mode & 0o100
+    assert not os.stat(os.path.join(work_tree, "keep")).st_mode & 0o100
+    assert os.listdir(os.path.join(work_tree, "sub")) == []
+    index = index_of(work_tree)
+    assert sorted(index) == ["change", "dir/inner", "dir/keep", "gone", "keep", "link", "run", "sub", "swap"]
+    assert index["keep"][:2] == (MODE_FILE, h["keep"])
+    assert index["run"][:2] == (MODE_EXECUTABLE, h["run"])
+    assert index["link"][0] == MODE_SYMLINK
+    assert index["sub"][0] == MODE_GITLINK
+    assert index["keep"][2][-1] == len(b"unchanged\n")
+    assert read(os.path.join(work_tree, ".git", "refs", "heads", BRANCH)) == (h["commit"] + "\n").encode()
+    assert not os.path.exists(work_tree + ".tmp")
+    assert_clean(work_tree)
+
+
+def test_refresh_rewrites_only_what_changed(objects, tmp_path):
+    h = make_first(objects)
+    h2 = make_second(objects, h)
+    work_tree = str(tmp_path / "wt")
+    refresh(objects.storage, work_tree, h["commit"], BRANCH, REMOTE)
+    # An old mtime tells whether a file was written again
+    for path in ("keep", "run"):
+        os.utime(os.path.join(work_tree, path), (1000000000, 1000000000))
+    kept = {path: os.stat(os.path.join(work_tree, path)) for path in ("keep", "run")}
+    old_index = index_of(work_tree)
+
+    refresh(objects.storage, work_tree, h2["commit"], BRANCH, REMOTE)
+    assert read(os.path.join(work_tree, "change")) == b"new\n"
+    assert read(os.path.join(work_tree, "new")) == b"added\n"
+    assert not os.path.exists(os.path.join(work_tree, "gone"))
+    assert read(os.path.join(work_tree, "dir")) == b"directory becoming a file\n"
+    assert read(os.path.join(work_tree, "swap", "keep")) == b"unchanged\n"
+    for path, st in kept.items():
+        assert os.stat(os.path.join(work_tree, path)).st_mtime == st.st_mtime
+    index = index_of(work_tree)
+    assert sorted(index) == ["change", "dir", "keep", "link", "new", "run", "sub", "swap/keep"]
+    # Unchanged entries keep the stat data recorded at checkout
+    assert index["link"] == old_index["link"]
+    assert index["keep"] == old_index["keep"]
+    assert index["change"][1] == h2["change"]
+    assert read(os.path.join(work_tree, ".git", "refs", "heads", BRANCH)) == (h2["commit"] + "\n").encode()
+    assert read(os.path.join(work_tree, ".git", "shallow")).split() == [h["commit"].encode(), h2["commit"].encode()]
+    assert_clean(work_tree)
+
+    # And back again
+    refresh(objects.storage, work_tree, h["commit"], BRANCH, REMOTE)
+    assert read(os.path.join(work_tree, "dir", "inner")) == b"inner\n"
+    assert os.path.isfile(os.path.join(work_tree, "swap"))
+    assert sorted(index_of(work_tree)) == sorted(old_index)
+    assert_clean(work_tree)
+
+
+def test_duplicate_names_are_rejected(objects, tmp_path):
+    # A symlink out of the worktree and a directory of the same name
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    link = objects.blob(str(outside).encode())
+    subtree = objects.tree([(b"100644", b"x", objects.blob(b"x"))])
+    tree = objects.tree([(b"120000", b"d", link), (b"40000", b"d", subtree)])
+    work_tree = str(tmp_path / "wt")
+    with pytest.raises(CheckoutError):
+        checkout(objects.storage, work_tree, objects.commit(tree), BRANCH, REMOTE)
+    assert os.listdir(str(outside)) == []
+    assert not os.path.exists(work_tree)
+    assert not os.path.exists(work_tree + ".tmp")
+
+
+@pytest.mark.parametrize("name", [b"..", b".git", b".GIT", b"."])
+def test_unsafe_names_are_rejected(objects, tmp_path, name):
+    tree = objects.tree([(b"100644", name, objects.blob(b"x"))])
+    with pytest.raises(CheckoutError):
+        checkout(objects.storage, str(tmp_path / "wt"), objects.commit(tree), BRANCH, REMOTE)
+
+
+def test_refresh_does_not_follow_symlinks(objects, tmp_path):
+    h = make_first(objects)
+    dir_2 = objects.tree([(b"100644", b"inner", objects.blob(b"inner changed\n")), (b"100644", b"keep", h["keep"])])
+    tree_2 = objects.tree([
+        (b"100644", b"change", objects.blob(b"new\n")),
+        (b"40000", b"dir", dir_2),
+        (b"100644", b"keep", h["keep"]),
+    ])
+    work_tree = str(tmp_path / "wt")
+    refresh(objects.storage, work_tree, h["commit"], BRANCH, REMOTE)
+    # Someone replaces a directory of the checkout with a symlink out of it
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    shutil.rmtree(os.path.join(work_tree, "dir"))
+    os.symlink(str(outside), os.path.join(work_tree, "dir"))
+    # A file replaced with a symlink is replaced, not written through
+    os.unlink(os.path.join(work_tree, "change"))
+    os.symlink(str(outside / "target"), os.path.join(work_tree, "change"))
+    with pytest.raises(CheckoutError):
+        refresh(objects.storage, work_tree, objects.commit(tree_2, [h["commit"]]), BRANCH, REMOTE)
+    assert os.listdir(str(outside)) == []
+    assert read(os.path.join(work_tree, "change")) == b"new\n"
+    assert stat.S_ISLNK(os.lstat(os.path.join(work_tree, "dir")).st_mode)
@@ -2,10 +2,31 @@ DATABASE_NAME = "gitsync"
 GIT_PREFIX = "git"
 OBJECTS_COLL_NAME = "~objects"
 REPOS_COLL_NAME = "~repos"
+CLOSURE_COLL_NAME = "~closure"
+CLOSURE_SEEDED_KEY = "~seeded"
+MANIFEST_COLL_NAME = "~manifests"
+JOURNAL_COLL_NAME = "~journal"
+REFS_COLL_NAME = "~refs"
+MOUNTS_COLL_NAME = "~mounts"
+REFS_KEY_SEPARATOR = "/"
 LOCAL_CMD_PREFIX = "/localhost/gitsync"
 
 PUSH_RESPONSE_PENDING = 0
 PUSH_RESPONSE_SUCCESS = 1
 PUSH_RESPONSE_FAILURE = 2
 
+SYNC_RETRY_INITIAL_DELAY = 5.0
+SYNC_RETRY_MAX_DELAY = 300.0
+
+# Congestion window and retransmission timeout shared by the fetches of all repos
+FETCH_INITIAL_WINDOW = 2.0
+FETCH_MAX_WINDOW = 64.0
+FETCH_INITIAL_RTO = 1.0
+FETCH_MIN_RTO = 0.2
+FETCH_MAX_RTO = 8.0
+
+REPO_IDLE_TIMEOUT = 600.0
+REPO_EVICT_INTERVAL = 60.0
+
 MOUNT_PATH = "~/.gitsync/~mount"
+MOUNT_BRANCHES_DIR = "~branches"
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import random
+import zlib
+import pytest
+from pyndn import Data, Interest, Name
+from storage.filesystem import FileStorage
+
+
+class Network:
+    """
+    In-process NDN network: Interests go to every face with a matching filter and
+    Data satisfies every matching pending Interest. Each packet is delayed by delay
+    plus up to jitter seconds, so a jitter reorders them. drop(interest) loses
+    the Interest when it returns True.
+    """
+    def __init__(self):
+        self.faces = []
+        self.delay = 0.0
+        self.jitter = 0.0
+        self.drop = None
+
+    def face(self) -> "LoopbackFace":
+        face = LoopbackFace(self)
+        self.faces.append(face)
+        return face
+
+    def later(self, callback, *args):
+        delay = self.delay + random.uniform(0, self.jitter)
+        asyncio.get_event_loop().call_later(delay, callback, *args)
+
+
+class LoopbackFace:
+    def __init__(self, network: Network):
+        self.network = network
+        self.filters = {}
+        self.pending = []
+        self.last_id = 0
+        self.interest_cnt = 0
+
+    def callLater(self, delayMilliseconds, callback):
+        asyncio.get_event_loop().call_later(delayMilliseconds / 1000.0, callback)
+
+    def setInterestFilter(self, prefix, on_interest):
+        self.last_id += 1
+        self.filters[self.last_id] = (Name(prefix), on_interest)
+        return self.last_id
+
+    def registerPrefix(self, prefix, on_interest, on_register_failed, *args, **kwargs):
+        if on_interest is None:
+            self.last_id += 1
+            return self.last_id
+        return self.setInterestFilter(prefix, on_interest)
+
+    def removeRegisteredPrefix(self, filter_id):
+        self.filters.pop(filter_id, None)
+
+    def expressInterest(self, interest, on_data, on_timeout=None, on_network_nack=None):
+        self.interest_cnt += 1
+        entry = [Interest(interest), on_data, False]
+        self.pending.append(entry)
+
+        def timeout():
+            if not entry[2]:
+                entry[2] = True
+                self.pending.remove(entry)
+                if on_timeout is not None:
+                    on_timeout(entry[0])
+
+        self.callLater(interest.interestLifetimeMilliseconds or 4000.0, timeout)
+        if self.network.drop is not None and self.network.drop(interest):
+            return
+        wire = interest.wireEncode()
+        for face in self.network.faces:
+            for filter_id, (prefix, on_interest) in list(face.filters.items()):
+                if prefix.match(interest.name):
+                    received = Interest()
+                    received.wireDecode(wire)
+                    self.network.later(on_interest, prefix, received, face, filter_id, None)
+                    break
+
+    def send(self, wire):
+        data = Data()
+        data.wireDecode(bytes(wire))
+        for face in self.network.faces:
+            for entry in list(face.pending):
+                if not entry[2] and entry[0].matchesData(data):
+                    entry[2] = True
+                    face.pending.remove(entry)
+                    self.network.later(entry[1], entry[0], data)
+
+    def putData(self, data):
+        self.send(data.wireEncode().toBytes())
+
+
+class ObjectWriter:
+    """
+    Writes loose git objects into a storage and returns their ids
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        # Commits get increasing committer times, as when made one after another
+        self.clock = 1500000000
+
+    def put(self, content_type: str, content: bytes) -> str:
+        data = content_type.encode() + b" %d\x00" % len(content) + content
+        hash_name = hashlib.sha1(data).hexdigest()
+        self.storage.put(hash_name, zlib.compress(data))
+        return hash_name
+
+    def blob(self, content: bytes) -> str:
+        return self.put("blob", content)
+
+    def tree(self, entries) -> str:
+        """
+        entries are (mode, name, hash_name), with mode and name as bytes, in git order
+        """
+        return self.put("tree", b"".join(mode + b" " + name + b"\x00" + bytes.fromhex(hash_name)
+                                         for mode, name, hash_name in entries))
+
+    def commit(self, tree: str, parents=()) -> str:
+        self.clock += 1
+        lines = ["tree " + tree] + ["parent " + parent for parent in parents]
+        lines += ["author a <a@a> {} +0000".format(self.clock), "committer a <a@a> {} +0000".format(self.clock),
+                  "", "message", ""]
+        return self.put("commit", "\n".join(lines).encode())
+
+
+@pytest.fixture
+def network():
+    return Network()
+
+
+@pytest.fixture
+def objects(tmp_path):
+    return ObjectWriter(FileStorage(str(tmp_path / "src")))
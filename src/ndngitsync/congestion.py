@@ -0,0 +1,135 @@
+from typing import Optional
+import time
+import asyncio
+import collections
+
+
+CC_INITIAL_WINDOW = 2.0
+CC_MIN_WINDOW = 1.0
+CC_MAX_WINDOW = 64.0
+CC_INITIAL_SSTHRESH = 32.0
+CC_DECREASE_FACTOR = 0.5
+CC_INITIAL_RTO = 1.0
+CC_MIN_RTO = 0.2
+CC_MAX_RTO = 8.0
+CC_RTT_ALPHA = 0.125
+CC_RTT_BETA = 0.25
+CC_RTO_K = 4
+
+
+class CongestionController:
+    """
+    AIMD window over outstanding Interests, with RTO estimation as in RFC 6298.
+    Times are in seconds unless stated otherwise. Waiters are grouped by owner and
+    granted slots round-robin, so one window can be shared fairly.
+    """
+    def __init__(self,
+                 initial_window: float = CC_INITIAL_WINDOW,
+                 min_window: float = CC_MIN_WINDOW,
+                 max_window: float = CC_MAX_WINDOW,
+                 ssthresh: float = CC_INITIAL_SSTHRESH,
+                 decrease_factor: float = CC_DECREASE_FACTOR,
+                 initial_rto: float = CC_INITIAL_RTO,
+                 min_rto: float = CC_MIN_RTO,
+                 max_rto: float = CC_MAX_RTO):
+        self.window = float(initial_window)
+        self.min_window = float(min_window)
+        self.max_window = float(max_window)
+        self.ssthresh = float(ssthresh)
+        self.decrease_factor = decrease_factor
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = initial_rto
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.waiters = collections.OrderedDict()
+
+    def limit(self) -> int:
+        return max(int(self.window), 1)
+
+    async def acquire(self, owner=None):
+        if not self.waiters and self.in_flight < self.limit():
+            self.in_flight += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(owner, collections.deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # The slot may have been granted right before cancellation
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake_up()
+
+    def wake_up(self):
+        while self.waiters and self.in_flight < self.limit():
+            owner, queue = next(iter(self.waiters.items()))
+            fut = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(owner)
+            else:
+                del self.waiters[owner]
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def on_data(self, rtt: float, retransmitted: bool = False):
+        # Karn's algorithm: ambiguous samples are not used for RTT estimation
+        if not retransmitted:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2.0
+            else:
+                self.rttvar = (1 - CC_RTT_BETA) * self.rttvar + CC_RTT_BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - CC_RTT_ALPHA) * self.srtt + CC_RTT_ALPHA * rtt
+            self.rto = min(max(self.srtt + CC_RTO_K * self.rttvar, self.min_rto), self.max_rto)
+        # Slow start below ssthresh, additive increase above
+        if self.window < self.ssthresh:
+            self.window += 1.0
+        else:
+            self.window += 1.0 / self.window
+        self.window = min(self.window, self.max_window)
+        self.wake_up()
+
+    def on_timeout(self):
+        self.rto = min(self.rto * 2.0, self.max_rto)
+        self.decrease()
+
+    def on_nack(self):
+        self.decrease()
+
+    def decrease(self):
+        # Only react once per RTT to a burst of losses
+        now = time.monotonic()
+        if now - self.last_decrease < (self.srtt if self.srtt is not None else self.rto):
+            return
+        self.last_decrease = now
+        self.ssthresh = max(self.window * self.decrease_factor, self.min_window)
+        self.window = self.ssthresh
+
+    def interest_lifetime(self) -> float:
+        """
+        Interest lifetime in milliseconds
+        """
+        return self.rto * 1000.0
+
+    def retry_interval(self) -> float:
+        return self.rto
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "ssthresh": self.ssthresh,
+            "in_flight": self.in_flight,
+            "waiting_owners": len(self.waiters),
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "rto": self.rto,
+        }
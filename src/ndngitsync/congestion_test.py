@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from ndngitsync.congestion import CongestionController
+
+
+def test_slow_start_then_additive_increase():
+    congestion = CongestionController(initial_window=2, ssthresh=4)
+    for _ in range(2):
+        congestion.on_data(0.1)
+    assert congestion.window == 4
+    congestion.on_data(0.1)
+    assert congestion.window == pytest.approx(4.25)
+
+
+def test_multiplicative_decrease_once_per_rtt():
+    congestion = CongestionController(initial_window=16, ssthresh=64)
+    congestion.on_data(10.0)
+    congestion.on_nack()
+    assert congestion.window == pytest.approx(8.5)
+    assert congestion.ssthresh == pytest.approx(8.5)
+    # Losses within the same RTT are one congestion event
+    congestion.on_nack()
+    congestion.on_timeout()
+    assert congestion.window == pytest.approx(8.5)
+
+
+def test_window_stays_within_bounds():
+    congestion = CongestionController(initial_window=2, min_window=1, max_window=4, ssthresh=64)
+    for _ in range(10):
+        congestion.on_data(0.1)
+    assert congestion.window == 4
+    for _ in range(10):
+        congestion.last_decrease = 0.0
+        congestion.on_nack()
+    assert congestion.window == 1
+
+
+def test_rto_estimation():
+    congestion = CongestionController(min_rto=0.01, max_rto=10.0)
+    congestion.on_data(0.2)
+    assert congestion.srtt == pytest.approx(0.2)
+    assert congestion.rttvar == pytest.approx(0.1)
+    assert congestion.rto == pytest.approx(0.2 + 4 * 0.1)
+    congestion.on_data(0.4)
+    assert congestion.rttvar == pytest.approx(0.75 * 0.1 + 0.25 * 0.2)
+    assert congestion.srtt == pytest.approx(0.875 * 0.2 + 0.125 * 0.4)
+    assert congestion.interest_lifetime() == pytest.approx(congestion.rto * 1000)
+
+
+def test_retransmitted_samples_are_ignored():
+    congestion = CongestionController()
+    congestion.on_data(0.2)
+    rto = congestion.rto
+    congestion.on_data(5.0, retransmitted=True)
+    assert congestion.srtt == pytest.approx(0.2)
+    assert congestion.rto == rto
+
+
+def test_timeout_backs_off_rto():
+    congestion = CongestionController(initial_rto=1.0, max_rto=3.0)
+    congestion.on_timeout()
+    assert congestion.rto == 2.0
+    congestion.on_timeout()
+    assert congestion.rto == 3.0
+    # A fresh sample brings it back down
+    congestion.on_data(0.1)
+    assert congestion.rto < 1.0
+
+
+def test_slots_granted_round_robin():
+    async def run():
+        congestion = CongestionController(initial_window=1)
+        await congestion.acquire("a")
+        order = []
+
+        async def use(owner):
+            await congestion.acquire(owner)
+            order.append(owner)
+            congestion.release()
+
+        tasks = [asyncio.ensure_future(use(owner)) for owner in ("a", "a", "a", "b", "b")]
+        await asyncio.sleep(0)
+        assert congestion.in_flight == 1
+        congestion.release()
+        await asyncio.gather(*tasks)
+        assert congestion.in_flight == 0
+        return order
+
+    assert asyncio.run(run()) == ["a", "b", "a", "b", "a"]
@@ -1,18 +1,56 @@
-from typing import Optional, Union
+from typing import BinaryIO, List, Optional, Tuple, Union
 import sys
+import heapq
 import zlib
 import hashlib
 import asyncio
+import tempfile
+import time
 import logging
 from pyndn import Face, Interest, Data, NetworkNack, Name
 from .storage import IStorage
+from .congestion import CongestionController
+from .lrucache import LruCache
+from .gitobject import OBJECT_TYPES, commit_children, tree_children, verify_object_async, ObjectVerifier
+from .negotiation import NEGOTIATION_MAX_HAVES, encode_haves, decode_haves, encode_objects, decode_objects, \
+    missing_objects_async, write_bundle, decode_manifest, BundleDecoder, OBJECTS_ENTRY_SIZE, MANIFEST_ENTRY
 
 
 FETCHER_MAX_ATTEMPT_NUMBER = 3
-FETCHER_RETRY_INTERVAL = 1000.0
 FETCHER_FINAL_BLOCK_ID = 2 ** 31 - 1
-FETCHER_MAX_INTEREST_IN_FLIGHT = 20
-HASH_LENGTH = 20
+FETCHER_SEGMENT_WINDOW = 8
+FETCHER_REORDER_LIMIT = 4 * FETCHER_SEGMENT_WINDOW
+FETCHER_BUFFER_SIZE = 4 * 1024 * 1024
+FETCHER_MIN_ACTIVE = 4
+FETCHER_OBJECT_ATTEMPTS = 5
+FETCHER_RETRY_INITIAL_DELAY = 1.0
+FETCHER_RETRY_MAX_DELAY = 30.0
+FETCHER_JOURNAL_INTERVAL = 5.0
+# Commits and trees extend the frontier, so they go before blobs
+FETCHER_TYPE_PRIORITY = {"commit": 0, "tag": 0, "tree": 1, "": 1, "blob": 2}
+FETCHER_BUNDLE_THRESHOLD = 64
+PRODUCER_SEGMENT_SIZE = 4400
+PRODUCER_NEGOTIATE_COMPONENT = "negotiate"
+PRODUCER_BUNDLE_COMPONENT = "bundle"
+PRODUCER_BUNDLE_MAX_SIZE = 32 * 1024 * 1024
+# Negotiation results and bundles are kept in temporary files, spilling to disk past this size
+PRODUCER_SPOOL_SIZE = 1024 * 1024
+PRODUCER_NEGOTIATION_CACHE_SIZE = 8 * PRODUCER_BUNDLE_MAX_SIZE
+# Results for a want whose closure is not stored may grow as objects arrive, so they are
+# kept only long enough to be fetched, and not written again once evicted
+PRODUCER_NEGOTIATION_TTL = 60.0
+# Objects in each result, so an evicted one is written again identically
+PRODUCER_NEGOTIATION_RECORD_CACHE_SIZE = 16 * 1024 * 1024
+PRODUCER_MISSING_CACHE_SIZE = 4 * 1024 * 1024
+PRODUCER_MISSING_ENTRY_SIZE = 64
+PRODUCER_FRESHNESS_PERIOD = 60000
+PRODUCER_SEGMENT_CACHE_SIZE = 16 * 1024 * 1024
+# Objects larger than this are read a segment at a time, from one of this many streams kept open
+PRODUCER_STREAM_THRESHOLD = 1024 * 1024
+PRODUCER_OPEN_STREAMS = 16
+PRODUCER_PACKET_CACHE_SIZE = 64 * 1024 * 1024
+PRODUCER_NEGATIVE_CACHE_ENTRIES = 4096
+PRODUCER_NEGATIVE_CACHE_TTL = 1.0
 
 
 async def fetch_data_packet(face: Face, interest: Interest) -> Union[Data, NetworkNack, None]:
@@ -38,139 +76,494 @@ async def fetch_data_packet(face: Face, interest: Interest) -> Union[Data, Netwo
     return result
 
 
-async def fetch_object(face: Face, prefix: Name, semaphore: asyncio.Semaphore) -> Optional[bytes]:
-    async def retry_or_fail() -> Optional[Data]:
-        nonlocal interest
-        result = None
-        # retry for up to FETCHER_MAX_ATTEMPT_NUMBER times
-        for _ in range(FETCHER_MAX_ATTEMPT_NUMBER):
-            # express interest
-            async with semaphore:
+async def fetch_object(face: Face, prefix: Name, congestion: CongestionController,
+                       app_params: Optional[bytes] = None,
+                       max_attempts: int = FETCHER_MAX_ATTEMPT_NUMBER,
+                       owner=None) -> Optional[BinaryIO]:
+    """
+    Fetch every segment under prefix into a temporary file, which spills to disk past
+    FETCHER_BUFFER_SIZE, and return it rewound; the caller closes it
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=FETCHER_BUFFER_SIZE)
+
+    async def write(segment: bytes):
+        spool.write(segment)
+
+    if not await fetch_segments(face, prefix, congestion, write, app_params, max_attempts, owner):
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool
+
+
+def decode_stream(stream: BinaryIO, entry_size: int, decode) -> list:
+    """
+    Decode the fixed-size entries read from stream, FETCHER_BUFFER_SIZE bytes at a time
+    """
+    piece_size = FETCHER_BUFFER_SIZE - FETCHER_BUFFER_SIZE % entry_size
+    ret = []
+    for piece in iter(lambda: stream.read(piece_size), b""):
+        ret += decode(piece)
+    return ret
+
+
+async def run_shared(in_flight: dict, key, load):
+    """
+    Await load(), or the result of the call already running for key
+    """
+    future = in_flight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+    future = asyncio.get_event_loop().create_future()
+    in_flight[key] = future
+    result = None
+    try:
+        result = await load()
+    finally:
+        del in_flight[key]
+        future.set_result(result)
+    return result
+
+
+async def fetch_segments(face: Face, prefix: Name, congestion: CongestionController, write,
+                         app_params: Optional[bytes] = None,
+                         max_attempts: int = FETCHER_MAX_ATTEMPT_NUMBER,
+                         owner=None) -> bool:
+    """
+    Fetch every segment under prefix and await write on their contents in order.
+    At most FETCHER_REORDER_LIMIT segments are held back waiting for an earlier one.
+    """
+    async def retry_or_fail(interest: Interest) -> Optional[Data]:
+        # retry for up to max_attempts times
+        for attempt in range(max_attempts):
+            # express interest within the congestion window
+            interest.interestLifetimeMilliseconds = congestion.interest_lifetime()
+            await congestion.acquire(owner)
+            start = time.monotonic()
+            try:
                 response = await fetch_data_packet(face, interest)
+            finally:
+                congestion.release()
             if isinstance(response, Data):
                 # if succeeded, jump out
-                result = response
-                break
+                congestion.on_data(time.monotonic() - start, attempt > 0)
+                return response
+            elif isinstance(response, NetworkNack):
+                # if nacked, wait for next time
+                congestion.on_nack()
+                await asyncio.sleep(congestion.retry_interval())
             else:
-                # if failed, wait for next time
-                await asyncio.sleep(FETCHER_RETRY_INTERVAL / 1000.0)
-        return result
-
-    data = bytes("", "utf-8")
-    final_id = FETCHER_FINAL_BLOCK_ID
-    cur_id = 0
-    while cur_id <= final_id:
-        if cur_id == 0:
-            interest = Interest(Name(prefix))
-        else:
-            interest = Interest(Name(prefix).appendSegment(cur_id))
-        data_packet = await retry_or_fail()
-        if data_packet is None:
-            return None
-        data += data_packet.content.toBytes()
-        final_id_component = data_packet.metaInfo.getFinalBlockId()
-        if final_id_component.isSegment():
-            final_id = final_id_component.toSegment()
-        else:
-            break
-        cur_id += 1
-    return data
+                # if timed out, the lifetime has already been waited for
+                congestion.on_timeout()
+        return None
+
+    async def segment_worker():
+        nonlocal failed, next_id, writing
+        # Workers share one iterator, so every segment is requested exactly once
+        for seg_id in pending:
+            # Do not run too far ahead of a segment being retried
+            while seg_id - next_id >= FETCHER_REORDER_LIMIT and not failed:
+                advanced.clear()
+                await advanced.wait()
+            if failed:
+                return
+            data_packet = await retry_or_fail(Interest(Name(prefix).appendSegment(seg_id)))
+            if data_packet is None:
+                failed = True
+                advanced.set()
+                return
+            ready[seg_id] = data_packet.content.toBytes()
+            # One worker at a time writes; it also takes segments arriving meanwhile
+            if not writing:
+                writing = True
+                try:
+                    while next_id in ready:
+                        await write(ready.pop(next_id))
+                        next_id += 1
+                finally:
+                    writing = False
+            advanced.set()
+
+    # Segment 0 tells us the FinalBlockId
+    first_interest = Interest(Name(prefix))
+    if app_params is not None:
+        first_interest.applicationParameters = app_params
+        first_interest.appendParametersDigestToName()
+    data_packet = await retry_or_fail(first_interest)
+    if data_packet is None:
+        return False
+    await write(data_packet.content.toBytes())
+    final_id_component = data_packet.metaInfo.getFinalBlockId()
+    if not final_id_component.isSegment():
+        return True
+    final_id = min(final_id_component.toSegment(), FETCHER_FINAL_BLOCK_ID)
+
+    # Keep a window of segment Interests outstanding and pass them on in order
+    pending = iter(range(1, final_id + 1))
+    next_id = 1
+    ready = {}
+    advanced = asyncio.Event()
+    failed = False
+    writing = False
+    window = min(FETCHER_SEGMENT_WINDOW, final_id)
+    await asyncio.gather(*(segment_worker() for _ in range(window)))
+    return not failed
+
+
+class FetchCoordinator:
+    """
+    Object fetches of all sessions writing to one storage. Concurrent requests for
+    the same object share one future, and all sessions draw from one congestion
+    window, which is granted round-robin between them.
+    """
+    def __init__(self, congestion: Optional[CongestionController] = None):
+        self.congestion = congestion if congestion is not None else CongestionController()
+        self.in_flight = {}
+        self.shared_cnt = 0
+
+    async def run_once(self, key, load):
+        if key in self.in_flight:
+            self.shared_cnt += 1
+        return await run_shared(self.in_flight, key, load)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.in_flight),
+            "shared": self.shared_cnt,
+            "congestion": self.congestion.stats(),
+        }
 
 
 class GitFetcher:
-    def __init__(self, face: Face, prefix: Union[Name, str], storage: IStorage):
+    def __init__(self, face: Face, prefix: Union[Name, str], storage: IStorage,
+                 congestion: Optional[CongestionController] = None,
+                 closure_db: Optional[IStorage] = None,
+                 coordinator: Optional[FetchCoordinator] = None,
+                 buffer_size: int = FETCHER_BUFFER_SIZE,
+                 journal_db: Optional[IStorage] = None):
         self.face = face
-        self.semaphore = asyncio.Semaphore(FETCHER_MAX_INTEREST_IN_FLIGHT)
+        self.coordinator = coordinator if coordinator is not None else FetchCoordinator(congestion)
+        self.congestion = self.coordinator.congestion
         self.requested = set()
+        # Requested objects not stored yet -> expected type; journaled to resume the session
+        self.pending = {}
+        self.journal_db = journal_db
+        self.journal_key = None
+        # Requested objects not dispatched yet, by type priority and then size
+        self.queue = []
+        self.active = 0
+        # Object sizes announced by a manifest
+        self.sizes = {}
+        # Objects whose whole closure is known to be stored
+        self.complete = set()
+        # Commit/tree -> number of children not complete yet
+        self.waiting = {}
+        # Object -> commits/trees waiting for it
+        self.parents = {}
+        self.closure_db = closure_db
         self.finished_cnt = 0
         self.finish_event = asyncio.Event()
         self.prefix = prefix
         self.storage = storage
+        # Fetched objects larger than this are spooled to a temporary file
+        self.buffer_size = buffer_size
         self.success = True
         self.event_loop = asyncio.get_event_loop()
+        # Objects are written behind in batches; closure markers wait until they are flushed
+        self.closed_objects = []
+        self.session_open = True
+        # Temporary file of the manifest received for the head being fetched, kept for serving to others
+        self.manifest = None
+        self.storage.begin_batch()
 
-    def fetch(self, hash_name: str, expect_type: str = ""):
-        # Ignore in-flight or fetched file
+    def fetch(self, hash_name: str, expect_type: str = "", parent: Optional[bytes] = None):
         hash_value = bytes.fromhex(hash_name)
+        if parent is not None and hash_value not in self.complete:
+            self.waiting[parent] += 1
+            self.parents.setdefault(hash_value, []).append(parent)
+        # Ignore in-flight or fetched file
         if hash_value in self.requested:
             return
         self.requested.add(hash_value)
-        self.event_loop.create_task(self._do_fetch(hash_name, hash_value, expect_type))
+        self.pending[hash_value] = expect_type
+        self.enqueue(hash_name, hash_value, expect_type)
+
+    def enqueue(self, hash_name: str, hash_value: bytes, expect_type: str, attempt: int = 0):
+        priority = (FETCHER_TYPE_PRIORITY.get(expect_type, 1), self.sizes.get(hash_name, 0), len(self.requested))
+        heapq.heappush(self.queue, (priority, hash_name, hash_value, expect_type, attempt))
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Start queued fetches in priority order, keeping about a congestion window active
+        """
+        if not self.success:
+            self.queue = []
+            return
+        while self.queue and self.active < max(self.congestion.limit(), FETCHER_MIN_ACTIVE):
+            _, hash_name, hash_value, expect_type, attempt = heapq.heappop(self.queue)
+            self.active += 1
+            self.event_loop.create_task(self.run_fetch(hash_name, hash_value, expect_type, attempt))
+
+    async def run_fetch(self, hash_name: str, hash_value: bytes, expect_type: str, attempt: int):
+        try:
+            await self.run_guarded(self._do_fetch(hash_name, hash_value, expect_type, attempt))
+        finally:
+            self.active -= 1
+            self.dispatch()
+
+    async def run_guarded(self, coroutine):
+        """
+        Fail the session if coroutine raises, so that its write batch is not left open
+        """
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            self.fail()
+            raise
+        except Exception:
+            logging.exception("Fetching from %s failed", self.prefix)
+            self.fail()
+
+    def fetch_negotiated(self, commit: str, haves: List[str], manifest_prefix: Optional[Name] = None):
+        if self.journal_db is not None:
+            self.journal_key = commit
+            self.event_loop.create_task(self.run_guarded(self.keep_journal()))
+        self.event_loop.create_task(self.run_guarded(self._do_fetch_negotiated(commit, haves, manifest_prefix)))
+
+    async def _do_fetch_negotiated(self, commit: str, haves: List[str], manifest_prefix: Optional[Name]):
+        # Resume an interrupted session from its journaled frontier
+        objects = self.load_journal()
+        # A published manifest spares the negotiation; it is relative to the previous head
+        if objects is None and manifest_prefix is not None:
+            objects = await self.fetch_manifest(manifest_prefix, commit)
+        if objects is None:
+            objects = await self.negotiate(commit, haves)
+        # Many small objects are cheaper to transfer as one bundle
+        if objects is not None and len(objects) >= FETCHER_BUNDLE_THRESHOLD:
+            objects = await self.fetch_bundle(commit, haves, objects)
+        # Request every missing object at once; the traversal only finds them in flight
+        for hash_name, content_type in objects or []:
+            self.fetch(hash_name, content_type)
+        self.fetch(commit, "commit")
+
+    def negotiation_prefix(self, component: str, commit: str, app_params: bytes) -> Name:
+        return (Name(self.prefix).append(component)
+                .append(commit).append(hashlib.sha256(app_params).hexdigest()))
+
+    async def negotiate(self, commit: str, haves: List[str]) -> Optional[List[Tuple[str, str]]]:
+        app_params = encode_haves(haves[:NEGOTIATION_MAX_HAVES])
+        prefix = self.negotiation_prefix(PRODUCER_NEGOTIATE_COMPONENT, commit, app_params)
+        result = await fetch_object(self.face, prefix, self.congestion, app_params, max_attempts=1,
+                                    owner=self)
+        if result is None:
+            logging.info("Negotiation failed: %s", commit)
+            return None
+        with result:
+            return decode_stream(result, OBJECTS_ENTRY_SIZE, decode_objects)
+
+    async def fetch_manifest(self, manifest_prefix: Name, commit: str) -> Optional[List[Tuple[str, str]]]:
+        manifest = await fetch_object(self.face, Name(manifest_prefix).append(commit), self.congestion,
+                                      max_attempts=1, owner=self)
+        if manifest is None:
+            logging.info("Manifest fetching failed: %s", commit)
+            return None
+        entries = decode_stream(manifest, MANIFEST_ENTRY.size, decode_manifest)
+        manifest.seek(0)
+        self.manifest = manifest
+        self.sizes.update((hash_name, size) for hash_name, _, size in entries)
+        return [(hash_name, content_type) for hash_name, content_type, _ in entries]
+
+    async def fetch_bundle(self, commit: str, haves: List[str],
+                           objects: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Fetch the bundle of objects and store them as they arrive; return the objects
+        still missing, which includes the rest of the bundle if fetching it fails
+        """
+        app_params = encode_haves(haves[:NEGOTIATION_MAX_HAVES])
+        prefix = self.negotiation_prefix(PRODUCER_BUNDLE_COMPONENT, commit, app_params)
+        decoder = BundleDecoder()
+        received = set()
+
+        async def write(segment: bytes):
+            for hash_name, obj_data in decoder.feed(segment):
+                if await verify_object_async(obj_data, bytes.fromhex(hash_name)) is None:
+                    continue
+                if not self.storage.exists(hash_name):
+                    self.storage.put(hash_name, obj_data)
+                received.add(hash_name)
+
+        if not await fetch_segments(self.face, prefix, self.congestion, write, app_params, owner=self):
+            logging.info("Bundle fetching failed: %s", commit)
+        return [(hash_name, content_type) for hash_name, content_type in objects
+                if hash_name not in received]
+
+    def load_journal(self) -> Optional[List[Tuple[str, str]]]:
+        if self.journal_key is None or not self.journal_db.exists(self.journal_key):
+            return None
+        # Completed since, by this or another session
+        if self.closure_db is not None and self.closure_db.exists(self.journal_key):
+            self.journal_db.remove(self.journal_key)
+            return None
+        objects = decode_objects(self.journal_db.get(self.journal_key))
+        logging.info("Resuming fetching %s with %d pending objects", self.journal_key, len(objects))
+        return objects
+
+    def save_journal(self):
+        self.journal_db.put(self.journal_key, encode_objects(
+            (hash_value.hex(), expect_type) for hash_value, expect_type in self.pending.items()
+            if expect_type in OBJECT_TYPES))
+
+    async def keep_journal(self):
+        # Also covers a daemon restart in the middle of the session
+        while self.session_open:
+            await asyncio.sleep(FETCHER_JOURNAL_INTERVAL)
+            if self.session_open:
+                self.storage.flush()
+                self.save_closure()
+                self.save_journal()
+
+    def save_closure(self):
+        """
+        Mark the closures completed so far; the objects in them must be flushed first
+        """
+        if self.closure_db is None or not self.closed_objects:
+            return
+        self.closure_db.begin_batch()
+        try:
+            for hash_value in self.closed_objects:
+                self.closure_db.put(hash_value.hex(), b"")
+        finally:
+            self.closure_db.end_batch()
+        self.closed_objects = []
 
     def fail(self):
         self.success = False
+        self.finish()
+
+    def finish(self):
         self.finish_event.set()
+        if not self.session_open:
+            return
+        self.session_open = False
+        try:
+            self.storage.flush()
+            self.save_closure()
+        finally:
+            self.storage.end_batch()
+        if self.journal_key is not None:
+            if self.success:
+                self.journal_db.remove(self.journal_key)
+            else:
+                self.save_journal()
 
-    async def _do_fetch(self, hash_name: str, hash_value: bytes, expect_type: str = ""):
+    async def _do_fetch(self, hash_name: str, hash_value: bytes, expect_type: str = "", attempt: int = 0):
         def fail():
             self.fail()
 
-        # Get the data
-        if self.storage.exists(hash_name):
-            raw_data = self.storage.get(hash_name)
-        else:
-            raw_data = await fetch_object(self.face, Name(self.prefix).append(hash_name), self.semaphore)
-        if not isinstance(raw_data, bytes):
-            fail()
+        # Skip subtrees whose closure is already stored
+        if self.closure_db is not None and self.closure_db.exists(hash_name):
+            self.pending.pop(hash_value, None)
+            self.mark_complete(hash_value)
+            self.finish_one()
             return
-        # Verify data
-        data = zlib.decompress(raw_data)
-        header_size = data.find(b'\x00')
-        header = data[:header_size]
-        content = data[header_size + 1:]
-        content_type, content_len = header.decode("utf-8").split(' ')
-        content_len = int(content_len)
-        if content_len != len(content):
+
+        # Other sessions fetching the same object share its result
+        obj = await self.coordinator.run_once(
+            hash_name, lambda: self.load_object(hash_name, hash_value))
+        if obj is None:
+            # Back off and retry the object instead of aborting the session
+            if attempt + 1 < FETCHER_OBJECT_ATTEMPTS and self.success:
+                delay = min(FETCHER_RETRY_INITIAL_DELAY * 2 ** attempt, FETCHER_RETRY_MAX_DELAY)
+                logging.info("Retrying %s in %.1fs", hash_name, delay)
+                self.event_loop.call_later(delay, self.enqueue, hash_name, hash_value, expect_type, attempt + 1)
+                return
             fail()
             return
+        self.pending.pop(hash_value, None)
+        content_type, content, from_disk = obj
         if expect_type != "" and content_type != expect_type:
             fail()
             return
-        sha1 = hashlib.sha1()
-        sha1.update(data)
-        if sha1.digest() != hash_value:
-            fail()
-            return
-        # Write back if OK (double check existence for parallelism)
-        from_disk = self.storage.exists(hash_name)
-        if not from_disk:
-            self.storage.put(hash_name, raw_data)
         # Traverse data
         if content_type == "commit":
-            if not from_disk:
-                self.traverse_commit(content)
+            # Without closure markers, a stored commit is assumed to have its history
+            if not from_disk or self.closure_db is not None:
+                self.expand(hash_value, self.traverse_commit, content)
+            else:
+                self.mark_complete(hash_value)
         elif content_type == "tree":
-            self.traverse_tree(content)
+            self.expand(hash_value, self.traverse_tree, content)
         else:
             if content_type != "blob":
                 logging.error("Error: Unknown file type %s", content_type)
+            self.mark_complete(hash_value)
+        self.finish_one()
+
+    async def load_object(self, hash_name: str, hash_value: bytes) -> Optional[Tuple[str, bytes, bool]]:
+        """
+        Get the object from storage or the network, verifying it as it streams in,
+        and store it if fetched. Blob content is not returned.
+        """
+        verifier = ObjectVerifier(hash_value)
+        if self.storage.exists(hash_name):
+            with self.storage.get_stream(hash_name) as stream:
+                for chunk in iter(lambda: stream.read(self.buffer_size), b""):
+                    await verifier.update_async(chunk)
+            obj = verifier.finish()
+            return None if obj is None else obj + (True,)
+
+        with tempfile.SpooledTemporaryFile(max_size=self.buffer_size) as spool:
+            async def write(segment: bytes):
+                spool.write(segment)
+                await verifier.update_async(segment)
+
+            if not await fetch_segments(self.face, Name(self.prefix).append(hash_name), self.congestion,
+                                        write, owner=self):
+                return None
+            obj = verifier.finish()
+            if obj is None:
+                return None
+            # Write back if OK (double check existence for parallelism)
+            from_disk = self.storage.exists(hash_name)
+            if not from_disk:
+                spool.seek(0)
+                self.storage.put_stream(hash_name, spool)
+        content_type, content = obj
+        return content_type, content, from_disk
+
+    def finish_one(self):
         # Finish event
         self.finished_cnt += 1
         if self.finished():
-            self.finish_event.set()
-
-    def traverse_commit(self, content: bytes):
-        lines = content.decode("utf-8").split("\n")
-        for ln in lines:
-            if not ln.startswith("tree") and not ln.startswith("parent"):
-                break
-            expect_type, hash_name = ln.split(" ")
-            if expect_type == "parent":
-                expect_type = "commit"
-            self.fetch(hash_name, expect_type)
-
-    def traverse_tree(self, content: bytes):
-        size = len(content)
-        pos = 0
-        while pos < size:
-            name_start = content.find(b'\x00', pos)
-            hash_name = content[name_start + 1:name_start + HASH_LENGTH + 1]
-            if content[pos] == ord('1'):
-                expect_type = "blob"
-            else:
-                expect_type = "tree"
-            self.fetch(hash_name.hex(), expect_type)
-            pos = name_start + HASH_LENGTH + 1
+            self.finish()
+
+    def expand(self, hash_value: bytes, traverse, content: bytes):
+        self.waiting[hash_value] = 0
+        traverse(content, hash_value)
+        if self.waiting[hash_value] == 0:
+            self.mark_complete(hash_value)
+
+    def mark_complete(self, hash_value: bytes):
+        stack = [hash_value]
+        while stack:
+            value = stack.pop()
+            self.complete.add(value)
+            # Only commits and trees have a closure worth recording
+            if self.waiting.pop(value, None) is not None and self.closure_db is not None:
+                self.closed_objects.append(value)
+            for parent in self.parents.pop(value, []):
+                self.waiting[parent] -= 1
+                if self.waiting[parent] == 0:
+                    stack.append(parent)
+
+    def traverse_commit(self, content: bytes, parent: Optional[bytes] = None):
+        for hash_name, expect_type in commit_children(content):
+            self.fetch(hash_name, expect_type, parent)
+
+    def traverse_tree(self, content: bytes, parent: Optional[bytes] = None):
+        for hash_name, expect_type in tree_children(content):
+            self.fetch(hash_name, expect_type, parent)
 
     def finished(self) -> bool:
         return len(self.requested) == self.finished_cnt or not self.success
@@ -180,34 +573,241 @@ class GitFetcher:
         return self.success
 
 
+class PacketCache:
+    """
+    Encoded Data packets ready to be sent, keyed by name, plus a short-lived
+    negative cache of objects known to be absent. Producers share one cache, so
+    objects are named with their producer's prefix.
+    """
+    def __init__(self,
+                 max_size: int = PRODUCER_PACKET_CACHE_SIZE,
+                 max_negative_entries: int = PRODUCER_NEGATIVE_CACHE_ENTRIES,
+                 negative_ttl: float = PRODUCER_NEGATIVE_CACHE_TTL):
+        self.packets = LruCache(max_size)
+        self.negative = LruCache(max_negative_entries)
+        self.negative_ttl = negative_ttl
+
+    def get(self, name: Name) -> Optional[bytes]:
+        return self.packets.get(name.toUri())
+
+    def put(self, name: Name, wire: bytes):
+        self.packets.put(name.toUri(), wire, len(wire))
+
+    def is_missing(self, name: Name) -> bool:
+        key = name.toUri()
+        expire_time = self.negative.get(key)
+        if expire_time is None:
+            return False
+        if expire_time < time.monotonic():
+            self.negative.remove(key)
+            return False
+        return True
+
+    def set_missing(self, name: Name):
+        self.negative.put(name.toUri(), time.monotonic() + self.negative_ttl, 1)
+
+    def stats(self) -> dict:
+        return {
+            "packets": self.packets.stats(),
+            "negative": self.negative.stats(),
+        }
+
+
 class GitProducer:
-    def __init__(self, face: Face, prefix: Union[Name, str], storage: IStorage):
+    def __init__(self, face: Face, prefix: Union[Name, str], storage: IStorage,
+                 packet_cache: Optional[PacketCache] = None,
+                 register: bool = True,
+                 closure_db: Optional[IStorage] = None):
         self.face = face
         self.prefix = prefix
+        self.prefix_len = len(Name(prefix))
         self.storage = storage
-        self.register_id = face.registerPrefix(prefix, self.on_interest, self.on_register_failed)
+        # Negotiation results are kept only for wants whose closure is marked here
+        self.closure_db = closure_db
+        self.segment_cache = LruCache(PRODUCER_SEGMENT_CACHE_SIZE)
+        # Object -> (stream, size) of the large objects being served
+        self.streams = LruCache(PRODUCER_OPEN_STREAMS, lambda entry: entry[0].close())
+        self.missing_cache = LruCache(PRODUCER_MISSING_CACHE_SIZE)
+        # Walks for missing objects in progress, shared by identical requests
+        self.missing_in_flight = {}
+        # Negotiation name -> (temporary file, size, expiry or None) of the result served under it
+        self.negotiation_files = LruCache(PRODUCER_NEGOTIATION_CACHE_SIZE, lambda entry: entry[0].close())
+        self.negotiation_records = LruCache(PRODUCER_NEGOTIATION_RECORD_CACHE_SIZE)
+        self.negotiation_in_flight = {}
+        self.packet_cache = packet_cache if packet_cache is not None else PacketCache()
+        self.register_id = None
+        if register:
+            self.register_id = face.registerPrefix(prefix, self.on_interest, self.on_register_failed)
 
     def on_register_failed(self, prefix):
         logging.error("Prefix registration failed: %s", prefix)
 
     def on_interest(self, _prefix, interest, face, _filter_id, _filter):
-        if len(interest.name) < 4:
+        name = interest.name
+        if len(name) < 4:
             return
-        if interest.name[-1].isSequenceNumber():
-            _ = interest.name[-1].toSequenceNumber()
-            hash_name = interest.name[-2].toEscapedString()
+        logging.info("OnInterest: %s", name.toUri())
+        wire = self.packet_cache.get(name)
+        if wire is not None:
+            face.send(wire)
+            return
+
+        seg_no = name[-1].toSegment() if name[-1].isSegment() else 0
+        component = name[self.prefix_len].toEscapedString()
+        if component in (PRODUCER_NEGOTIATE_COMPONENT, PRODUCER_BUNDLE_COMPONENT):
+            asyncio.get_event_loop().create_task(self.serve_negotiation(interest, face, component, seg_no))
+            return
+        object_name = name[:-1] if name[-1].isSegment() else name
+        if self.packet_cache.is_missing(object_name):
+            return
+        hash_name = object_name[-1].toEscapedString()
+        segment = self.get_segment(hash_name, seg_no)
+        if segment is None:
+            logging.info("Not exist: %s", hash_name)
+            self.packet_cache.set_missing(object_name)
+            return
+        content, final_seg = segment
+        if content is not None:
+            self.send_segment(name, content, seg_no, final_seg, face)
+
+    async def serve_negotiation(self, interest: Interest, face, component: str, seg_no: int):
+        # Name: <prefix>/<negotiate|bundle>/<want>/<haves-digest>[/<params-digest>][/<segment>]
+        name = interest.name
+        if len(name) < self.prefix_len + 3:
+            return
+        key = name[:self.prefix_len + 3].toUri()
+        result = self.negotiation_files.get(key)
+        if result is not None and result[2] is not None and result[2] < time.monotonic():
+            self.negotiation_files.remove(key)
+            result = None
+        if result is None:
+            result = await run_shared(self.negotiation_in_flight, key,
+                                      lambda: self.load_negotiation(key, interest, component))
+        if result is None:
+            return
+        out, size, expiry = result
+        final_seg = max(size - 1, 0) // PRODUCER_SEGMENT_SIZE
+        # Evicted while waiting for it to be written; the requester asks again
+        if seg_no > final_seg or out.closed:
+            return
+        out.seek(seg_no * PRODUCER_SEGMENT_SIZE)
+        # Segments of a result that may change are not cached past it
+        self.send_segment(name, out.read(PRODUCER_SEGMENT_SIZE), seg_no, final_seg, face, cache=expiry is None)
+
+    def send_segment(self, name: Name, content: bytes, seg_no: int, final_seg: int, face, cache: bool = True):
+        data = Data(name)
+        data.content = content
+        data.metaInfo.freshnessPeriod = PRODUCER_FRESHNESS_PERIOD
+        data.metaInfo.setFinalBlockId(Name.Component.fromSegment(final_seg))
+        wire = data.wireEncode().toBytes()
+        if cache:
+            self.packet_cache.put(name, wire)
+        face.send(wire)
+
+    @staticmethod
+    def split_segments(content: bytes) -> tuple:
+        return tuple(content[i:i + PRODUCER_SEGMENT_SIZE]
+                     for i in range(0, max(len(content), 1), PRODUCER_SEGMENT_SIZE))
+
+    def get_segment(self, hash_name: str, seg_no: int) -> Optional[Tuple[Optional[bytes], int]]:
+        """
+        Content of segment seg_no of the object, or None past its end, and its last segment number.
+        None if the object is not stored. Small objects are cached split into segments; larger ones
+        are read a segment at a time.
+        """
+        segments = self.segment_cache.get(hash_name)
+        stream = self.streams.get(hash_name) if segments is None else None
+        if segments is None and stream is None:
+            if not self.storage.exists(hash_name):
+                return None
+            size = self.storage.size(hash_name)
+            if size <= PRODUCER_STREAM_THRESHOLD:
+                segments = self.split_segments(self.storage.get(hash_name))
+                self.segment_cache.put(hash_name, segments, size)
+            else:
+                stream = (self.storage.get_stream(hash_name), size)
+                self.streams.put(hash_name, stream, 1)
+        if segments is not None:
+            return segments[seg_no] if seg_no < len(segments) else None, len(segments) - 1
+        out, size = stream
+        final_seg = max(size - 1, 0) // PRODUCER_SEGMENT_SIZE
+        if seg_no > final_seg:
+            return None, final_seg
+        out.seek(seg_no * PRODUCER_SEGMENT_SIZE)
+        return out.read(PRODUCER_SEGMENT_SIZE), final_seg
+
+    def is_closed(self, hash_name: str) -> bool:
+        return self.closure_db is not None and self.closure_db.exists(hash_name)
+
+    async def load_negotiation(self, key: str, interest: Interest,
+                               component: str) -> Optional[Tuple[BinaryIO, int, Optional[float]]]:
+        name = interest.name
+        want = name[self.prefix_len + 1].toEscapedString()
+        record = self.negotiation_records.get(key)
+        if record is not None:
+            objects = decode_objects(record)
+        elif name[-1].isSegment():
+            # Later segments carry no parameters; they are served only from what was built before
+            return None
+        else:
+            # Without haves the parameters are empty, and PyNDN then leaves them out
+            app_params = interest.applicationParameters.toBytes() or b""
+            # The result is cached under the digest in the name, so it must be the digest of these haves
+            if name[self.prefix_len + 2].toEscapedString() != hashlib.sha256(app_params).hexdigest():
+                logging.warning("Haves digest mismatch: %s", name.toUri())
+                return None
+            objects = await self.get_missing_objects(want, app_params)
+            if objects is None:
+                return None
+        try:
+            out, size, record = await asyncio.get_event_loop().run_in_executor(
+                None, self.write_negotiation, component, objects)
+        except (ValueError, zlib.error) as e:
+            logging.error("Writing %s for %s failed: %s", component, want, e)
+            return None
+        if self.is_closed(want):
+            self.negotiation_records.put(key, record, len(record))
+            expiry = None
         else:
-            hash_name = interest.name[-1].toEscapedString()
+            expiry = time.monotonic() + PRODUCER_NEGOTIATION_TTL
+        self.negotiation_files.put(key, (out, size, expiry), size)
+        return out, size, expiry
 
-        # TODO: Segmentation
-        logging.info("OnInterest: %s", interest.name.toUri())
-        if self.storage.exists(hash_name):
-            data = Data(interest.name)
-            data.content = self.storage.get(hash_name)
-            data.metaInfo.freshnessPeriod = 60000
-            face.putData(data)
+    def write_negotiation(self, component: str, objects: List[Tuple[str, str]]) -> Tuple[BinaryIO, int, bytes]:
+        """
+        Write the result into a temporary file. Also return the objects it holds, from
+        which the same file is written again once it has been evicted.
+        """
+        out = tempfile.SpooledTemporaryFile(max_size=PRODUCER_SPOOL_SIZE)
+        if component == PRODUCER_NEGOTIATE_COMPONENT:
+            record = encode_objects(objects)
+            out.write(record)
         else:
-            logging.info("Not exist: %s", hash_name)
+            record = encode_objects(write_bundle(self.storage, objects, PRODUCER_BUNDLE_MAX_SIZE, out))
+        return out, out.tell(), record
+
+    async def get_missing_objects(self, want: str, app_params: bytes) -> Optional[List[Tuple[str, str]]]:
+        # Negotiation and bundle requests for the same range share one walk
+        missing_key = (want, hashlib.sha256(app_params).digest())
+        objects = self.missing_cache.get(missing_key)
+        if objects is not None:
+            return objects
+        return await run_shared(self.missing_in_flight, missing_key,
+                                lambda: self.load_missing_objects(missing_key, want, app_params))
+
+    async def load_missing_objects(self, missing_key: tuple, want: str,
+                                   app_params: bytes) -> Optional[List[Tuple[str, str]]]:
+        try:
+            objects = await missing_objects_async(self.storage, want, decode_haves(app_params))
+        except (ValueError, zlib.error) as e:
+            logging.error("Listing objects missing for %s failed: %s", want, e)
+            return None
+        if self.is_closed(want):
+            self.missing_cache.put(missing_key, objects, len(objects) * PRODUCER_MISSING_ENTRY_SIZE)
+        return objects
 
     def cancel(self):
-        self.face.removeRegisteredPrefix(self.register_id)
+        if self.register_id is not None:
+            self.face.removeRegisteredPrefix(self.register_id)
+        self.negotiation_files.clear()
+        self.streams.clear()
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import pytest
+from pyndn import Data, Interest, Name
+from ndngitsync import gitfetcher
+from ndngitsync.congestion import CongestionController
+from ndngitsync.gitfetcher import GitFetcher, GitProducer, FetchCoordinator, PacketCache, PRODUCER_SEGMENT_SIZE, \
+    fetch_data_packet, fetch_object, fetch_segments
+from storage import leveldb
+from storage.filesystem import FileStorage
+
+PREFIX = Name("/test/object")
+SEGMENT_SIZE = 100
+
+
+def serve(face, content: bytes, missing=()):
+    """
+    Answer segment Interests under PREFIX with content, except segments in missing
+    """
+    final_seg = max(len(content) - 1, 0) // SEGMENT_SIZE
+
+    def on_interest(_prefix, interest, face, _filter_id, _filter):
+        name = interest.name
+        seg_no = name[-1].toSegment() if name[-1].isSegment() else 0
+        if seg_no in missing:
+            return
+        data = Data(name)
+        data.content = content[seg_no * SEGMENT_SIZE:(seg_no + 1) * SEGMENT_SIZE]
+        data.metaInfo.setFinalBlockId(Name.Component.fromSegment(final_seg))
+        face.putData(data)
+
+    face.setInterestFilter(PREFIX, on_interest)
+
+
+def fast_congestion() -> CongestionController:
+    return CongestionController(initial_rto=0.05, min_rto=0.01, max_rto=0.1)
+
+
+def test_segments_written_in_order_despite_reordering(network):
+    content = os.urandom(SEGMENT_SIZE * 50 + 7)
+    serve(network.face(), content)
+    # Up to 20 ms of jitter on every packet shuffles the segments of the window
+    network.jitter = 0.02
+    written = []
+
+    async def write(segment: bytes):
+        written.append(segment)
+        # A slow writer must not let segments overtake each other either
+        await asyncio.sleep(0.001)
+
+    assert asyncio.run(fetch_segments(network.face(), PREFIX, CongestionController(), write))
+    assert b"".join(written) == content
+    assert [len(segment) for segment in written] == [SEGMENT_SIZE] * 50 + [7]
+
+
+def test_lost_interests_are_retransmitted(network):
+    content = os.urandom(SEGMENT_SIZE * 20)
+    serve(network.face(), content)
+    lost = set()
+
+    def drop(interest) -> bool:
+        # Lose the first Interest for every third segment
+        name = interest.name
+        seg_no = name[-1].toSegment() if name[-1].isSegment() else 0
+        if seg_no % 3 == 0 and seg_no not in lost:
+            lost.add(seg_no)
+            return True
+        return False
+
+    network.drop = drop
+    face = network.face()
+    with asyncio.run(fetch_object(face, PREFIX, fast_congestion())) as result:
+        assert result.read() == content
+    assert face.interest_cnt == 20 + len(lost)
+
+
+def test_missing_segment_fails_the_fetch(network):
+    serve(network.face(), os.urandom(SEGMENT_SIZE * 10), missing={4})
+    assert asyncio.run(fetch_object(network.face(), PREFIX, fast_congestion(), max_attempts=2)) is None
+
+
+def test_single_segment(network):
+    serve(network.face(), b"small")
+    with asyncio.run(fetch_object(network.face(), PREFIX, CongestionController())) as result:
+        assert result.read() == b"small"
+
+
+def test_large_objects_are_served_a_segment_at_a_time(network, objects, tmp_path, monkeypatch):
+    # Stored in LevelDB in chunks that segments straddle
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(leveldb, "CHUNK_SIZE", 10000)
+    monkeypatch.setattr(gitfetcher, "PRODUCER_STREAM_THRESHOLD", 20000)
+    objects.storage = leveldb.DBStorage("gitsync_test", "objects")
+    blob = objects.blob(os.urandom(50000))
+    dst = FileStorage(str(tmp_path / "dst"))
+
+    async def run():
+        producer = GitProducer(network.face(), "/git/repo/objects", objects.storage)
+        fetcher = GitFetcher(network.face(), "/git/repo/objects", dst)
+        fetcher.fetch(blob, "blob")
+        assert await fetcher.wait_until_finish()
+        assert len(producer.segment_cache) == 0
+        assert blob in producer.streams
+        producer.cancel()
+        assert producer.streams.entries == {}
+
+    asyncio.run(run())
+    assert dst.get(blob) == objects.storage.get(blob)
+    objects.storage.drop()
+
+
+def test_sessions_share_one_window_round_robin(network, objects, tmp_path):
+    blobs = {"a": [objects.blob(b"a%d" % i) for i in range(8)], "b": [objects.blob(b"b%d" % i) for i in range(8)]}
+    session_of = {hash_name: session for session, names in blobs.items() for hash_name in names}
+    order = []
+
+    def record(interest) -> bool:
+        order.append(session_of[interest.name[3].toEscapedString()])
+        return False
+
+    network.drop = record
+    coordinator = FetchCoordinator(CongestionController(initial_window=1, max_window=1))
+
+    async def run():
+        GitProducer(network.face(), "/git/repo/objects", objects.storage)
+        fetchers = [GitFetcher(network.face(), "/git/repo/objects", FileStorage(str(tmp_path / session)), coordinator=coordinator)
+                    for session in blobs]
+        for fetcher, names in zip(fetchers, blobs.values()):
+            for hash_name in names:
+                fetcher.fetch(hash_name, "blob")
+        assert fetchers[0].congestion is fetchers[1].congestion
+        return all([await fetcher.wait_until_finish() for fetcher in fetchers])
+
+    assert asyncio.run(run())
+    # a takes the free slot; once both wait for it, they take turns
+    assert order == ["a"] + ["a", "b"] * 7 + ["b"]
+
+
+def test_dispatch_orders_commits_and_trees_before_blobs_by_size(network, objects, tmp_path, monkeypatch):
+    monkeypatch.setattr(gitfetcher, "FETCHER_MIN_ACTIVE", 1)
+    large, small, medium = objects.blob(b"l" * 300), objects.blob(b"s" * 100), objects.blob(b"m" * 200)
+    tree = objects.tree([(b"100644", b"s", small)])
+    commit = objects.commit(tree)
+    order = []
+
+    def record(interest) -> bool:
+        order.append(interest.name[3].toEscapedString())
+        return False
+
+    network.drop = record
+
+    async def run():
+        GitProducer(network.face(), "/git/repo/objects", objects.storage)
+        fetcher = GitFetcher(network.face(), "/git/repo/objects", FileStorage(str(tmp_path / "dst")),
+                             CongestionController(initial_window=1, max_window=1))
+        fetcher.sizes = {large: 300, small: 100, medium: 200}
+        # The first one takes the only slot; the rest queue up behind it
+        for hash_name, expect_type in ((large, "blob"), (medium, "blob"), (small, "blob"),
+                                       (tree, "tree"), (commit, "commit")):
+            fetcher.fetch(hash_name, expect_type)
+        return await fetcher.wait_until_finish()
+
+    assert asyncio.run(run())
+    assert order == [large, commit, tree, small, medium]
+
+
+@pytest.mark.parametrize("streamed", [False, True], ids=["cached", "streamed"])
+def test_producer_splits_objects_into_segments(network, objects, monkeypatch, streamed):
+    if streamed:
+        monkeypatch.setattr(gitfetcher, "PRODUCER_STREAM_THRESHOLD", 0)
+    blob = objects.blob(os.urandom(2 * PRODUCER_SEGMENT_SIZE + 100))
+    raw_data = objects.storage.get(blob)
+    final_seg = (len(raw_data) - 1) // PRODUCER_SEGMENT_SIZE
+    assert final_seg == 2
+
+    async def run():
+        GitProducer(network.face(), "/git/repo/objects", objects.storage)
+        face = network.face()
+        prefix = Name("/git/repo/objects").append(blob)
+        segments = [await fetch_data_packet(face, Interest(prefix))]
+        for seg_no in range(1, final_seg + 2):
+            interest = Interest(Name(prefix).appendSegment(seg_no))
+            interest.interestLifetimeMilliseconds = 50
+            segments.append(await fetch_data_packet(face, interest))
+        return segments
+
+    segments = asyncio.run(run())
+    # Nothing past the last segment
+    assert segments.pop() is None
+    assert [len(data.content) for data in segments] == [PRODUCER_SEGMENT_SIZE] * 2 + [len(raw_data) % PRODUCER_SEGMENT_SIZE]
+    assert b"".join(data.content.toBytes() for data in segments) == raw_data
+    for data in segments:
+        assert data.metaInfo.getFinalBlockId().toSegment() == final_seg
+
+
+def test_packet_cache_hits_misses_and_eviction(monkeypatch):
+    cache = PacketCache(max_size=250, max_negative_entries=2, negative_ttl=10.0)
+    names = [Name("/git/repo/objects").append(str(i)) for i in range(3)]
+    cache.put(names[0], b"0" * 100)
+    cache.put(names[1], b"1" * 100)
+    assert cache.get(names[0]) == b"0" * 100
+    assert cache.get(names[2]) is None
+    # names[1] is the least recently used
+    cache.put(names[2], b"2" * 100)
+    assert cache.get(names[1]) is None
+    assert cache.get(names[0]) is not None and cache.get(names[2]) is not None
+    assert cache.stats()["packets"] == {"entries": 2, "size": 200, "hits": 3, "misses": 2}
+
+    for name in names:
+        cache.set_missing(name)
+    assert not cache.is_missing(names[0])
+    assert cache.is_missing(names[1]) and cache.is_missing(names[2])
+    # Entries expire after negative_ttl
+    now = gitfetcher.time.monotonic()
+    monkeypatch.setattr(gitfetcher.time, "monotonic", lambda: now + 11.0)
+    assert not cache.is_missing(names[1])
+    assert cache.stats()["negative"]["entries"] == 1
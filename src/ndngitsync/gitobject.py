@@ -0,0 +1,249 @@
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import zlib
+import asyncio
+import hashlib
+from .storage import IStorage
+
+
+HASH_LENGTH = 20
+OBJECT_TYPES = ["commit", "tree", "blob", "tag"]
+VERIFY_INLINE_MAX_SIZE = 64 * 1024
+VERIFY_CHUNK_SIZE = 64 * 1024
+VERIFY_MAX_HEADER_SIZE = 64
+VERIFY_WORKERS = os.cpu_count() or 1
+
+_verify_executor = None
+
+
+def decode_object(raw_data: bytes) -> Tuple[str, bytes]:
+    """
+    Decompress a loose object into its type and content
+    """
+    data = zlib.decompress(raw_data)
+    header_size = data.find(b'\x00')
+    content_type, _ = data[:header_size].decode("utf-8").split(' ')
+    return content_type, data[header_size + 1:]
+
+
+def verify_object(raw_data: bytes, hash_value: bytes, expect_type: str = "") -> Optional[Tuple[str, bytes]]:
+    """
+    Check a loose object against its id and expected type, return its type and content
+    """
+    try:
+        data = zlib.decompress(raw_data)
+        header_size = data.find(b'\x00')
+        content_type, content_len = data[:header_size].decode("utf-8").split(' ')
+        content_len = int(content_len)
+    except (zlib.error, UnicodeDecodeError, ValueError):
+        return None
+    content = data[header_size + 1:]
+    if content_len != len(content):
+        return None
+    if expect_type != "" and content_type != expect_type:
+        return None
+    if hashlib.sha1(data).digest() != hash_value:
+        return None
+    return content_type, content
+
+
+def get_verify_executor() -> ThreadPoolExecutor:
+    global _verify_executor
+    if _verify_executor is None:
+        _verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+    return _verify_executor
+
+
+async def verify_object_async(raw_data: bytes, hash_value: bytes,
+                              expect_type: str = "") -> Optional[Tuple[str, bytes]]:
+    """
+    verify_object, run in a worker thread for large objects.
+    zlib and hashlib release the GIL, so workers run in parallel with the event loop.
+    """
+    if len(raw_data) <= VERIFY_INLINE_MAX_SIZE:
+        return verify_object(raw_data, hash_value, expect_type)
+    event_loop = asyncio.get_event_loop()
+    return await event_loop.run_in_executor(get_verify_executor(), verify_object,
+                                            raw_data, hash_value, expect_type)
+
+
+class ObjectVerifier:
+    """
+    verify_object for an object received in pieces. Blob content is hashed and
+    dropped, so memory stays bounded whatever the size of the object.
+    """
+    def __init__(self, hash_value: bytes, expect_type: str = ""):
+        self.hash_value = hash_value
+        self.expect_type = expect_type
+        self.decompressor = zlib.decompressobj()
+        self.sha1 = hashlib.sha1()
+        self.header = b""
+        self.content_type = None
+        self.content_len = 0
+        self.received = 0
+        self.content = []
+        self.failed = False
+        # Pieces given to update_async and not verified yet
+        self.buffered = []
+        self.buffered_size = 0
+
+    def update(self, raw_chunk: bytes):
+        try:
+            while raw_chunk and not self.failed:
+                data = self.decompressor.decompress(raw_chunk, VERIFY_CHUNK_SIZE)
+                raw_chunk = self.decompressor.unconsumed_tail
+                self.feed(data)
+        except zlib.error:
+            self.failed = True
+
+    async def update_async(self, raw_chunk: bytes):
+        """
+        update in a worker thread. Small pieces such as network segments are gathered
+        until VERIFY_INLINE_MAX_SIZE bytes, so the thread hop pays off; finish() takes the rest.
+        """
+        self.buffered.append(raw_chunk)
+        self.buffered_size += len(raw_chunk)
+        if self.buffered_size < VERIFY_INLINE_MAX_SIZE:
+            return
+        raw_data = self.take_buffered()
+        event_loop = asyncio.get_event_loop()
+        await event_loop.run_in_executor(get_verify_executor(), self.update, raw_data)
+
+    def take_buffered(self) -> bytes:
+        raw_data = self.buffered[0] if len(self.buffered) == 1 else b"".join(self.buffered)
+        self.buffered = []
+        self.buffered_size = 0
+        return raw_data
+
+    def feed(self, data: bytes):
+        self.sha1.update(data)
+        if self.content_type is None:
+            self.header += data
+            header_size = self.header.find(b'\x00')
+            if header_size < 0:
+                self.failed = len(self.header) > VERIFY_MAX_HEADER_SIZE
+                return
+            try:
+                content_type, content_len = self.header[:header_size].decode("utf-8").split(' ')
+                self.content_len = int(content_len)
+            except (UnicodeDecodeError, ValueError):
+                self.failed = True
+                return
+            if self.expect_type != "" and content_type != self.expect_type:
+                self.failed = True
+                return
+            self.content_type = content_type
+            data = self.header[header_size + 1:]
+            self.header = b""
+        self.received += len(data)
+        if self.content_type != "blob":
+            self.content.append(data)
+
+    def finish(self) -> Optional[Tuple[str, bytes]]:
+        """
+        Return the type and content (empty for blobs) if the object is valid
+        """
+        if self.buffered:
+            self.update(self.take_buffered())
+        if not self.failed:
+            try:
+                self.feed(self.decompressor.flush())
+            except zlib.error:
+                self.failed = True
+        if (self.failed or self.content_type is None or not self.decompressor.eof
+                or self.received != self.content_len or self.sha1.digest() != self.hash_value):
+            return None
+        return self.content_type, b"".join(self.content)
+
+
+def read_object(storage: IStorage, hash_name: str) -> Optional[Tuple[str, bytes]]:
+    if not storage.exists(hash_name):
+        return None
+    return decode_object(storage.get(hash_name))
+
+
+def commit_children(content: bytes) -> List[Tuple[str, str]]:
+    ret = []
+    lines = content.decode("utf-8").split("\n")
+    for ln in lines:
+        if not ln.startswith("tree") and not ln.startswith("parent"):
+            break
+        expect_type, hash_name = ln.split(" ")
+        if expect_type == "parent":
+            expect_type = "commit"
+        ret.append((hash_name, expect_type))
+    return ret
+
+
+def tree_children(content: bytes) -> List[Tuple[str, str]]:
+    ret = []
+    size = len(content)
+    pos = 0
+    while pos < size:
+        name_start = content.find(b'\x00', pos)
+        hash_name = content[name_start + 1:name_start + HASH_LENGTH + 1]
+        if content[pos] == ord('1'):
+            expect_type = "blob"
+        else:
+            expect_type = "tree"
+        ret.append((hash_name.hex(), expect_type))
+        pos = name_start + HASH_LENGTH + 1
+    return ret
+
+
+def tree_entries(content: bytes) -> List[Tuple[int, bytes, str]]:
+    """
+    Parse a tree into (mode, name, hash_name) entries, in tree order
+    """
+    ret = []
+    size = len(content)
+    pos = 0
+    while pos < size:
+        mode_end = content.find(b' ', pos)
+        name_end = content.find(b'\x00', mode_end)
+        if mode_end < 0 or name_end < 0 or name_end + HASH_LENGTH + 1 > size:
+            raise ValueError("Malformed tree")
+        mode = int(content[pos:mode_end], 8)
+        hash_name = content[name_end + 1:name_end + HASH_LENGTH + 1]
+        ret.append((mode, content[mode_end + 1:name_end], hash_name.hex()))
+        pos = name_end + HASH_LENGTH + 1
+    return ret
+
+
+def closure_objects(storage: IStorage, root: str, is_complete=None) -> Optional[List[str]]:
+    """
+    Return root and every commit and tree it reaches if all the objects they reference are
+    stored, else None. Objects for which is_complete(hash_name) holds are not walked.
+    """
+    ret = []
+    seen = set()
+    stack = [root]
+    while stack:
+        hash_name = stack.pop()
+        if hash_name in seen:
+            continue
+        seen.add(hash_name)
+        if is_complete is not None and is_complete(hash_name):
+            continue
+        obj = read_object(storage, hash_name)
+        if obj is None or obj[0] not in ("commit", "tree"):
+            return None
+        ret.append(hash_name)
+        for child, child_type in object_children(*obj):
+            if child_type != "blob":
+                stack.append(child)
+            elif child not in seen:
+                seen.add(child)
+                if not storage.exists(child):
+                    return None
+    return ret
+
+
+def object_children(content_type: str, content: bytes) -> List[Tuple[str, str]]:
+    if content_type == "commit":
+        return commit_children(content)
+    elif content_type == "tree":
+        return tree_children(content)
+    else:
+        return []
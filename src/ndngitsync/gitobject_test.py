@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import os
+import zlib
+import pytest
+from ndngitsync.gitobject import verify_object, verify_object_async, ObjectVerifier, VERIFY_INLINE_MAX_SIZE
+
+
+def make_object(content_type: str, content: bytes):
+    """
+    Loose form and id of an object
+    """
+    data = content_type.encode() + b" %d\x00" % len(content) + content
+    return zlib.compress(data), hashlib.sha1(data).digest()
+
+
+def corrupt(raw_data: bytes) -> bytes:
+    # Flip a byte in the middle of the deflate stream
+    pos = len(raw_data) // 2
+    return raw_data[:pos] + bytes([raw_data[pos] ^ 0xff]) + raw_data[pos + 1:]
+
+
+def verify_in_pieces(raw_data: bytes, hash_value: bytes, expect_type: str = "", piece_size: int = 1000):
+    async def run():
+        verifier = ObjectVerifier(hash_value, expect_type)
+        for i in range(0, len(raw_data), piece_size):
+            await verifier.update_async(raw_data[i:i + piece_size])
+        return verifier.finish()
+
+    return asyncio.run(run())
+
+
+# Small ones are verified inline, large ones in the worker pool
+SIZES = [100, 4 * VERIFY_INLINE_MAX_SIZE]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_valid_objects_pass(size):
+    content = os.urandom(size)
+    raw_data, hash_value = make_object("blob", content)
+    assert verify_object(raw_data, hash_value) == ("blob", content)
+    assert asyncio.run(verify_object_async(raw_data, hash_value, "blob")) == ("blob", content)
+    # Blob content is not kept when verifying in pieces
+    assert verify_in_pieces(raw_data, hash_value) == ("blob", b"")
+    tree_data, tree_hash = make_object("tree", content)
+    assert verify_in_pieces(tree_data, tree_hash, "tree") == ("tree", content)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_corrupt_objects_fail(size):
+    raw_data, hash_value = make_object("blob", os.urandom(size))
+    other_hash = hashlib.sha1(b"other").digest()
+    cases = [
+        (corrupt(raw_data), hash_value, ""),
+        (raw_data[:-10], hash_value, ""),
+        (raw_data, other_hash, ""),
+        (raw_data, hash_value, "tree"),
+    ]
+    for bad_data, bad_hash, expect_type in cases:
+        assert verify_object(bad_data, bad_hash, expect_type) is None
+        assert asyncio.run(verify_object_async(bad_data, bad_hash, expect_type)) is None
+        assert verify_in_pieces(bad_data, bad_hash, expect_type) is None
+
+
+@pytest.mark.parametrize("data", [
+    b"blob 5\x00abc",
+    b"blob 2\x00abc",
+    b"blob x\x00abc",
+    b"blob" + b"1" * 100,
+], ids=["short", "long", "bad-length", "no-header-end"])
+def test_bad_headers_fail(data):
+    raw_data = zlib.compress(data)
+    hash_value = hashlib.sha1(data).digest()
+    assert verify_object(raw_data, hash_value) is None
+    assert verify_in_pieces(raw_data, hash_value, piece_size=3) is None
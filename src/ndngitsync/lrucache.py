@@ -0,0 +1 @@
+from storage.lrucache import LruCache
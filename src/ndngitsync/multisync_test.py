@@ -0,0 +1,148 @@
+import asyncio
+import pytest
+from pyndn import Name
+from ndngitsync import sync as sync_module
+from ndngitsync.sync import Sync, SyncSchedule, MultiSync
+
+GROUP_PREFIX = Name("/git/~sync")
+
+
+@pytest.fixture
+def fast(monkeypatch):
+    """
+    Sync intervals a hundred times shorter
+    """
+    monkeypatch.setattr(sync_module, "SYNC_INTERVAL_MIN", 0.01)
+    monkeypatch.setattr(sync_module, "SYNC_INTERVAL_MAX", 0.02)
+    monkeypatch.setattr(sync_module, "SYNC_INTERVAL_BACKOFF_MAX", 0.32)
+
+
+async def run_schedule(schedule: SyncSchedule, duration: float, during=None) -> list:
+    """
+    Run schedule for duration seconds and return when it sent, awaiting during meanwhile
+    """
+    event_loop = asyncio.get_event_loop()
+    sent = []
+    running = True
+    start = event_loop.time()
+    task = asyncio.ensure_future(schedule.run(lambda: sent.append(event_loop.time() - start), lambda: running))
+    if during is not None:
+        await during()
+    await asyncio.sleep(duration - (event_loop.time() - start))
+    running = False
+    schedule.event.set()
+    await task
+    return sent
+
+
+def test_schedule_backs_off_while_quiet(fast):
+    sent = asyncio.run(run_schedule(SyncSchedule(), 1.0))
+    # Sent at once, then after intervals of 0.01-0.02, 0.02-0.04, ... 0.32-0.64 seconds
+    assert sent[0] < 0.01
+    gaps = [later - earlier for earlier, later in zip(sent, sent[1:])]
+    assert gaps == sorted(gaps)
+    assert 5 <= len(gaps) <= 7
+    assert gaps[-1] <= 0.64 + 0.02
+
+
+def test_schedule_skips_suppressed_timers(fast):
+    async def suppress_often():
+        for _ in range(100):
+            schedule.suppress()
+            await asyncio.sleep(0.005)
+
+    schedule = SyncSchedule()
+    sent = asyncio.run(run_schedule(schedule, 0.5, suppress_often))
+    assert len(sent) == 1
+    # Suppressed timers still back off
+    assert schedule.interval > 0.1
+
+
+def test_schedule_trigger_sends_at_once_and_reset_does_not(fast):
+    async def poke():
+        await asyncio.sleep(0.5)
+        assert schedule.interval >= 0.16
+        schedule.reset()
+        await asyncio.sleep(0)
+        assert schedule.interval == 0.01
+        schedule.trigger()
+        await asyncio.sleep(0)
+
+    schedule = SyncSchedule()
+    sent = asyncio.run(run_schedule(schedule, 0.51, poke))
+    # The first send, the timers before 0.5 s, and the trigger
+    assert sent[-1] == pytest.approx(0.5, abs=0.005)
+    assert sent[-2] < 0.5 - 0.01
+
+
+class Peer:
+    def __init__(self, network, repos: dict):
+        self.face = network.face()
+        self.group = MultiSync(GROUP_PREFIX, self.face)
+        self.updates = []
+        for name, state in repos.items():
+            sync = Sync(Name("/git").append(name).append("sync"), self.face,
+                        lambda branch, timestamp, name=name: self.updates.append((name, branch, timestamp)))
+            sync.state = dict(state)
+            self.group.add(name, sync)
+        self.group.run()
+
+    def state(self, name: str) -> dict:
+        return self.group.syncs[name].state
+
+
+def run_peers(network, repo_sets, duration: float):
+    """
+    Run a peer for each dict of repos for duration seconds. Return the peers and the
+    number of sync group Interests of each kind.
+    """
+    counts = {}
+
+    def count(interest) -> bool:
+        name = interest.name
+        if GROUP_PREFIX.isPrefixOf(name):
+            kind = name[len(GROUP_PREFIX)].toEscapedString()
+            counts[kind] = counts.get(kind, 0) + 1
+        return False
+
+    network.drop = count
+
+    async def run():
+        peers = [Peer(network, repos) for repos in repo_sets]
+        await asyncio.sleep(duration)
+        for peer in peers:
+            peer.group.stop()
+        await asyncio.sleep(0)
+        return peers
+
+    return asyncio.run(run()), counts
+
+
+def test_identical_repos_exchange_only_digests(network, fast):
+    repos = {"a": {"master": 1}, "b": {"master": 2}}
+    _, counts = run_peers(network, [repos, repos], 1.0)
+    assert set(counts) == {"digest"}
+    # Both back off: at most about 8 timers each in a second
+    assert counts["digest"] <= 2 * 9
+
+
+def test_different_repo_sets_stop_comparing_vectors(network, fast):
+    common = {"master": 1}
+    peers, counts = run_peers(network, [{"a": common, "b": {"master": 2}}, {"a": common, "c": {"dev": 3}}], 1.0)
+    # One vector each way, then the digests are known to be consistent and back off
+    assert counts.get("vector", 0) + counts.get("vector-reply", 0) <= 4
+    assert counts["digest"] <= 2 * 9
+    first, second = peers
+    assert second.group.root_digest() in first.group.consistent_digests
+    assert first.group.root_digest() in second.group.consistent_digests
+    assert first.updates == second.updates == []
+
+
+def test_repos_both_track_converge(network, fast):
+    peers, _ = run_peers(network, [{"a": {"master": 5}, "b": {"master": 2}},
+                                   {"a": {"master": 3, "dev": 1}, "c": {"dev": 3}}], 1.0)
+    first, second = peers
+    assert first.state("a") == second.state("a") == {"master": 5, "dev": 1}
+    assert first.updates == [("a", "dev", 1)]
+    assert second.updates == [("a", "master", 5)]
+    assert second.group.root_digest() in first.group.consistent_digests
@@ -0,0 +1,244 @@
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+import asyncio
+import heapq
+import struct
+import stat
+from .storage import IStorage
+from .gitobject import HASH_LENGTH, OBJECT_TYPES, read_object, commit_children, tree_entries
+
+
+NEGOTIATION_MAX_HAVES = 256
+BUNDLE_ENTRY_HEADER = struct.Struct("!%dsI" % HASH_LENGTH)
+OBJECTS_ENTRY_SIZE = HASH_LENGTH + 1
+MANIFEST_ENTRY = struct.Struct("!%dsBI" % HASH_LENGTH)
+MANIFEST_MAX_OBJECT_SIZE = 2 ** 32 - 1
+TREE_MODE_GITLINK = 0o160000
+
+
+def encode_haves(haves: Iterable[str]) -> bytes:
+    return b"".join(bytes.fromhex(hash_name) for hash_name in haves)
+
+
+def decode_haves(raw: bytes) -> List[str]:
+    return [raw[pos:pos + HASH_LENGTH].hex()
+            for pos in range(0, len(raw) - HASH_LENGTH + 1, HASH_LENGTH)]
+
+
+def encode_objects(objects: Iterable[Tuple[str, str]]) -> bytes:
+    """
+    Each entry is a binary object id followed by one byte of object type
+    """
+    return b"".join(bytes.fromhex(hash_name) + bytes([OBJECT_TYPES.index(content_type)])
+                    for hash_name, content_type in objects)
+
+
+def decode_objects(raw: bytes) -> List[Tuple[str, str]]:
+    return [(raw[pos:pos + HASH_LENGTH].hex(), OBJECT_TYPES[raw[pos + HASH_LENGTH]])
+            for pos in range(0, len(raw) - OBJECTS_ENTRY_SIZE + 1, OBJECTS_ENTRY_SIZE)
+            if raw[pos + HASH_LENGTH] < len(OBJECT_TYPES)]
+
+
+def encode_manifest(entries: Iterable[Tuple[str, str, int]]) -> bytes:
+    """
+    Each entry is a binary object id, one byte of object type and the stored size
+    """
+    return b"".join(MANIFEST_ENTRY.pack(bytes.fromhex(hash_name), OBJECT_TYPES.index(content_type),
+                                        min(size, MANIFEST_MAX_OBJECT_SIZE))
+                    for hash_name, content_type, size in entries)
+
+
+def decode_manifest(raw: bytes) -> List[Tuple[str, str, int]]:
+    return [(hash_value.hex(), OBJECT_TYPES[type_index], size)
+            for hash_value, type_index, size in MANIFEST_ENTRY.iter_unpack(
+                raw[:len(raw) - len(raw) % MANIFEST_ENTRY.size])
+            if type_index < len(OBJECT_TYPES)]
+
+
+def parse_commit(storage: IStorage, commit: str) -> Optional[Tuple[str, List[str], int]]:
+    """
+    Tree, parents and committer time of a stored commit
+    """
+    obj = read_object(storage, commit)
+    if obj is None or obj[0] != "commit":
+        return None
+    tree = None
+    parents = []
+    for hash_name, content_type in commit_children(obj[1]):
+        if content_type == "tree":
+            tree = hash_name
+        else:
+            parents.append(hash_name)
+    commit_time = 0
+    for line in obj[1].split(b"\n"):
+        if not line:
+            break
+        if line.startswith(b"committer "):
+            fields = line.rsplit(b" ", 2)
+            if len(fields) == 3 and fields[1].isdigit():
+                commit_time = int(fields[1])
+    return None if tree is None else (tree, parents, commit_time)
+
+
+def missing_objects(storage: IStorage, want: str, haves: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    List objects reachable from commit want but not from any of the haves,
+    commits and trees first. Best effort: the requester still traverses.
+    History is walked newest first from both sides, as git does, and only until every
+    commit left to visit is reachable from a have; so the have side is walked no further
+    back than the new commits go. Each new tree is compared path by path with the trees
+    of its commit's parents, so subtrees they share are skipped without being read.
+    """
+    # New commits, parents after children
+    commits = []
+    parsed_commits = {}
+    uninteresting = set()
+    seen = set()
+    queue = []
+
+    def push(commit: str):
+        if commit in seen:
+            return
+        seen.add(commit)
+        parsed = parse_commit(storage, commit)
+        parsed_commits[commit] = parsed
+        heapq.heappush(queue, (-parsed[2] if parsed is not None else 0, commit))
+        if commit not in uninteresting:
+            interesting.add(commit)
+
+    interesting = set()
+    for have in haves:
+        uninteresting.add(have)
+        push(have)
+    push(want)
+    while interesting:
+        _, commit = heapq.heappop(queue)
+        parsed = parsed_commits[commit]
+        interesting.discard(commit)
+        if commit in uninteresting:
+            for parent in parsed[1] if parsed is not None else []:
+                uninteresting.add(parent)
+                interesting.discard(parent)
+        else:
+            commits.append(commit)
+        for parent in parsed[1] if parsed is not None else []:
+            push(parent)
+
+    # With clock skew, a commit may be listed before a have is found to reach it
+    commits = [commit for commit in commits if commit not in uninteresting]
+
+    def base_tree(commit: str) -> Optional[str]:
+        if commit not in parsed_commits:
+            parsed_commits[commit] = parse_commit(storage, commit)
+        parsed = parsed_commits[commit]
+        return None if parsed is None else parsed[0]
+
+    trees = []
+    blobs = []
+    listed = set()
+    for commit in commits:
+        if parsed_commits[commit] is None:
+            continue
+        tree, parents, _ = parsed_commits[commit]
+        bases = [base for base in map(base_tree, parents) if base is not None]
+        stack = [(tree, bases)]
+        while stack:
+            tree, bases = stack.pop()
+            if tree in listed or tree in bases:
+                continue
+            listed.add(tree)
+            trees.append((tree, "tree"))
+            obj = read_object(storage, tree)
+            if obj is None or obj[0] != "tree":
+                continue
+            base_entries = {}
+            for base in bases:
+                base_obj = read_object(storage, base)
+                if base_obj is None or base_obj[0] != "tree":
+                    continue
+                for _, name, hash_name in tree_entries(base_obj[1]):
+                    base_entries.setdefault(name, []).append(hash_name)
+            for mode, name, hash_name in tree_entries(obj[1]):
+                child_bases = base_entries.get(name, [])
+                if hash_name in listed or hash_name in child_bases or mode == TREE_MODE_GITLINK:
+                    continue
+                if stat.S_ISDIR(mode):
+                    stack.append((hash_name, child_bases))
+                else:
+                    listed.add(hash_name)
+                    blobs.append((hash_name, "blob"))
+    return [(commit, "commit") for commit in commits] + trees + blobs
+
+
+async def missing_objects_async(storage: IStorage, want: str, haves: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    missing_objects, run in a worker thread so a negotiation does not stall the daemon
+    """
+    event_loop = asyncio.get_event_loop()
+    return await event_loop.run_in_executor(None, missing_objects, storage, want, list(haves))
+
+
+def build_manifest(storage: IStorage, want: str, haves: Iterable[str]) -> bytes:
+    """
+    Manifest of the objects a holder of haves needs to complete commit want.
+    Walks like missing_objects, so run it in a worker thread from the event loop.
+    """
+    entries = []
+    for hash_name, content_type in missing_objects(storage, want, haves):
+        if storage.exists(hash_name):
+            entries.append((hash_name, content_type, storage.size(hash_name)))
+    return encode_manifest(entries)
+
+
+def write_bundle(storage: IStorage, objects: Iterable[Tuple[str, str]], max_size: int,
+                 out: BinaryIO) -> List[Tuple[str, str]]:
+    """
+    Write loose objects to out, each prefixed with its binary id and length, and
+    return the objects written. Objects that do not fit into max_size are left out.
+    Given the returned list, the bundle can be written again byte for byte.
+    """
+    written = []
+    size = 0
+    for hash_name, content_type in objects:
+        if not storage.exists(hash_name):
+            continue
+        raw_data = storage.get(hash_name)
+        entry_size = BUNDLE_ENTRY_HEADER.size + len(raw_data)
+        if size + entry_size > max_size:
+            continue
+        out.write(BUNDLE_ENTRY_HEADER.pack(bytes.fromhex(hash_name), len(raw_data)))
+        out.write(raw_data)
+        written.append((hash_name, content_type))
+        size += entry_size
+    return written
+
+
+def decode_bundle(raw: bytes) -> Iterator[Tuple[str, bytes]]:
+    view = memoryview(raw)
+    pos = 0
+    while pos + BUNDLE_ENTRY_HEADER.size <= len(view):
+        hash_value, length = BUNDLE_ENTRY_HEADER.unpack_from(view, pos)
+        pos += BUNDLE_ENTRY_HEADER.size
+        yield hash_value.hex(), bytes(view[pos:pos + length])
+        pos += length
+
+
+class BundleDecoder:
+    """
+    decode_bundle for a bundle received in pieces; only one object is held at a time
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[Tuple[str, bytes]]:
+        self.buffer += chunk
+        ret = []
+        pos = 0
+        while pos + BUNDLE_ENTRY_HEADER.size <= len(self.buffer):
+            hash_value, length = BUNDLE_ENTRY_HEADER.unpack_from(self.buffer, pos)
+            end = pos + BUNDLE_ENTRY_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            ret.append((hash_value.hex(), bytes(self.buffer[pos + BUNDLE_ENTRY_HEADER.size:end])))
+            pos = end
+        del self.buffer[:pos]
+        return ret
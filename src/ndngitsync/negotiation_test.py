@@ -0,0 +1,370 @@
+import asyncio
+import hashlib
+import io
+import os
+import pytest
+from typing import Optional
+from pyndn import Data, Interest, Name
+from ndngitsync import gitfetcher
+from ndngitsync.congestion import CongestionController
+from ndngitsync.gitfetcher import GitFetcher, GitProducer, FETCHER_BUNDLE_THRESHOLD, PRODUCER_SEGMENT_SIZE
+from ndngitsync.lrucache import LruCache
+from ndngitsync.negotiation import missing_objects, encode_haves, decode_haves, encode_objects, decode_objects, \
+    write_bundle, decode_bundle, BundleDecoder, BUNDLE_ENTRY_HEADER
+from storage.filesystem import FileStorage
+
+PREFIX = Name("/git/repo/objects")
+
+
+def make_history(objects):
+    """
+    c1 and c2 on top of it: c2 changes a, adds e and keeps subtree d
+    """
+    blob_a = objects.blob(b"a")
+    blob_x = objects.blob(b"x")
+    tree_d = objects.tree([(b"100644", b"x", blob_x)])
+    tree_1 = objects.tree([(b"100644", b"a", blob_a), (b"40000", b"d", tree_d)])
+    c1 = objects.commit(tree_1)
+    blob_a2 = objects.blob(b"a2")
+    blob_e = objects.blob(b"e")
+    tree_2 = objects.tree([(b"100644", b"a", blob_a2), (b"40000", b"d", tree_d), (b"100644", b"e", blob_e)])
+    c2 = objects.commit(tree_2, [c1])
+    return {"blob_a": blob_a, "blob_x": blob_x, "tree_d": tree_d, "tree_1": tree_1, "c1": c1,
+            "blob_a2": blob_a2, "blob_e": blob_e, "tree_2": tree_2, "c2": c2}
+
+
+def test_missing_objects_stops_at_haves(objects):
+    h = make_history(objects)
+    missing = missing_objects(objects.storage, h["c2"], [h["c1"]])
+    assert missing == [(h["c2"], "commit"), (h["tree_2"], "tree"), (h["blob_a2"], "blob"), (h["blob_e"], "blob")]
+
+
+def test_missing_objects_without_haves(objects):
+    h = make_history(objects)
+    missing = missing_objects(objects.storage, h["c2"], [])
+    types = [content_type for _, content_type in missing]
+    # Commits first, then trees, then blobs, each object once
+    assert types == sorted(types, key=["commit", "tree", "blob"].index)
+    assert len(missing) == len(set(missing)) == 9
+    assert {hash_name for hash_name, _ in missing} == set(h.values())
+
+
+def test_missing_objects_of_merge_skips_trees_of_either_parent(objects):
+    h = make_history(objects)
+    blob_m = objects.blob(b"m")
+    side_tree = objects.tree([(b"100644", b"a", h["blob_a"]), (b"100644", b"m", blob_m)])
+    side = objects.commit(side_tree, [h["c1"]])
+    merge_tree = objects.tree([(b"100644", b"a", h["blob_a2"]), (b"40000", b"d", h["tree_d"]),
+                               (b"100644", b"e", h["blob_e"]), (b"100644", b"m", blob_m)])
+    merge = objects.commit(merge_tree, [h["c2"], side])
+    missing = missing_objects(objects.storage, merge, [h["c2"]])
+    assert missing[:2] == [(merge, "commit"), (side, "commit")]
+    # blob_m comes with side; merge_tree reuses everything else from its parents
+    assert {hash_name for hash_name, _ in missing[2:]} == {merge_tree, side_tree, blob_m}
+
+
+def test_missing_objects_skips_submodules(objects):
+    gitlink = "ab" * 20
+    tree = objects.tree([(b"160000", b"sub", gitlink)])
+    commit = objects.commit(tree)
+    assert missing_objects(objects.storage, commit, []) == [(commit, "commit"), (tree, "tree")]
+
+
+def test_haves_and_objects_round_trip():
+    haves = ["01" * 20, "fe" * 20]
+    assert decode_haves(encode_haves(haves)) == haves
+    entries = [("01" * 20, "commit"), ("02" * 20, "tree"), ("03" * 20, "blob"), ("04" * 20, "tag")]
+    assert decode_objects(encode_objects(entries)) == entries
+
+
+def test_decode_objects_drops_unknown_types_and_partial_entries():
+    raw = encode_objects([("01" * 20, "blob")]) + bytes(20) + b"\x09" + b"\x05" * 7
+    assert decode_objects(raw) == [("01" * 20, "blob")]
+
+
+def test_negotiation_over_the_network(network, objects, tmp_path):
+    h = make_history(objects)
+
+    async def run():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        fetcher = GitFetcher(network.face(), PREFIX, FileStorage(str(tmp_path / "dst")))
+        ret = await fetcher.negotiate(h["c2"], [h["c1"]])
+        fetcher.finish()
+        return ret
+
+    assert asyncio.run(run()) == missing_objects(objects.storage, h["c2"], [h["c1"]])
+
+
+def test_fetch_transfers_only_missing_objects(network, objects, tmp_path):
+    h = make_history(objects)
+    dst = FileStorage(str(tmp_path / "dst"))
+    for key in ("c1", "tree_1", "tree_d", "blob_a", "blob_x"):
+        dst.put(h[key], objects.storage.get(h[key]))
+    face = network.face()
+
+    async def run():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        fetcher = GitFetcher(face, PREFIX, dst)
+        fetcher.fetch_negotiated(h["c2"], [h["c1"]])
+        return await fetcher.wait_until_finish()
+
+    assert asyncio.run(run())
+    for key in ("c2", "tree_2", "blob_a2", "blob_e"):
+        assert dst.exists(h[key])
+    # One negotiation Interest, then one per new object
+    assert face.interest_cnt == 1 + 4
+
+
+def make_wide_commit(objects, blob_cnt: int, blob_size: int) -> str:
+    """
+    A commit whose tree holds blob_cnt random blobs of blob_size bytes
+    """
+    blobs = [objects.blob(os.urandom(blob_size)) for _ in range(blob_cnt)]
+    tree = objects.tree([(b"100644", b"f%04d" % i, blob) for i, blob in enumerate(blobs)])
+    return objects.commit(tree)
+
+
+def test_bundle_round_trip(objects):
+    h = make_history(objects)
+    entries = missing_objects(objects.storage, h["c2"], [])
+    out = io.BytesIO()
+    assert write_bundle(objects.storage, entries, 2 ** 20, out) == entries
+    raw = out.getvalue()
+    expected = [(hash_name, objects.storage.get(hash_name)) for hash_name, _ in entries]
+    assert list(decode_bundle(raw)) == expected
+    # Fed in pieces that split headers and objects, the decoder yields the same
+    decoder = BundleDecoder()
+    decoded = []
+    for i in range(0, len(raw), 7):
+        decoded += decoder.feed(raw[i:i + 7])
+    assert decoded == expected
+    assert decoder.buffer == b""
+
+
+def test_bundle_leaves_out_what_does_not_fit(objects):
+    h = make_history(objects)
+    entries = [(h["blob_a"], "blob"), (h["c2"], "commit"), ("ab" * 20, "blob"), (h["blob_x"], "blob")]
+    small = BUNDLE_ENTRY_HEADER.size + len(objects.storage.get(h["blob_a"]))
+    out = io.BytesIO()
+    # The commit is too large for what is left and the third object is not stored
+    written = write_bundle(objects.storage, entries, 2 * small, out)
+    assert written == [(h["blob_a"], "blob"), (h["blob_x"], "blob")]
+    # Written again from the returned list, the bundle is the same
+    again = io.BytesIO()
+    assert write_bundle(objects.storage, written, 2 * small, again) == written
+    assert again.getvalue() == out.getvalue()
+
+
+def fetch_bundled(network, objects, dst, commit: str, producer_setup=None) -> list:
+    """
+    Fetch commit into dst and return the names of the Interests sent
+    """
+    interest_names = []
+
+    def record(interest) -> bool:
+        interest_names.append(Name(interest.name))
+        return False
+
+    network.drop = record
+
+    async def run():
+        producer = GitProducer(network.face(), PREFIX, objects.storage)
+        if producer_setup is not None:
+            producer_setup(producer)
+        fetcher = GitFetcher(network.face(), PREFIX, dst)
+        fetcher.fetch_negotiated(commit, [])
+        return await fetcher.wait_until_finish()
+
+    assert asyncio.run(run())
+    return interest_names
+
+
+def test_bundle_over_16mb_over_the_network(network, objects, tmp_path):
+    # Over the 16 MB a MongoDB document holds, in thousands of segments
+    blob_cnt = FETCHER_BUNDLE_THRESHOLD + 4
+    commit = make_wide_commit(objects, blob_cnt, 17 * 2 ** 20 // blob_cnt)
+    dst = FileStorage(str(tmp_path / "dst"))
+    interest_names = fetch_bundled(network, objects, dst, commit)
+    entries = missing_objects(objects.storage, commit, [])
+    for hash_name, _ in entries:
+        assert dst.get(hash_name) == objects.storage.get(hash_name)
+    bundle_size = sum(BUNDLE_ENTRY_HEADER.size + len(objects.storage.get(hash_name)) for hash_name, _ in entries)
+    assert bundle_size > 16 * 2 ** 20
+    # Everything came in the bundle; the commit is then found in storage
+    components = {name[len(PREFIX)].toEscapedString() for name in interest_names}
+    assert components == {"negotiate", "bundle"}
+    bundle_segments = {name[-1].toSegment() for name in interest_names
+                       if name[len(PREFIX)].toEscapedString() == "bundle" and name[-1].isSegment()}
+    assert bundle_segments == set(range(1, -(-bundle_size // PRODUCER_SEGMENT_SIZE)))
+
+
+def test_evicted_bundle_is_written_again(network, objects, tmp_path):
+    commit = make_wide_commit(objects, FETCHER_BUNDLE_THRESHOLD, 1000)
+    dst = FileStorage(str(tmp_path / "dst"))
+    closure_db = FileStorage(str(tmp_path / "closure"))
+    closure_db.put(commit, b"")
+
+    def evict_everything(producer):
+        producer.negotiation_files = LruCache(1)
+        producer.closure_db = closure_db
+
+    interest_names = fetch_bundled(network, objects, dst, commit, evict_everything)
+    for hash_name, _ in missing_objects(objects.storage, commit, []):
+        assert dst.get(hash_name) == objects.storage.get(hash_name)
+    assert {name[len(PREFIX)].toEscapedString() for name in interest_names} == {"negotiate", "bundle"}
+
+
+class RecordingFace:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, wire):
+        data = Data()
+        data.wireDecode(bytes(wire))
+        self.sent.append(data)
+
+
+async def ask_producer(producer: GitProducer, want: str, haves, haves_digest: str = None) -> Optional[Data]:
+    """
+    Send the producer the first negotiation Interest, naming haves_digest if given
+    """
+    app_params = encode_haves(haves)
+    if haves_digest is None:
+        haves_digest = hashlib.sha256(app_params).hexdigest()
+    interest = Interest(Name(PREFIX).append("negotiate").append(want).append(haves_digest))
+    interest.applicationParameters = app_params
+    face = RecordingFace()
+    producer.on_interest(None, interest, face, None, None)
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if face.sent:
+            return face.sent[0]
+    return None
+
+
+def test_negotiation_checks_haves_digest(objects):
+    h = make_history(objects)
+    haves_digest = hashlib.sha256(encode_haves([h["c1"]])).hexdigest()
+
+    async def run():
+        producer = GitProducer(None, PREFIX, objects.storage, register=False)
+        # Named after the haves [c1], but sending none
+        forged = await ask_producer(producer, h["c2"], [], haves_digest)
+        return forged, await ask_producer(producer, h["c2"], [h["c1"]])
+
+    forged, data = asyncio.run(run())
+    assert forged is None
+    assert decode_objects(data.content.toBytes()) == missing_objects(objects.storage, h["c2"], [h["c1"]])
+
+
+def test_negotiation_results_are_kept_only_for_closed_wants(objects, tmp_path, monkeypatch):
+    h = make_history(objects)
+    closure_db = FileStorage(str(tmp_path / "closure"))
+    monkeypatch.setattr(gitfetcher, "PRODUCER_NEGOTIATION_TTL", -1.0)
+
+    async def run():
+        producer = GitProducer(None, PREFIX, objects.storage, register=False, closure_db=closure_db)
+        assert await ask_producer(producer, h["c2"], [h["c1"]]) is not None
+        (out, _, expiry), _ = next(iter(producer.negotiation_files.entries.values()))
+        assert expiry is not None
+        assert len(producer.negotiation_records) == len(producer.missing_cache) == 0
+        assert len(producer.packet_cache.packets) == 0
+        # Expired, the result is built again and the old file closed
+        assert await ask_producer(producer, h["c2"], [h["c1"]]) is not None
+        assert out.closed
+
+        closure_db.put(h["c2"], b"")
+        assert await ask_producer(producer, h["c2"], [h["c1"]]) is not None
+        (out, _, expiry), _ = next(iter(producer.negotiation_files.entries.values()))
+        assert expiry is None
+        assert len(producer.negotiation_records) == len(producer.missing_cache) == 1
+        assert len(producer.packet_cache.packets) == 1
+        producer.cancel()
+        assert out.closed
+
+    asyncio.run(run())
+
+
+def test_interrupted_fetch_resumes_from_journal(network, objects, tmp_path, monkeypatch):
+    h = make_history(objects)
+    dst = FileStorage(str(tmp_path / "dst"))
+    journal_db = FileStorage(str(tmp_path / "journal"))
+    closure_db = FileStorage(str(tmp_path / "closure"))
+    monkeypatch.setattr(gitfetcher, "FETCHER_JOURNAL_INTERVAL", 0.01)
+    monkeypatch.setattr(gitfetcher, "FETCHER_OBJECT_ATTEMPTS", 2)
+    monkeypatch.setattr(gitfetcher, "FETCHER_RETRY_INITIAL_DELAY", 0.5)
+    # blob_e cannot be fetched in the first session
+    network.drop = lambda interest: Name(PREFIX).append(h["blob_e"]).isPrefixOf(interest.name)
+
+    def fetcher(face) -> GitFetcher:
+        congestion = CongestionController(initial_rto=0.05, min_rto=0.01, max_rto=0.1)
+        return GitFetcher(face, PREFIX, dst, congestion, closure_db=closure_db, journal_db=journal_db)
+
+    async def interrupted():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        session = fetcher(network.face())
+        session.fetch_negotiated(h["c2"], [])
+        await asyncio.sleep(0.3)
+        # Progress is saved while blob_e is waiting to be retried
+        assert all(closure_db.exists(h[key]) for key in ("tree_d", "tree_1", "c1"))
+        assert decode_objects(journal_db.get(h["c2"])) == [(h["blob_e"], "blob")]
+        return await session.wait_until_finish()
+
+    assert not asyncio.run(interrupted())
+    assert not closure_db.exists(h["c2"])
+    assert journal_db.exists(h["c2"])
+
+    network.drop = None
+    face = network.face()
+
+    async def resumed():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        session = fetcher(face)
+        session.fetch_negotiated(h["c2"], [])
+        return await session.wait_until_finish()
+
+    assert asyncio.run(resumed())
+    # No negotiation, only the object still missing
+    assert face.interest_cnt == 1
+    assert closure_db.exists(h["c2"])
+    assert not journal_db.exists(h["c2"])
+
+    # A journal left behind by a session completed elsewhere is dropped
+    journal_db.put(h["c1"], encode_objects([(h["blob_x"], "blob")]))
+    face = network.face()
+
+    async def completed():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        session = fetcher(face)
+        session.fetch_negotiated(h["c1"], [])
+        return await session.wait_until_finish()
+
+    assert asyncio.run(completed())
+    assert not journal_db.exists(h["c1"])
+    # Negotiated afresh, everything is found stored
+    assert face.interest_cnt == 1
+
+
+@pytest.mark.parametrize("marked", [True, False], ids=["marked", "unmarked"])
+def test_fetch_skips_only_marked_subtrees(network, objects, tmp_path, marked):
+    h = make_history(objects)
+    dst = FileStorage(str(tmp_path / "dst"))
+    closure_db = FileStorage(str(tmp_path / "closure"))
+    # blob_x is missing under tree_d; only a closure marker says otherwise
+    for key in ("c1", "tree_1", "tree_d", "blob_a"):
+        dst.put(h[key], objects.storage.get(h[key]))
+    if marked:
+        closure_db.put(h["tree_d"], b"")
+    face = network.face()
+
+    async def run():
+        GitProducer(network.face(), PREFIX, objects.storage)
+        fetcher = GitFetcher(face, PREFIX, dst, closure_db=closure_db)
+        fetcher.fetch(h["c2"], "commit")
+        return await fetcher.wait_until_finish()
+
+    assert asyncio.run(run())
+    # c2, tree_2, blob_a2 and blob_e, and blob_x unless tree_d is marked
+    assert face.interest_cnt == (4 if marked else 5)
+    assert dst.exists(h["blob_x"]) != marked
+    assert all(closure_db.exists(h[key]) for key in ("c2", "tree_2", "tree_d", "c1", "tree_1"))
@@ -1,7 +1,11 @@
+from typing import List, Optional
 from pyndn import Face, Name, Data, Interest
-from .sync import Sync
-from .gitfetcher import GitFetcher, GitProducer, fetch_data_packet
-from .storage import DBStorage, IStorage
+from .sync import Sync, MultiSync
+from .gitfetcher import GitFetcher, GitProducer, PacketCache, FetchCoordinator, fetch_data_packet
+from .storage import DBStorage, IStorage, PrefixedStorage
+from .negotiation import build_manifest
+from .tlv import encode_tlv, decode_tlvs, encode_nonneg_int, decode_nonneg_int
+import io
 import pickle
 import asyncio
 import struct
@@ -9,6 +13,26 @@ import logging
 from .config import *
 
 
+BRANCH_TLV_NAME = 211
+BRANCH_TLV_CUSTODIAN = 212
+BRANCH_TLV_KEY = 213
+BRANCH_TLV_TIMESTAMP = 214
+BRANCH_TLV_HEAD = 215
+BRANCH_TLV_HEAD_DATA = 216
+PICKLE_PROTOCOL_MARK = 0x80
+METADATA_FRESHNESS = 1000
+
+
+class BranchInfoUnpickler(pickle.Unpickler):
+    """
+    Unpickler for branch records stored by older versions, refusing any other class
+    """
+    def find_class(self, module, name):
+        if name == "BranchInfo" and module in ("ndngitsync.repo", "repo", __name__):
+            return BranchInfo
+        raise pickle.UnpicklingError("Unexpected class in branch record: {}.{}".format(module, name))
+
+
 class BranchInfo:
     def __init__(self, branch_name):
         self.name = branch_name
@@ -18,37 +42,175 @@ class BranchInfo:
         self.head = ""
         self.head_data = b""
 
+    def encode(self) -> bytes:
+        ret = (encode_tlv(BRANCH_TLV_NAME, self.name.encode("utf-8"))
+               + encode_tlv(BRANCH_TLV_CUSTODIAN, self.custodian.encode("utf-8"))
+               + encode_tlv(BRANCH_TLV_KEY, self.key.encode("utf-8"))
+               + encode_tlv(BRANCH_TLV_TIMESTAMP, encode_nonneg_int(self.timestamp))
+               + encode_tlv(BRANCH_TLV_HEAD, self.head.encode("utf-8")))
+        if self.head_data:
+            ret += encode_tlv(BRANCH_TLV_HEAD_DATA, self.head_data)
+        return ret
+
+    @staticmethod
+    def decode(raw: bytes, allow_pickle: bool = False) -> "BranchInfo":
+        """
+        Decode a BranchInfo, raising ValueError if malformed. Records pickled by older
+        versions are accepted only with allow_pickle, which is for the local database:
+        never unpickle what a peer sent.
+        """
+        raw = bytes(raw)
+        if raw[:1] == bytes([PICKLE_PROTOCOL_MARK]):
+            if not allow_pickle:
+                raise ValueError("Pickled BranchInfo rejected")
+            try:
+                ret = BranchInfoUnpickler(io.BytesIO(raw)).load()
+            except (pickle.UnpicklingError, EOFError, AttributeError, TypeError) as e:
+                raise ValueError("Malformed pickled BranchInfo: {}".format(e))
+            if not isinstance(ret, BranchInfo):
+                raise ValueError("Malformed pickled BranchInfo")
+            return ret
+        ret = BranchInfo("")
+        for tlv_type, value in decode_tlvs(raw):
+            if tlv_type == BRANCH_TLV_NAME:
+                ret.name = value.decode("utf-8")
+            elif tlv_type == BRANCH_TLV_CUSTODIAN:
+                ret.custodian = value.decode("utf-8")
+            elif tlv_type == BRANCH_TLV_KEY:
+                ret.key = value.decode("utf-8")
+            elif tlv_type == BRANCH_TLV_TIMESTAMP:
+                ret.timestamp = decode_nonneg_int(value)
+            elif tlv_type == BRANCH_TLV_HEAD:
+                ret.head = value.decode("utf-8")
+            elif tlv_type == BRANCH_TLV_HEAD_DATA:
+                ret.head_data = value
+        return ret
+
+
+def refs_digest(repo_db: IStorage) -> bytes:
+    """
+    Sync digest of the branches stored in repo_db. Unlike Sync.digest(), it leaves out
+    timestamps merged from peers whose objects are not fetched yet.
+    """
+    state = {}
+    for branch in repo_db.keys():
+        try:
+            state[branch] = BranchInfo.decode(repo_db.get(branch), allow_pickle=True).timestamp
+        except ValueError:
+            continue
+    return Sync.state_digest(state)
+
 
 class Repo:
-    def __init__(self, objects_db: IStorage, repo_name: str, face: Face):
+    def __init__(self, objects_db: IStorage, repo_name: str, face: Face,
+                 packet_cache: Optional[PacketCache] = None,
+                 closure_db: Optional[IStorage] = None,
+                 sync_group: Optional[MultiSync] = None,
+                 coordinator: Optional[FetchCoordinator] = None,
+                 manifest_db: Optional[IStorage] = None,
+                 journal_db: Optional[IStorage] = None,
+                 register_prefixes: bool = True,
+                 refs_db: Optional[IStorage] = None):
         self.repo_name = repo_name
-        self.repo_db = DBStorage(DATABASE_NAME, repo_name)
+        # Branch records live in the shared refs_db if given, or in a database of their own
+        if refs_db is not None:
+            self.repo_db = PrefixedStorage(refs_db, repo_name + REFS_KEY_SEPARATOR)
+        else:
+            self.repo_db = DBStorage(DATABASE_NAME, repo_name)
         self.objects_db = objects_db
+        self.closure_db = closure_db
+        self.coordinator = coordinator
+        self.manifest_db = manifest_db
+        self.journal_db = journal_db
+        # Branch -> delay before retrying a failed sync update
+        self.retry_delays = {}
+        self.fetchers = []
+        # Updates and pushes in progress, which keep the repo loaded
+        self.running_tasks = 0
         self.repo_prefix = Name(GIT_PREFIX).append(repo_name)
         self.sync = Sync(face=face,
                          prefix=Name(self.repo_prefix).append("sync"),
                          on_update=self.on_sync_update)
         self.producer = GitProducer(face=face,
                                     prefix=Name(self.repo_prefix).append("objects"),
-                                    storage=objects_db)
+                                    storage=objects_db,
+                                    packet_cache=packet_cache,
+                                    register=register_prefixes,
+                                    closure_db=closure_db)
+        self.handlers = {
+            "objects": self.producer.on_interest,
+            "refs": self.on_refs_interest,
+            "ref-list": self.on_reflist_interest,
+            "branch-info": self.on_branchinfo_interest,
+            "sync": self.sync.on_sync_interest,
+        }
+        self.manifest_producer = None
+        if manifest_db is not None:
+            self.manifest_producer = GitProducer(face=face,
+                                                 prefix=Name(self.repo_prefix).append("manifest"),
+                                                 storage=manifest_db,
+                                                 packet_cache=packet_cache,
+                                                 register=register_prefixes)
+            self.handlers["manifest"] = self.manifest_producer.on_interest
         self.face = face
         self.branches = {}
+        # Encoded Data packets answering metadata Interests, dropped when a branch changes
+        self.branchinfo_wires = {}
+        self.refs_wires = {}
+        self.reflist_wire = None
+        # Called with (repo_name, branch, commit, old_head) whenever a branch moves
+        self.on_branch_update = None
         self.load_refs()
 
-        face.registerPrefix(Name(self.repo_prefix).append("refs"),
-                            self.on_refs_interest,
-                            self.on_register_failed)
-        face.registerPrefix(Name(self.repo_prefix).append("ref-list"),
-                            self.on_reflist_interest,
-                            self.on_register_failed)
-        face.registerPrefix(Name(self.repo_prefix).append("branch-info"),
-                            self.on_branchinfo_interest,
-                            self.on_register_failed)
-        self.sync.run()
+        if register_prefixes:
+            face.registerPrefix(Name(self.repo_prefix).append("refs"),
+                                self.on_refs_interest,
+                                self.on_register_failed)
+            face.registerPrefix(Name(self.repo_prefix).append("ref-list"),
+                                self.on_reflist_interest,
+                                self.on_register_failed)
+            face.registerPrefix(Name(self.repo_prefix).append("branch-info"),
+                                self.on_branchinfo_interest,
+                                self.on_register_failed)
+        if sync_group is not None:
+            sync_group.add(repo_name, self.sync, register=register_prefixes)
+        else:
+            self.sync.run()
+
+    def on_interest(self, prefix, interest: Interest, face, filter_id, interest_filter):
+        """
+        Dispatch an Interest under the repo prefix, for a server registering all repos at once
+        """
+        if len(interest.name) <= len(self.repo_prefix):
+            return
+        handler = self.handlers.get(interest.name[len(self.repo_prefix)].toEscapedString())
+        if handler is not None:
+            handler(prefix, interest, face, filter_id, interest_filter)
+
+    def is_idle(self) -> bool:
+        return (not self.retry_delays and self.running_tasks == 0
+                and all(fetcher.finish_event.is_set() for fetcher in self.fetchers))
+
+    async def run_tracked(self, coroutine):
+        """
+        Await coroutine, keeping the repo from being evicted meanwhile
+        """
+        self.running_tasks += 1
+        try:
+            return await coroutine
+        finally:
+            self.running_tasks -= 1
+
+    def close(self):
+        self.sync.stop()
+        self.producer.cancel()
+        if self.manifest_producer is not None:
+            self.manifest_producer.cancel()
+        self.repo_db.close()
 
     def on_sync_update(self, branch: str, timestamp: int):
         event_loop = asyncio.get_event_loop()
-        event_loop.create_task(self.sync_update(branch, timestamp))
+        event_loop.create_task(self.run_tracked(self.sync_update(branch, timestamp)))
 
     async def sync_update(self, branch: str, timestamp: int):
         commit = ""
@@ -74,8 +236,16 @@ class Repo:
                     print("error: Couldn't fetch refs")
                     return
 
-                fetcher = self.fetch(commit)
+                fetcher = self.fetch(commit, use_manifest=True)
                 await asyncio.wait_for(fetcher.wait_until_finish(), None)
+                if not fetcher.success:
+                    self.retry_sync_update(branch, timestamp)
+                    return
+                self.retry_delays.pop(branch, None)
+                # Serve the manifest to peers as well
+                if fetcher.success and fetcher.manifest is not None and self.manifest_db is not None:
+                    with fetcher.manifest as manifest:
+                        self.manifest_db.put_stream(commit, manifest)
                 update_db()
                 print("Update branch", branch, timestamp)
         else:
@@ -84,28 +254,51 @@ class Repo:
             print("ON NEW BRANCH", interest.name.toUri())
             data = await fetch_data_packet(self.face, interest)
             if isinstance(data, Data):
-                branchinfo = pickle.loads(data.content.toBytes())
+                try:
+                    branchinfo = BranchInfo.decode(data.content.toBytes())
+                except ValueError as e:
+                    logging.warning("Malformed branch-info for %s: %s", branch, e)
+                    return
+                if branchinfo.name != branch:
+                    logging.warning("Branch-info for %s names branch %s", branch, branchinfo.name)
+                    return
             else:
                 print("error: Couldn't fetch branch-info")
                 return
+            # Known from now on, but without a head until it is fetched, so a failed fetch is retried
+            branchinfo.timestamp = 0
+            branchinfo.head = "?"
+            branchinfo.head_data = b""
             self.branches[branch] = branchinfo
+            self.invalidate_wires(branch)
             await self.sync_update(branch, timestamp)
 
+    def retry_sync_update(self, branch: str, timestamp: int):
+        # The fetcher journal lets the retry continue where this attempt stopped
+        delay = self.retry_delays.get(branch, SYNC_RETRY_INITIAL_DELAY)
+        self.retry_delays[branch] = min(delay * 2, SYNC_RETRY_MAX_DELAY)
+        logging.warning("Fetching branch %s failed, retrying in %.0fs", branch, delay)
+        asyncio.get_event_loop().call_later(delay, self.on_sync_update, branch, timestamp)
+
     def on_branchinfo_interest(self, _prefix, interest: Interest, face, _filter_id, _filter):
         name = interest.name
         print("ON BRANCH INFO INTEREST", name.toUri())
         branch = name[-1].toEscapedString()
         if branch not in self.branches:
             return
-        data = Data(interest.name)
-        data.content = pickle.dumps(self.branches[branch])
-        data.metaInfo.freshnessPeriod = 1000
-        face.putData(data)
+        wire = self.branchinfo_wires.get(branch)
+        if wire is None:
+            data = Data(Name(self.repo_prefix).append("branch-info").append(branch))
+            data.content = self.branches[branch].encode()
+            data.metaInfo.freshnessPeriod = METADATA_FRESHNESS
+            wire = data.wireEncode().toBytes()
+            self.branchinfo_wires[branch] = wire
+        face.send(wire)
 
     def on_refs_interest(self, _prefix, interest: Interest, face, _filter_id, _filter):
         name = interest.name
         print("ON REFS INTEREST", name.toUri())
-        if name[-1].isTimestamp:
+        if name[-1].isTimestamp():
             timestamp = name[-1].toTimestamp()
             name = name[:-1]
         else:
@@ -118,23 +311,42 @@ class Repo:
                 self.on_sync_update(branch, timestamp)
             return
 
-        data = Data()
-        raw_data = pickle.loads(self.repo_db.get(branch))
-        data.wireDecode(raw_data.head_data)
-        data.metaInfo.freshnessPeriod = 1000
-        face.putData(data)
+        wire = self.refs_wires.get(branch)
+        if wire is None:
+            # head_data is not kept with the branch, so the first Interest after loading reads it
+            raw_data = self.repo_db.get(branch)
+            head_data = BranchInfo.decode(raw_data, allow_pickle=True).head_data if raw_data is not None else b""
+            if not head_data:
+                return
+            wire = self.encode_refs_data(head_data)
+            self.refs_wires[branch] = wire
+        face.send(wire)
 
     def on_reflist_interest(self, _prefix, interest: Interest, face, _filter_id, _filter):
-        result = '\n'.join("{} refs/heads/{}".format(info.head, name)
-                           for name, info in self.branches.items())
-        result = result + '\n'
+        if self.reflist_wire is None:
+            result = '\n'.join("{} refs/heads/{}".format(info.head, name)
+                               for name, info in self.branches.items())
+            result = result + '\n'
 
-        print("On reflist -> return:", result)
+            print("On reflist -> return:", result)
 
-        data = Data(interest.name)
-        data.content = result.encode("utf-8")
-        data.metaInfo.freshnessPeriod = 1000
-        face.putData(data)
+            data = Data(Name(self.repo_prefix).append("ref-list"))
+            data.content = result.encode("utf-8")
+            data.metaInfo.freshnessPeriod = METADATA_FRESHNESS
+            self.reflist_wire = data.wireEncode().toBytes()
+        face.send(self.reflist_wire)
+
+    @staticmethod
+    def encode_refs_data(head_data: bytes) -> bytes:
+        data = Data()
+        data.wireDecode(head_data)
+        data.metaInfo.freshnessPeriod = METADATA_FRESHNESS
+        return data.wireEncode().toBytes()
+
+    def invalidate_wires(self, branch: str):
+        self.branchinfo_wires.pop(branch, None)
+        self.refs_wires.pop(branch, None)
+        self.reflist_wire = None
 
     def on_register_failed(self, prefix):
         logging.error("Prefix registration failed: %s", prefix)
@@ -143,7 +355,7 @@ class Repo:
         logging.info("Loading %s {", self.repo_prefix[-1])
         for branch in self.repo_db.keys():
             raw_data = self.repo_db.get(branch)
-            self.branches[branch] = pickle.loads(raw_data)
+            self.branches[branch] = BranchInfo.decode(raw_data, allow_pickle=True)
             # Drop the data packet from memory
             self.branches[branch].head_data = b""
             logging.info("  branch: %s head: %s", self.branches[branch].name, self.branches[branch].head)
@@ -151,11 +363,38 @@ class Repo:
         self.sync.state = {name: info.timestamp for name, info in self.branches.items()}
         logging.info("}")
 
-    def fetch(self, commit):
-        fetcher = GitFetcher(self.face, Name(self.repo_prefix).append("objects"), self.objects_db)
-        fetcher.fetch(commit, "commit")
+    def fetch(self, commit, use_manifest=False):
+        fetcher = GitFetcher(self.face, Name(self.repo_prefix).append("objects"), self.objects_db,
+                             closure_db=self.closure_db, coordinator=self.coordinator,
+                             journal_db=self.journal_db)
+        manifest_prefix = None
+        if use_manifest and self.manifest_db is not None:
+            manifest_prefix = Name(self.repo_prefix).append("manifest")
+        fetcher.fetch_negotiated(commit, self.haves(), manifest_prefix)
+        self.fetchers = [f for f in self.fetchers if not f.finish_event.is_set()]
+        self.fetchers.append(fetcher)
         return fetcher
 
+    async def publish_manifest(self, branch: str, commit: str):
+        """
+        Record the objects needed to go from the branch's current head to commit
+        """
+        old_head = self.branches[branch].head
+        haves = [old_head] if old_head not in ("", "?") else []
+        event_loop = asyncio.get_event_loop()
+        manifest = await event_loop.run_in_executor(None, build_manifest, self.objects_db, commit, haves)
+        self.manifest_db.put(commit, manifest)
+
+    def haves(self) -> List[str]:
+        ret = []
+        for info in self.branches.values():
+            if info.head in ("", "?") or not self.objects_db.exists(info.head):
+                continue
+            if self.closure_db is not None and not self.closure_db.exists(info.head):
+                continue
+            ret.append(info.head)
+        return ret
+
     def create_branch(self, branch, custodian):
         if branch in self.branches:
             return False
@@ -164,7 +403,8 @@ class Repo:
         branch_info.timestamp = 0
         branch_info.custodian = custodian
         self.branches[branch] = branch_info
-        self.repo_db.put(branch, pickle.dumps(self.branches[branch]))
+        self.repo_db.put(branch, branch_info.encode())
+        self.invalidate_wires(branch)
         asyncio.get_event_loop().create_task(self.sync.publish_data(branch, 0))
         return True
 
@@ -179,6 +419,9 @@ class Repo:
             if not fetcher.success:
                 return
 
+            if self.manifest_db is not None:
+                await self.publish_manifest(branch, commit)
+
             # TODO W-A-W conflict
             timestamp = await self.sync.publish_data(branch)
 
@@ -201,7 +444,7 @@ class Repo:
             try:
                 await asyncio.wait_for(fetcher.wait_until_finish(), timeout)
             except asyncio.TimeoutError:
-                event_loop.create_task(checkout())
+                event_loop.create_task(self.run_tracked(checkout()))
                 response = PUSH_RESPONSE_PENDING
 
         if response is None:
@@ -218,13 +461,16 @@ class Repo:
         face.putData(data)
 
     def update_branch(self, branch: str, timestamp: int, commit: str, head_data: bytes):
+        old_head = self.branches[branch].head
         # Update database
         self.branches[branch].timestamp = timestamp
         self.branches[branch].head = commit
         self.branches[branch].head_data = head_data
-        self.repo_db.put(branch, pickle.dumps(self.branches[branch]))
+        self.repo_db.put(branch, self.branches[branch].encode())
         # Release Data in memory
         self.branches[branch].head_data = b""
+        self.invalidate_wires(branch)
+        self.refs_wires[branch] = self.encode_refs_data(head_data)
 
         # Send notification Data
         notif = Data(Name(LOCAL_CMD_PREFIX)
@@ -235,3 +481,5 @@ class Repo:
         notif.metaInfo.freshnessPeriod = 10
         notif.content = commit.encode()
         self.face.putData(notif)
+        if self.on_branch_update is not None:
+            self.on_branch_update(self.repo_name, branch, commit, old_head)
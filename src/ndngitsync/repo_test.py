@@ -0,0 +1,62 @@
+import os
+import pickle
+import pytest
+from ndngitsync.repo import BranchInfo, BRANCH_TLV_NAME, BRANCH_TLV_TIMESTAMP
+from ndngitsync.tlv import encode_tlv
+
+
+def make_branch_info(head_data: bytes = b"") -> BranchInfo:
+    branch_info = BranchInfo("master")
+    branch_info.custodian = "/alice"
+    branch_info.key = "/alice/KEY/1"
+    branch_info.timestamp = 1500000000000000
+    branch_info.head = "ab" * 20
+    branch_info.head_data = head_data
+    return branch_info
+
+
+@pytest.mark.parametrize("head_data", [b"", b"\x06\x03abc"], ids=["no-head-data", "head-data"])
+def test_branch_info_round_trip(head_data):
+    branch_info = make_branch_info(head_data)
+    decoded = BranchInfo.decode(branch_info.encode())
+    assert vars(decoded) == vars(branch_info)
+
+
+def test_pickled_branch_info_is_rejected_from_peers():
+    raw = pickle.dumps(make_branch_info())
+    with pytest.raises(ValueError):
+        BranchInfo.decode(raw)
+
+
+def test_pickled_branch_info_is_read_from_the_database():
+    branch_info = make_branch_info(b"data")
+    decoded = BranchInfo.decode(pickle.dumps(branch_info), allow_pickle=True)
+    assert vars(decoded) == vars(branch_info)
+
+
+class Exploit:
+    def __init__(self, path: str):
+        self.path = path
+
+    def __reduce__(self):
+        return os.mkdir, (self.path,)
+
+
+@pytest.mark.parametrize("obj", [Exploit, [1, 2]], ids=["other-class", "not-branch-info"])
+def test_pickles_of_other_objects_are_rejected(obj, tmp_path):
+    path = str(tmp_path / "pwned")
+    raw = pickle.dumps(obj(path) if obj is Exploit else obj)
+    with pytest.raises(ValueError):
+        BranchInfo.decode(raw, allow_pickle=True)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("raw", [
+    pickle.dumps(BranchInfo("master"))[:-5],
+    encode_tlv(BRANCH_TLV_NAME, b"master")[:-1],
+    encode_tlv(BRANCH_TLV_NAME, b"\xff\xfe"),
+    encode_tlv(BRANCH_TLV_TIMESTAMP, b"\x00\x00\x01"),
+], ids=["truncated-pickle", "truncated-tlv", "bad-utf8", "bad-timestamp"])
+def test_malformed_branch_info_raises_value_error(raw):
+    with pytest.raises(ValueError):
+        BranchInfo.decode(raw, allow_pickle=True)
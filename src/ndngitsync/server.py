@@ -1,25 +1,50 @@
-from typing import Union
+from typing import Optional, Union
 from pyndn import Face, Name, Data, Interest
-from .storage import DBStorage
+from .storage import DBStorage, PrefixedStorage
 import shutil
-import random
 import asyncio
+import functools
+import json
 import struct
+import time
 import logging
 import os
 import subprocess
 from .config import *
-from .repo import Repo
+from .repo import Repo, BranchInfo, refs_digest
+from .gitobject import closure_objects
+from .gitfetcher import PacketCache, FetchCoordinator
+from .congestion import CongestionController
+from .checkout import checkout_async, refresh_async, check_name, CheckoutError
+from .sync import MultiSync, SyncStub
+from .asyncface import AsyncFace
 
 
 class Server:
     def __init__(self, face: Face, cmd_prefix: str):
         self.running = True
         self.face = face
+        # Loaded repos; the others are stubs in the sync group until first used
         self.repos = {}
+        self.repo_names = set()
+        self.last_used = {}
         self.objects_db = DBStorage(DATABASE_NAME, OBJECTS_COLL_NAME)
         self.repos_db = DBStorage(DATABASE_NAME, REPOS_COLL_NAME)
+        self.refs_db = DBStorage(DATABASE_NAME, REFS_COLL_NAME)
+        self.closure_db = DBStorage(DATABASE_NAME, CLOSURE_COLL_NAME)
+        self.manifest_db = DBStorage(DATABASE_NAME, MANIFEST_COLL_NAME)
+        self.journal_db = DBStorage(DATABASE_NAME, JOURNAL_COLL_NAME)
+        # Branch checkouts to refresh, keyed by repo and branch, so they survive a restart
+        self.mounts_db = DBStorage(DATABASE_NAME, MOUNTS_COLL_NAME)
+        self.packet_cache = PacketCache()
+        self.fetch_coordinator = FetchCoordinator(CongestionController(
+            initial_window=FETCH_INITIAL_WINDOW, max_window=FETCH_MAX_WINDOW,
+            initial_rto=FETCH_INITIAL_RTO, min_rto=FETCH_MIN_RTO, max_rto=FETCH_MAX_RTO))
+        self.sync_group = MultiSync(Name(GIT_PREFIX).append("~sync"), face)
         self.cmd_prefix = Name(cmd_prefix)
+        # Branch checkouts kept up to date, as (repo, branch), and a lock for each
+        self.refreshed_mounts = {tuple(key.split(REFS_KEY_SEPARATOR, 1)) for key in self.mounts_db.keys()}
+        self.refresh_locks = {}
 
         def register_prefix(prefix: Union[str, Name]):
             self.face.registerPrefix(prefix, None, self.on_register_failed)
@@ -30,18 +55,143 @@ class Server:
             self.face.setInterestFilter(Name(prefix).append("update"), self.on_update)
             self.face.setInterestFilter(Name(prefix).append("unmount"), self.on_unmount)
             self.face.setInterestFilter(Name(prefix).append("commit"), self.on_commit)
+            self.face.setInterestFilter(Name(prefix).append("stats"), self.on_stats)
 
         register_prefix(self.cmd_prefix)
         register_prefix(LOCAL_CMD_PREFIX)
+        # One registration for all repos, dispatched by repo name
+        self.face.registerPrefix(Name(GIT_PREFIX), self.on_repo_interest, self.on_register_failed)
 
         self.load_repos()
+        self.sync_group.run()
+        event_loop = asyncio.get_event_loop()
+        event_loop.create_task(self.evict_idle_repos())
+        # Catch up with heads that moved while the daemon was down
+        for repo, branch in self.refreshed_mounts:
+            event_loop.create_task(self.refresh_mount(repo, branch))
 
     def load_repos(self):
         logging.info("Loading repos......")
-        for repo in self.repos_db.keys():
-            self.repos[repo] = Repo(self.objects_db, repo, self.face)
+        # repos_db only lists the tracked repos; stubs start from the branches actually stored,
+        # so an update merged from a peer but not fetched yet loads the repo again to finish it
+        for repo in list(self.repos_db.keys()):
+            self.migrate_repo_db(repo)
+            self.repo_names.add(repo)
+            self.add_stub(repo, self.stored_digest(repo))
+        self.seed_closure()
+        self.prune_fetch_state()
         logging.info("All repos loaded.")
 
+    def branch_heads(self) -> set:
+        heads = set()
+        for key in list(self.refs_db.keys()):
+            try:
+                heads.add(BranchInfo.decode(self.refs_db.get(key), allow_pickle=True).head)
+            except ValueError:
+                continue
+        return heads
+
+    def prune_fetch_state(self):
+        """
+        Drop the journals of fetches completed since, and the manifests of commits no branch points to
+        """
+        for commit in list(self.journal_db.keys()):
+            if self.closure_db.exists(commit):
+                self.journal_db.remove(commit)
+        heads = self.branch_heads()
+        for commit in list(self.manifest_db.keys()):
+            if commit not in heads:
+                self.manifest_db.remove(commit)
+
+    def seed_closure(self):
+        """
+        Mark the branch heads stored before closure markers were kept, once, so that the first
+        sync does not walk their whole history again. Heads were moved even by failed fetches,
+        so a head and its history are marked only if every object they reach is stored.
+        """
+        if self.closure_db.exists(CLOSURE_SEEDED_KEY):
+            return
+        for key in list(self.refs_db.keys()):
+            try:
+                head = BranchInfo.decode(self.refs_db.get(key), allow_pickle=True).head
+            except ValueError:
+                continue
+            if head in ("", "?") or self.closure_db.exists(head):
+                continue
+            try:
+                closure = closure_objects(self.objects_db, head, self.closure_db.exists)
+            except (IndexError, ValueError, UnicodeDecodeError):
+                continue
+            if closure is not None:
+                self.closure_db.put_many({hash_name: b"" for hash_name in closure})
+                logging.info("Marked %s and %d commits and trees under it complete", head, len(closure) - 1)
+            else:
+                logging.info("History of %s is incomplete, left to the next fetch", head)
+        self.closure_db.put(CLOSURE_SEEDED_KEY, b"")
+        self.closure_db.flush()
+
+    def migrate_repo_db(self, repo: str):
+        """
+        Move the branch records of a repo from its own database, as older versions kept them
+        """
+        if not DBStorage.collection_exists(DATABASE_NAME, repo):
+            return
+        old_db = DBStorage(DATABASE_NAME, repo)
+        new_db = PrefixedStorage(self.refs_db, repo + REFS_KEY_SEPARATOR)
+        new_db.put_many({branch: old_db.get(branch) for branch in old_db.keys()})
+        self.refs_db.flush()
+        old_db.drop()
+        logging.info("Migrated branches of %s to the shared refs database", repo)
+
+    def stored_digest(self, repo: str) -> bytes:
+        return refs_digest(PrefixedStorage(self.refs_db, repo + REFS_KEY_SEPARATOR))
+
+    def add_stub(self, repo: str, state_digest: bytes):
+        self.sync_group.add(repo, SyncStub(state_digest, functools.partial(self.load_sync, repo)), register=False)
+
+    def get_repo(self, repo: str) -> Optional[Repo]:
+        """
+        Return the repo, loading it if it is a stub, or None if it is not tracked
+        """
+        if repo not in self.repo_names:
+            return None
+        if repo not in self.repos:
+            logging.info("Loading repo %s", repo)
+            self.repos[repo] = Repo(self.objects_db, repo, self.face, self.packet_cache, self.closure_db,
+                                    self.sync_group, self.fetch_coordinator, self.manifest_db,
+                                    self.journal_db, register_prefixes=False, refs_db=self.refs_db)
+            self.repos[repo].on_branch_update = self.on_branch_update
+        self.last_used[repo] = time.monotonic()
+        return self.repos[repo]
+
+    def load_sync(self, repo: str):
+        repo_obj = self.get_repo(repo)
+        return repo_obj.sync if repo_obj is not None else None
+
+    def on_repo_interest(self, prefix, interest: Interest, face, filter_id, interest_filter):
+        repo_pos = len(Name(GIT_PREFIX))
+        if len(interest.name) <= repo_pos:
+            return
+        repo_obj = self.get_repo(interest.name[repo_pos].toEscapedString())
+        if repo_obj is not None:
+            repo_obj.on_interest(prefix, interest, face, filter_id, interest_filter)
+
+    async def evict_idle_repos(self):
+        while self.running:
+            await asyncio.sleep(REPO_EVICT_INTERVAL)
+            now = time.monotonic()
+            for repo, repo_obj in list(self.repos.items()):
+                if (now - self.last_used[repo] < REPO_IDLE_TIMEOUT or not repo_obj.is_idle()
+                        or self.is_refreshing(repo)):
+                    continue
+                logging.info("Unloading idle repo %s", repo)
+                self.add_stub(repo, self.stored_digest(repo))
+                repo_obj.close()
+                del self.repos[repo]
+
+    def is_refreshing(self, repo: str) -> bool:
+        return any(lock.locked() for (lock_repo, _), lock in self.refresh_locks.items() if lock_repo == repo)
+
     def on_register_failed(self, prefix):
         logging.error("Prefix registration failed: %s", prefix)
 
@@ -51,7 +201,8 @@ class Server:
             return
         repo = interest.name[-3].toEscapedString()
         branch = interest.name[-2].toEscapedString()
-        if repo not in self.repos:
+        repo_obj = self.get_repo(repo)
+        if repo_obj is None:
             logging.info("Repo %s doesn't exist", repo)
             response = PUSH_RESPONSE_FAILURE
             data = Data(interest.name)
@@ -64,10 +215,27 @@ class Server:
             logging.info("Arguments %s %s %s %d", repo, branch, commit, timeout)
 
             event_loop = asyncio.get_event_loop()
-            event_loop.create_task(self.repos[repo].push(branch, commit, timeout, face, interest.name))
+            event_loop.create_task(repo_obj.run_tracked(repo_obj.push(branch, commit, timeout, face, interest.name)))
 
     def stop(self):
+        """
+        Stop evicting repos and end face.run(), which the daemon runs until complete
+        """
         self.running = False
+        if isinstance(self.face, AsyncFace):
+            self.face.stop()
+
+    def close(self):
+        """
+        Stop, and flush and close the databases
+        """
+        self.stop()
+        self.sync_group.stop()
+        for repo_obj in self.repos.values():
+            repo_obj.close()
+        for db in (self.objects_db, self.repos_db, self.refs_db, self.closure_db, self.manifest_db,
+                   self.journal_db, self.mounts_db):
+            db.close()
 
     def on_create_branch(self, _prefix, interest: Interest, face, _filter_id, _filter):
         logging.info("OnCreateBranch: %s", interest.name.toUri())
@@ -75,10 +243,11 @@ class Server:
             return
         repo = interest.name[-2].toEscapedString()
         branch = interest.name[-1].toEscapedString()
-        if repo not in self.repos:
+        repo_obj = self.get_repo(repo)
+        if repo_obj is None:
             response = PUSH_RESPONSE_FAILURE
         else:
-            result = self.repos[repo].create_branch(branch, self.cmd_prefix.toUri())
+            result = repo_obj.create_branch(branch, self.cmd_prefix.toUri())
             response = PUSH_RESPONSE_SUCCESS if result else PUSH_RESPONSE_FAILURE
         data = Data(interest.name)
         data.content = struct.pack("i", response)
@@ -90,10 +259,12 @@ class Server:
         if len(interest.name) < 2:
             return
         repo = interest.name[-1].toEscapedString()
-        if repo in self.repos:
+        # Escaped names never hold the separator; the keys of a repo would otherwise take in another's
+        if repo in self.repo_names or REFS_KEY_SEPARATOR in repo:
             response = PUSH_RESPONSE_FAILURE
         else:
-            self.repos[repo] = Repo(self.objects_db, repo, self.face)
+            self.repo_names.add(repo)
+            self.get_repo(repo)
             self.repos_db.put(repo, b"")
             response = PUSH_RESPONSE_SUCCESS
         data = Data(interest.name)
@@ -111,11 +282,11 @@ class Server:
 
         # Analyze commit
         commit = None
-        if repo in self.repos:
-            repo_obj = self.repos[repo]
+        repo_obj = self.get_repo(repo)
+        if repo_obj is not None:
             if branch in repo_obj.branches:
                 commit = repo_obj.branches[branch].head
-        if not commit:
+        if not commit or commit == "?":
             # We should fetch
             data = Data(interest.name)
             data.content = struct.pack("i", PUSH_RESPONSE_FAILURE)
@@ -123,34 +294,47 @@ class Server:
             face.putData(data)
             return
 
-        # Call git to mount (not efficient)
         mount_path = os.path.join(os.path.expanduser(MOUNT_PATH), repo)
         os.makedirs(mount_path, exist_ok=True)
         mount_path = os.path.join(mount_path, commit)
-        repo_uri = "ndn::" + Name(GIT_PREFIX).append(repo).toUri()
+        event_loop = asyncio.get_event_loop()
+        event_loop.create_task(self.mount(repo, branch, commit, mount_path, face, interest.name))
 
-        os.spawnlp(os.P_NOWAIT, 'git', 'git', 'clone', '--depth', '1',
-                   '--branch', branch, repo_uri, mount_path)
+    async def mount(self, repo: str, branch: str, commit: str, mount_path: str, face, name: Name):
+        # A mount of the same commit is kept as it is, with any local changes
+        if os.path.isdir(mount_path):
+            response = PUSH_RESPONSE_SUCCESS
+        else:
+            repo_uri = "ndn::" + Name(GIT_PREFIX).append(repo).toUri()
+            try:
+                await checkout_async(self.objects_db, mount_path, commit, branch, repo_uri)
+                response = PUSH_RESPONSE_SUCCESS
+            except (CheckoutError, OSError) as e:
+                logging.error("Checkout of %s %s failed: %s", repo, commit, e)
+                response = PUSH_RESPONSE_FAILURE
 
         # Respond with Data
-        data = Data(interest.name)
-        data.content = struct.pack("i", PUSH_RESPONSE_SUCCESS) + mount_path.encode()
+        content = struct.pack("i", response)
+        if response == PUSH_RESPONSE_SUCCESS:
+            content += mount_path.encode()
+        data = Data(name)
+        data.content = content
         data.metaInfo.freshnessPeriod = 1000
         face.putData(data)
 
     def on_update(self, _prefix, interest: Interest, face, _filter_id, _filter):
         # Decode Interest
-        logging.info("OnClone: %s", interest.name.toUri())
+        logging.info("OnUpdate: %s", interest.name.toUri())
         repo = interest.name[-2].toEscapedString()
         branch = interest.name[-1].toEscapedString()
 
         # Analyze commit
         commit = None
-        if repo in self.repos:
-            repo_obj = self.repos[repo]
+        repo_obj = self.get_repo(repo)
+        if repo_obj is not None:
             if branch in repo_obj.branches:
                 commit = repo_obj.branches[branch].head
-        if not commit:
+        if not commit or commit == "?":
             # We should fetch
             data = Data(interest.name)
             data.content = struct.pack("i", PUSH_RESPONSE_FAILURE)
@@ -158,19 +342,63 @@ class Server:
             face.putData(data)
             return
 
-        # Call git to mount (not efficient)
-        alphabet = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'A', 'B', 'C', 'D', 'E', 'F']
-        mount_path = os.path.join(os.path.expanduser(MOUNT_PATH), repo)
-        os.makedirs(mount_path, exist_ok=True)
-        mount_path = os.path.join(mount_path, "tmp-" + "".join(random.choices(alphabet, k=25)))
+        # Keep refreshing it as the branch moves
+        if (repo, branch) not in self.refreshed_mounts:
+            self.refreshed_mounts.add((repo, branch))
+            self.mounts_db.put(repo + REFS_KEY_SEPARATOR + branch, b"")
+        event_loop = asyncio.get_event_loop()
+        event_loop.create_task(self.refresh_mount(repo, branch, face, interest.name))
+
+    def on_branch_update(self, repo: str, branch: str, commit: str, old_head: str):
+        if (repo, branch) in self.refreshed_mounts:
+            event_loop = asyncio.get_event_loop()
+            event_loop.create_task(self.refresh_mount(repo, branch))
+        # Manifests lead up to a head, so the old head's is kept only while a branch still points there
+        if old_head != commit and old_head not in self.branch_heads():
+            self.manifest_db.remove(old_head)
+
+    async def refresh_mount(self, repo: str, branch: str, face=None, name: Optional[Name] = None):
+        """
+        Bring the checkout of branch to its head, rewriting only the files that changed
+        """
+        mount_path = os.path.join(os.path.expanduser(MOUNT_PATH), repo, MOUNT_BRANCHES_DIR, branch)
         repo_uri = "ndn::" + Name(GIT_PREFIX).append(repo).toUri()
+        lock = self.refresh_locks.setdefault((repo, branch), asyncio.Lock())
+        async with lock:
+            # Read the head only now, so that refreshes queued behind this one have nothing to do
+            repo_obj = self.get_repo(repo)
+            commit = None
+            if repo_obj is not None and branch in repo_obj.branches:
+                commit = repo_obj.branches[branch].head
+            try:
+                if not commit or commit == "?":
+                    raise CheckoutError("No head to check out")
+                for part in branch.split("/"):
+                    check_name(part.encode())
+                await refresh_async(self.objects_db, mount_path, commit, branch, repo_uri)
+                response = PUSH_RESPONSE_SUCCESS
+            except (CheckoutError, OSError) as e:
+                logging.error("Refreshing %s %s failed: %s", repo, branch, e)
+                response = PUSH_RESPONSE_FAILURE
 
-        os.spawnlp(os.P_NOWAIT, 'git', 'git', 'clone', '--depth', '1',
-                   '--branch', branch, repo_uri, mount_path)
+        if name is not None:
+            content = struct.pack("i", response)
+            if response == PUSH_RESPONSE_SUCCESS:
+                content += mount_path.encode()
+            data = Data(name)
+            data.content = content
+            data.metaInfo.freshnessPeriod = 1000
+            face.putData(data)
 
-        # Respond with Data
+    def on_stats(self, _prefix, interest: Interest, face, _filter_id, _filter):
+        logging.info("OnStats: %s", interest.name.toUri())
+        stats = {
+            "repos": {"tracked": len(self.repo_names), "loaded": len(self.repos)},
+            "packet_cache": self.packet_cache.stats(),
+            "fetch": self.fetch_coordinator.stats(),
+        }
         data = Data(interest.name)
-        data.content = struct.pack("i", PUSH_RESPONSE_SUCCESS) + mount_path.encode()
+        data.content = struct.pack("i", PUSH_RESPONSE_SUCCESS) + json.dumps(stats).encode()
         data.metaInfo.freshnessPeriod = 1000
         face.putData(data)
 
@@ -179,9 +407,12 @@ class Server:
         repo = interest.name[-2].toEscapedString()
         branch = interest.name[-1].toEscapedString()
 
-        # Do nothing
+        # Stop refreshing the branch checkout; files are kept
         # dest_path = os.path.join(os.path.expanduser(MOUNT_PATH), repo, branch)
         # shutil.rmtree(dest_path, ignore_errors=True)
+        if (repo, branch) in self.refreshed_mounts:
+            self.refreshed_mounts.discard((repo, branch))
+            self.mounts_db.remove(repo + REFS_KEY_SEPARATOR + branch)
 
         # Respond with Data
         data = Data(interest.name)
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import pytest
+from pyndn import Data, Interest, Name
+from ndngitsync import server as server_module
+from ndngitsync.server import Server
+from ndngitsync.sync import Sync, SyncStub
+from ndngitsync.gitfetcher import fetch_data_packet
+from ndngitsync.config import DATABASE_NAME
+from storage.leveldb import DBStorage
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    # Databases live under ~/.gitsync
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+
+def run_servers(network, test):
+    """
+    Run test(start), where start() starts a Server. The servers are closed even if the
+    test fails, since their sync timers would otherwise keep the loop from finishing.
+    """
+    servers = []
+
+    def start() -> Server:
+        servers.append(Server(network.face(), "/cmd"))
+        return servers[-1]
+
+    async def run():
+        try:
+            await test(start)
+        finally:
+            for server in servers:
+                server.close()
+
+    asyncio.run(run())
+
+
+def command(server: Server, handler, *args):
+    name = Name("/cmd")
+    for arg in args:
+        name.append(arg)
+    handler(None, Interest(name), server.face, None, None)
+
+
+def track(server: Server, repo: str, *branches):
+    command(server, server.on_track_repo, "track-repo", repo)
+    for branch in branches:
+        command(server, server.on_create_branch, "create-branch", repo, branch)
+
+
+def test_repos_start_as_stubs_and_load_on_first_use(home, network):
+    async def test(start):
+        server = start()
+        track(server, "r", "master")
+        await asyncio.sleep(0)
+        server.close()
+
+        server = start()
+        stub = server.sync_group.syncs["r"]
+        assert server.repos == {}
+        assert isinstance(stub, SyncStub)
+        assert stub.digest() == Sync.state_digest({"master": 0})
+        data = await fetch_data_packet(network.face(), Interest(Name("/git/r/ref-list")))
+        assert data.content.toBytes() == b"? refs/heads/master\n"
+        assert set(server.repos) == {"r"}
+        # The loaded Sync takes the stub's place without changing the group state
+        assert server.sync_group.syncs["r"] is server.repos["r"].sync
+        assert server.sync_group.syncs["r"].digest() == stub.digest()
+
+    run_servers(network, test)
+
+
+def test_stubs_leave_out_updates_not_fetched(home, network):
+    async def test(start):
+        server = start()
+        track(server, "r", "master", "dev")
+        await asyncio.sleep(0)
+        repo_obj = server.repos["r"]
+        repo_obj.update_branch("dev", 7, "ab" * 20, Data(Name("/git/r/refs/dev")).wireEncode().toBytes())
+        # Merged from a peer, but the fetch has not finished
+        repo_obj.sync.state["master"] = 5
+        repo_obj.sync.notify_state_change()
+        server.close()
+
+        server = start()
+        assert server.sync_group.syncs["r"].digest() == Sync.state_digest({"master": 0, "dev": 7})
+
+    run_servers(network, test)
+
+
+def test_idle_repos_are_evicted(home, network, monkeypatch):
+    monkeypatch.setattr(server_module, "REPO_EVICT_INTERVAL", 0.01)
+    monkeypatch.setattr(server_module, "REPO_IDLE_TIMEOUT", 0.05)
+
+    async def test(start):
+        server = start()
+        track(server, "idle", "master")
+        track(server, "busy", "master")
+        await asyncio.sleep(0)
+        server.repos["idle"].sync.state["master"] = 5
+        server.repos["idle"].sync.notify_state_change()
+        server.repos["busy"].running_tasks += 1
+        await asyncio.sleep(0.2)
+        assert set(server.repos) == {"busy"}
+        stub = server.sync_group.syncs["idle"]
+        assert isinstance(stub, SyncStub)
+        assert stub.digest() == Sync.state_digest({"master": 0})
+        # Used again, it is loaded again
+        assert server.get_repo("idle").branches["master"].head == "?"
+        assert set(server.repos) == {"busy", "idle"}
+
+    run_servers(network, test)
+
+
+def test_manifests_and_journals_are_pruned(home, network):
+    old_head, new_head, done, undone = "01" * 20, "02" * 20, "03" * 20, "04" * 20
+    head_data = Data(Name("/git/r/refs/master")).wireEncode().toBytes()
+
+    async def test(start):
+        server = start()
+        track(server, "r", "master")
+        await asyncio.sleep(0)
+        repo_obj = server.repos["r"]
+        repo_obj.update_branch("master", 1, old_head, head_data)
+        server.manifest_db.put(old_head, b"old")
+        server.manifest_db.put(new_head, b"new")
+        # The old head's manifest goes once no branch points there
+        repo_obj.update_branch("master", 2, new_head, head_data)
+        assert not server.manifest_db.exists(old_head)
+        assert server.manifest_db.exists(new_head)
+        # Left behind by an earlier run
+        server.manifest_db.put(old_head, b"old")
+        server.journal_db.put(done, b"")
+        server.journal_db.put(undone, b"")
+        server.closure_db.put(done, b"")
+        server.close()
+
+        server = start()
+        assert not server.manifest_db.exists(old_head)
+        assert server.manifest_db.exists(new_head)
+        assert not server.journal_db.exists(done)
+        assert server.journal_db.exists(undone)
+
+    run_servers(network, test)
+
+
+def test_closure_is_seeded_only_for_complete_histories(home, network, objects):
+    head_data = Data(Name("/git/r/refs/master")).wireEncode().toBytes()
+
+    async def test(start):
+        server = start()
+        objects.storage = server.objects_db
+        blob = objects.blob(b"a")
+        tree = objects.tree([(b"100644", b"a", blob)])
+        c1 = objects.commit(tree)
+        c2 = objects.commit(tree, [c1])
+        # The head of dev moved although the fetch of its parent failed
+        lost_tree = objects.tree([(b"100644", b"b", "ab" * 20)])
+        c3 = objects.commit(lost_tree)
+        c4 = objects.commit(tree, [c3])
+        track(server, "r", "master", "dev")
+        await asyncio.sleep(0)
+        server.repos["r"].update_branch("master", 1, c2, head_data)
+        server.repos["r"].update_branch("dev", 1, c4, head_data)
+        # As stored before closure markers were kept
+        for hash_name in (server_module.CLOSURE_SEEDED_KEY, c1, c2, c3, c4, tree, lost_tree):
+            server.closure_db.remove(hash_name)
+        server.close()
+
+        server = start()
+        assert all(server.closure_db.exists(hash_name) for hash_name in (c2, c1, tree))
+        assert not any(server.closure_db.exists(hash_name) for hash_name in (c4, c3, lost_tree))
+
+    run_servers(network, test)
+
+
+def test_repo_names_cannot_reach_other_keyspaces(home, network):
+    async def test(start):
+        server = start()
+        track(server, "a", "master")
+        # The separator is escaped in the name component
+        track(server, "a/b", "master")
+        await asyncio.sleep(0)
+        assert server.repo_names == {"a", "a%2Fb"}
+        assert sorted(server.refs_db.keys()) == ["a%2Fb/master", "a/master"]
+        assert list(server.repos["a"].repo_db.keys()) == ["master"]
+
+    run_servers(network, test)
+
+
+def test_branch_records_are_migrated_once(home, network):
+    head_data = Data(Name("/git/r/refs/master")).wireEncode().toBytes()
+
+    async def test(start):
+        server = start()
+        track(server, "r", "master")
+        await asyncio.sleep(0)
+        server.repos["r"].update_branch("master", 3, "ab" * 20, head_data)
+        record = server.refs_db.get("r/master")
+        server.refs_db.remove("r/master")
+        server.close()
+        # As kept by older versions
+        old_db = DBStorage(DATABASE_NAME, "r")
+        old_db.put("master", record)
+        old_db.close()
+
+        server = start()
+        assert not DBStorage.collection_exists(DATABASE_NAME, "r")
+        assert list(server.refs_db.keys()) == ["r/master"]
+        assert server.refs_db.get("r/master") == record
+        assert server.sync_group.syncs["r"].digest() == Sync.state_digest({"master": 3})
+        server.close()
+
+        # Again, as if interrupted after copying the records
+        old_db = DBStorage(DATABASE_NAME, "r")
+        old_db.put("master", record)
+        old_db.close()
+        server = start()
+        assert not DBStorage.collection_exists(DATABASE_NAME, "r")
+        assert list(server.refs_db.keys()) == ["r/master"]
+        assert server.get_repo("r").branches["master"].head == "ab" * 20
+        server.close()
+
+        server = start()
+        assert list(server.refs_db.keys()) == ["r/master"]
+
+    run_servers(network, test)
+
+
+def test_fetch_window_comes_from_config(home, network, monkeypatch):
+    monkeypatch.setattr(server_module, "FETCH_MAX_WINDOW", 16.0)
+    monkeypatch.setattr(server_module, "FETCH_INITIAL_RTO", 0.5)
+
+    async def test(start):
+        congestion = start().fetch_coordinator.congestion
+        assert congestion.max_window == 16.0
+        assert congestion.rto == 0.5
+
+    run_servers(network, test)
+
+
+def test_stats_command(home, network):
+    async def test(start):
+        server = start()
+        track(server, "r")
+        server.packet_cache.put(Name("/git/r/objects/a"), b"a")
+        server.packet_cache.get(Name("/git/r/objects/a"))
+        data = await fetch_data_packet(network.face(), Interest(Name("/cmd/stats")))
+        stats = json.loads(data.content.toBytes()[4:].decode())
+        assert stats["repos"] == {"tracked": 1, "loaded": 1}
+        assert stats["packet_cache"]["packets"]["hits"] == 1
+        assert stats["fetch"]["congestion"]["in_flight"] == 0
+
+    run_servers(network, test)
@@ -1,3 +1,4 @@
 from storage.leveldb import DBStorage
 from storage import IStorage
 from storage.filesystem import FileStorage
+from storage.prefixed import PrefixedStorage
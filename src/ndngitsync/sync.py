@@ -1,14 +1,76 @@
-from typing import Optional, Union
+from typing import Optional, Tuple, Union
 import asyncio
+import functools
+import hashlib
+import struct
+import time
 from datetime import datetime
 from pyndn import Face, Interest, Data, NetworkNack, Name
 from random import uniform
 import sys
 import logging
+from .tlv import encode_tlv, decode_tlvs, encode_nonneg_int, decode_nonneg_int
 
 
 SYNC_INTERVAL_MIN = 1.0
 SYNC_INTERVAL_MAX = 2.0
+SYNC_INTERVAL_BACKOFF_MAX = 32.0
+SYNC_INTEREST_LIFETIME = 1000
+SYNC_DIGEST_LENGTH = 8
+SYNC_NAME_HASH_LENGTH = 4
+SYNC_VECTOR_ENTRY = struct.Struct("!%ds%ds" % (SYNC_NAME_HASH_LENGTH, SYNC_DIGEST_LENGTH))
+SYNC_VECTOR_CHUNK = 512
+SYNC_FULL_INTERVAL = 10
+SYNC_CONSISTENT_DIGESTS = 64
+
+SYNC_TLV_ENTRY = 201
+SYNC_TLV_BRANCH = 202
+SYNC_TLV_TIMESTAMP = 203
+SYNC_TLV_DIGEST = 204
+
+
+class SyncSchedule:
+    """
+    Retransmission timer of a sync Interest. The interval doubles while the group is
+    quiet, and a timer is skipped if a peer sent an equivalent state in the meantime.
+    Any state change resets the interval and may send at once.
+    """
+    def __init__(self):
+        self.interval = SYNC_INTERVAL_MIN
+        self.suppressed = False
+        self.send_now = False
+        self.event = asyncio.Event()
+
+    def trigger(self):
+        self.interval = SYNC_INTERVAL_MIN
+        self.send_now = True
+        self.event.set()
+
+    def reset(self):
+        self.interval = SYNC_INTERVAL_MIN
+        self.event.set()
+
+    def suppress(self):
+        self.suppressed = True
+
+    async def run(self, send, is_running):
+        self.trigger()
+        while is_running():
+            timeout = uniform(self.interval, self.interval * SYNC_INTERVAL_MAX / SYNC_INTERVAL_MIN)
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                if self.suppressed:
+                    logging.info("retx suppressed")
+                else:
+                    send()
+                self.interval = min(self.interval * 2, SYNC_INTERVAL_BACKOFF_MAX)
+            else:
+                self.event.clear()
+                if self.send_now and is_running():
+                    send()
+            self.send_now = False
+            self.suppressed = False
 
 
 class Sync:
@@ -19,79 +81,304 @@ class Sync:
         self.face = face
         self.on_update = on_update
         self.lock = asyncio.Lock()
-        self.sync_event = asyncio.Event()
+        self.schedule = SyncSchedule()
+        # Set by MultiSync when this Sync is driven by a daemon-wide group
+        self.on_state_change = None
+        self.last_sent = 0.0
+        # State at our last sync Interest, the base of the next delta
+        self.last_sent_state = None
+        self.deltas_sent = 0
 
     @staticmethod
-    def encode(sync_vec: dict) -> str:
-        return "~".join(k + ":" + str(v) for k, v in sync_vec.items())
+    def encode(sync_vec: dict) -> bytes:
+        return b"".join(encode_tlv(SYNC_TLV_ENTRY,
+                                   encode_tlv(SYNC_TLV_BRANCH, branch.encode("utf-8")) +
+                                   encode_tlv(SYNC_TLV_TIMESTAMP, encode_nonneg_int(timestamp)))
+                        for branch, timestamp in sync_vec.items())
 
     @staticmethod
-    def decode(raw_vec: str) -> dict:
+    def decode(raw_vec: bytes) -> dict:
         ret = {}
-        for state in raw_vec.split("~"):
-            branch, timestamp = state.split(":")
-            ret[branch] = int(timestamp)
+        for tlv_type, value in decode_tlvs(raw_vec):
+            if tlv_type != SYNC_TLV_ENTRY:
+                continue
+            branch = None
+            timestamp = None
+            for field_type, field in decode_tlvs(value):
+                if field_type == SYNC_TLV_BRANCH:
+                    branch = bytes(field).decode("utf-8")
+                elif field_type == SYNC_TLV_TIMESTAMP:
+                    timestamp = decode_nonneg_int(field)
+            if branch is None or timestamp is None:
+                raise ValueError("Incomplete sync state entry")
+            ret[branch] = timestamp
         return ret
 
+    def encode_message(self, full: bool = False) -> bytes:
+        """
+        Our state digest, followed by either every entry or only those changed since
+        our last sync Interest. Peers left behind by a delta see a digest mismatch.
+        """
+        changed = None
+        if not full and self.last_sent_state is not None and self.deltas_sent < SYNC_FULL_INTERVAL:
+            changed = {branch: timestamp for branch, timestamp in self.state.items()
+                       if self.last_sent_state.get(branch) != timestamp}
+            if len(changed) >= len(self.state):
+                changed = None
+        if changed is None:
+            self.deltas_sent = 0
+            entries = self.encode(self.state)
+        else:
+            self.deltas_sent += 1
+            entries = self.encode(changed)
+        self.last_sent_state = dict(self.state)
+        return encode_tlv(SYNC_TLV_DIGEST, self.digest()) + entries
+
+    @classmethod
+    def decode_message(cls, raw_msg: bytes) -> Tuple[Optional[bytes], dict]:
+        digest = None
+        for tlv_type, value in decode_tlvs(raw_msg):
+            if tlv_type == SYNC_TLV_DIGEST:
+                digest = bytes(value)
+        return digest, cls.decode(raw_msg)
+
     @staticmethod
     def timestamp():
         return int(datetime.utcnow().timestamp() * 1000000)
 
+    @staticmethod
+    def state_digest(state: dict) -> bytes:
+        sha256 = hashlib.sha256()
+        for branch, timestamp in sorted(state.items()):
+            sha256.update(branch.encode("utf-8") + b"\x00" + struct.pack("!Q", timestamp))
+        return sha256.digest()[:SYNC_DIGEST_LENGTH]
+
+    def digest(self) -> bytes:
+        return self.state_digest(self.state)
+
     def on_sync_interest(self, _prefix, interest: Interest, face, _filter_id, _filter):
         logging.info("on_sync_interest")
         async def update_state():
             nonlocal new_state
+            changed = False
             async with self.lock:
                 for branch, timestamp in new_state.items():
                     if branch not in self.state or self.state[branch] < timestamp:
                         self.state[branch] = timestamp
                         self.on_update(branch, timestamp)
+                        changed = True
+                # Still different after merging: the peer lacks something or sent an incomplete delta
+                if digest is not None and digest != self.digest():
+                    self.send_sync_interest(rate_limited=True, full=True)
+                    self.schedule.reset()
+                elif changed:
+                    # Pass the news on to peers beyond the sender
+                    self.notify_state_change()
+                elif digest is not None:
+                    self.schedule.suppress()
 
+        digest = None
+        new_state = {}
         if not interest.applicationParameters.isNull():
-            raw_vec = interest.applicationParameters.toBytes().decode("utf-8")
-            new_state = self.decode(raw_vec)
-        else:
-            new_state = {}
+            try:
+                digest, new_state = self.decode_message(interest.applicationParameters.toBytes())
+            except (ValueError, UnicodeDecodeError):
+                logging.warning("Malformed sync Interest: %s", interest.name.toUri())
+                return
         event_loop = asyncio.get_event_loop()
         event_loop.create_task(update_state())
 
     def on_sync_data(self, *args, **kwargs):
         pass
 
-    async def retx_sync_interest(self):
-        while self.running:
-            interest = Interest(Name(self.prefix))
-            interest.applicationParameters = self.encode(self.state)
-            interest.appendParametersDigestToName()
+    def send_sync_interest(self, rate_limited: bool = False, full: bool = False):
+        now = time.monotonic()
+        if rate_limited and now - self.last_sent < SYNC_INTERVAL_MIN:
+            return
+        self.last_sent = now
+        interest = Interest(Name(self.prefix))
+        interest.applicationParameters = self.encode_message(full)
+        interest.appendParametersDigestToName()
+        interest.interestLifetimeMilliseconds = SYNC_INTEREST_LIFETIME
 
-            # await fetch_data_packet(self.face, interest)
-            self.face.expressInterest(interest, self.on_sync_data)
-            logging.info("retx")
+        # await fetch_data_packet(self.face, interest)
+        self.face.expressInterest(interest, self.on_sync_data)
 
-            timeout = uniform(SYNC_INTERVAL_MIN, SYNC_INTERVAL_MAX)
-            try:
-                await asyncio.wait_for(self.sync_event.wait(), timeout)
-            except asyncio.TimeoutError:
-                pass
-            self.sync_event.clear()
+    async def retx_sync_interest(self):
+        await self.schedule.run(self.send_sync_interest, lambda: self.running)
 
     def run(self):
         self.running = True
         event_loop = asyncio.get_event_loop()
         event_loop.create_task(self.retx_sync_interest())
+        self.register()
+
+    def register(self):
         self.face.registerPrefix(self.prefix, self.on_sync_interest, self.on_register_failed)
 
     def stop(self):
         self.running = False
+        self.schedule.event.set()
 
     def on_register_failed(self, prefix):
         logging.error("Prefix registration failed: %s", prefix)
 
+    def notify_state_change(self):
+        if self.on_state_change is not None:
+            self.on_state_change(self)
+        else:
+            self.schedule.trigger()
+
     async def publish_data(self, branch: str, timestamp: Optional[int] = None):
         logging.info("publish_data")
         if timestamp is None:
             timestamp = self.timestamp()
         async with self.lock:
             self.state[branch] = timestamp
-        self.sync_event.set()
+        self.notify_state_change()
         return timestamp
+
+
+class SyncStub:
+    """
+    Stand-in for the Sync of a repo that is not loaded, knowing only its state digest.
+    Anything else loads the repo, whose Sync then replaces the stub in the group.
+    """
+    def __init__(self, state_digest: bytes, load):
+        self.state_digest = state_digest
+        self.load = load
+        self.on_state_change = None
+
+    def digest(self) -> bytes:
+        return self.state_digest
+
+    def register(self):
+        pass
+
+    def send_sync_interest(self, rate_limited: bool = False, full: bool = False):
+        sync = self.load()
+        if sync is not None:
+            sync.send_sync_interest(rate_limited, full)
+
+
+class MultiSync:
+    """
+    One sync group for all repos of a daemon. Only a digest of every repo's state is
+    sent periodically. A peer with a different digest answers with the per-repo digests,
+    and only the repos that differ exchange their full state vectors.
+    Peers may track different repos, so their root digests never match. Once the vectors
+    show that the repos both track agree, the peer's root digest is remembered as
+    consistent and treated like an equal one, until our own state changes.
+    """
+    def __init__(self, prefix: Union[Name, str], face: Face):
+        self.prefix = Name(prefix)
+        self.face = face
+        self.syncs = {}
+        self.name_hashes = {}
+        self.running = False
+        self.schedule = SyncSchedule()
+        self.last_vector_sent = 0.0
+        # Root digests of peers agreeing with us on every repo both track
+        self.consistent_digests = set()
+
+    @staticmethod
+    def name_hash(name: str) -> bytes:
+        return hashlib.sha256(name.encode("utf-8")).digest()[:SYNC_NAME_HASH_LENGTH]
+
+    def add(self, name: str, sync: Union[Sync, SyncStub], register: bool = True):
+        old_sync = self.syncs.get(name)
+        self.syncs[name] = sync
+        self.name_hashes[self.name_hash(name)] = sync
+        sync.on_state_change = functools.partial(self.on_state_change, name)
+        if register:
+            sync.register()
+        # Swapping a stub and its loaded Sync does not change the group state
+        if old_sync is None or old_sync.digest() != sync.digest():
+            self.consistent_digests.clear()
+            self.schedule.trigger()
+
+    def root_digest(self) -> bytes:
+        sha256 = hashlib.sha256()
+        for name, sync in sorted(self.syncs.items()):
+            sha256.update(self.name_hash(name) + sync.digest())
+        return sha256.digest()[:SYNC_DIGEST_LENGTH]
+
+    def on_state_change(self, name: str, sync: Sync):
+        # Propagate the repo's state now, and the new digest along with it
+        self.consistent_digests.clear()
+        sync.send_sync_interest()
+        self.schedule.trigger()
+
+    def on_sync_interest(self, _prefix, interest: Interest, face, _filter_id, _filter):
+        # Names: <prefix>/digest/<root-digest>, <prefix>/<vector|vector-reply>/<root-digest>/<params-digest>
+        if len(interest.name) <= len(self.prefix) + 1:
+            return
+        kind = interest.name[len(self.prefix)].toEscapedString()
+        digest = interest.name[len(self.prefix) + 1].getValue().toBytes()
+        if kind == "digest":
+            if digest == self.root_digest() or digest in self.consistent_digests:
+                self.schedule.suppress()
+            else:
+                # Unknown state: the vectors tell which repos both track and whether they differ.
+                # The schedule is not reset, as the peer may only track other repos.
+                self.send_vector("vector")
+        elif kind in ("vector", "vector-reply"):
+            # A peer tracking no repos sends empty parameters, which PyNDN leaves out
+            raw_vec = interest.applicationParameters.toBytes() or b""
+            differs = False
+            for name_hash, repo_digest in SYNC_VECTOR_ENTRY.iter_unpack(
+                    raw_vec[:len(raw_vec) - len(raw_vec) % SYNC_VECTOR_ENTRY.size]):
+                sync = self.name_hashes.get(name_hash)
+                if sync is not None and sync.digest() != repo_digest:
+                    differs = True
+                    sync.send_sync_interest(rate_limited=True, full=True)
+            if differs:
+                self.schedule.reset()
+                return
+            # Only a whole vector shows that every repo both track agrees
+            if len(raw_vec) < SYNC_VECTOR_CHUNK * SYNC_VECTOR_ENTRY.size:
+                if len(self.consistent_digests) >= SYNC_CONSISTENT_DIGESTS:
+                    self.consistent_digests.clear()
+                self.consistent_digests.add(digest)
+            # The peer did not know our digest; let it learn that we agree too
+            if kind == "vector":
+                self.send_vector("vector-reply")
+
+    def send_digest(self):
+        interest = Interest(Name(self.prefix).append("digest").append(self.root_digest()))
+        interest.interestLifetimeMilliseconds = SYNC_INTEREST_LIFETIME
+        self.face.expressInterest(interest, self.on_sync_data)
+
+    def send_vector(self, kind: str):
+        now = time.monotonic()
+        if now - self.last_vector_sent < SYNC_INTERVAL_MIN:
+            return
+        self.last_vector_sent = now
+        root_digest = self.root_digest()
+        entries = [SYNC_VECTOR_ENTRY.pack(self.name_hash(name), sync.digest())
+                   for name, sync in sorted(self.syncs.items())]
+        for i in range(0, max(len(entries), 1), SYNC_VECTOR_CHUNK):
+            interest = Interest(Name(self.prefix).append(kind).append(root_digest))
+            interest.applicationParameters = b"".join(entries[i:i + SYNC_VECTOR_CHUNK])
+            interest.appendParametersDigestToName()
+            interest.interestLifetimeMilliseconds = SYNC_INTEREST_LIFETIME
+            self.face.expressInterest(interest, self.on_sync_data)
+
+    def on_sync_data(self, *args, **kwargs):
+        pass
+
+    async def retx_sync_interest(self):
+        await self.schedule.run(self.send_digest, lambda: self.running)
+
+    def run(self):
+        self.running = True
+        event_loop = asyncio.get_event_loop()
+        event_loop.create_task(self.retx_sync_interest())
+        self.face.registerPrefix(self.prefix, self.on_sync_interest, self.on_register_failed)
+
+    def stop(self):
+        self.running = False
+        self.schedule.event.set()
+
+    def on_register_failed(self, prefix):
+        logging.error("Prefix registration failed: %s", prefix)
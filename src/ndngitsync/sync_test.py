@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
 import asyncio
-from sync import Sync
-from pyndn import Face, Interest, Data, NetworkNack, Name
+from ndngitsync.sync import Sync
+from ndngitsync.asyncface import AsyncFace
+from pyndn import Interest, Data, NetworkNack, Name
 from pyndn.security import KeyChain
 
 
@@ -11,16 +12,9 @@ def on_update(branch: str, timestamp: int):
 
 
 async def run():
-    async def face_loop():
-        nonlocal face, running
-        while running:
-            face.processEvents()
-            await asyncio.sleep(0.01)
+    face = AsyncFace()
     event_loop = asyncio.get_event_loop()
-    event_loop.create_task(face_loop())
-
-    running = True
-    face = Face()
+    event_loop.create_task(face.run())
     keychain = KeyChain()
     face.setCommandSigningInfo(keychain, keychain.getDefaultCertificateName())
 
@@ -0,0 +1,66 @@
+from typing import Iterator, Tuple
+import struct
+
+
+def encode_var_number(value: int) -> bytes:
+    """
+    VAR-NUMBER as in the NDN packet format
+    """
+    if value < 253:
+        return bytes([value])
+    elif value <= 0xffff:
+        return b"\xfd" + struct.pack("!H", value)
+    elif value <= 0xffffffff:
+        return b"\xfe" + struct.pack("!I", value)
+    else:
+        return b"\xff" + struct.pack("!Q", value)
+
+
+def decode_var_number(buf: bytes, pos: int) -> Tuple[int, int]:
+    first = buf[pos]
+    if first < 253:
+        return first, pos + 1
+    elif first == 253:
+        return struct.unpack_from("!H", buf, pos + 1)[0], pos + 3
+    elif first == 254:
+        return struct.unpack_from("!I", buf, pos + 1)[0], pos + 5
+    else:
+        return struct.unpack_from("!Q", buf, pos + 1)[0], pos + 9
+
+
+def encode_nonneg_int(value: int) -> bytes:
+    if value <= 0xff:
+        return bytes([value])
+    elif value <= 0xffff:
+        return struct.pack("!H", value)
+    elif value <= 0xffffffff:
+        return struct.pack("!I", value)
+    else:
+        return struct.pack("!Q", value)
+
+
+def decode_nonneg_int(value: bytes) -> int:
+    if len(value) not in (1, 2, 4, 8):
+        raise ValueError("Invalid NonNegativeInteger length %d" % len(value))
+    return int.from_bytes(value, "big")
+
+
+def encode_tlv(tlv_type: int, value: bytes) -> bytes:
+    return encode_var_number(tlv_type) + encode_var_number(len(value)) + value
+
+
+def decode_tlvs(buf: bytes) -> Iterator[Tuple[int, bytes]]:
+    """
+    Iterate over consecutive TLV elements, raising ValueError if buf is malformed
+    """
+    pos = 0
+    try:
+        while pos < len(buf):
+            tlv_type, pos = decode_var_number(buf, pos)
+            length, pos = decode_var_number(buf, pos)
+            if pos + length > len(buf):
+                raise ValueError("TLV length exceeds buffer")
+            yield tlv_type, buf[pos:pos + length]
+            pos += length
+    except (IndexError, struct.error):
+        raise ValueError("Truncated TLV")
@@ -0,0 +1,88 @@
+import pytest
+from ndngitsync.sync import Sync, SYNC_FULL_INTERVAL, SYNC_TLV_ENTRY, SYNC_TLV_BRANCH
+from ndngitsync.tlv import encode_var_number, decode_var_number, encode_nonneg_int, decode_nonneg_int, \
+    encode_tlv, decode_tlvs
+
+
+@pytest.mark.parametrize("value, length", [
+    (0, 1), (252, 1), (253, 3), (0xffff, 3), (0x10000, 5), (0xffffffff, 5), (0x100000000, 9), (2 ** 64 - 1, 9),
+])
+def test_var_number_round_trip(value, length):
+    raw = encode_var_number(value)
+    assert len(raw) == length
+    # Decoded in the middle of a buffer, it ends where the next field starts
+    assert decode_var_number(b"\x07" + raw + b"\x08", 1) == (value, 1 + length)
+
+
+@pytest.mark.parametrize("value, length", [(0, 1), (0xff, 1), (0x100, 2), (0x10000, 4), (0x100000000, 8)])
+def test_nonneg_int_round_trip(value, length):
+    raw = encode_nonneg_int(value)
+    assert len(raw) == length
+    assert decode_nonneg_int(raw) == value
+
+
+def test_nonneg_int_rejects_odd_lengths():
+    with pytest.raises(ValueError):
+        decode_nonneg_int(b"\x00\x01\x02")
+    with pytest.raises(ValueError):
+        decode_nonneg_int(b"")
+
+
+def test_tlvs_round_trip():
+    values = [(1, b""), (300, b"x" * 300), (70000, b"nested" + encode_tlv(2, b"y"))]
+    raw = b"".join(encode_tlv(tlv_type, value) for tlv_type, value in values)
+    assert list(decode_tlvs(raw)) == values
+    assert list(decode_tlvs(values[2][1][6:])) == [(2, b"y")]
+
+
+@pytest.mark.parametrize("raw", [
+    b"\x01",
+    b"\x01\x05abcd",
+    b"\xfd\x01",
+    b"\x01\xfe\x00\x00",
+    encode_tlv(1, b"ok") + b"\x02\x03a",
+], ids=["no-length", "short-value", "short-type", "short-length", "short-second"])
+def test_truncated_tlvs_raise_value_error(raw):
+    with pytest.raises(ValueError):
+        list(decode_tlvs(raw))
+
+
+def test_sync_state_round_trip():
+    state = {"repo/master": 1, "repo/dev": 2 ** 40, "репо/ветка": 0}
+    assert Sync.decode(Sync.encode(state)) == state
+
+
+def test_sync_state_skips_unknown_types():
+    raw = encode_tlv(250, b"future") + Sync.encode({"b": 5})
+    assert Sync.decode(raw) == {"b": 5}
+
+
+def test_sync_state_rejects_incomplete_entries():
+    with pytest.raises(ValueError):
+        Sync.decode(encode_tlv(SYNC_TLV_ENTRY, encode_tlv(SYNC_TLV_BRANCH, b"b")))
+
+
+def test_sync_messages_carry_deltas():
+    sync = Sync("/git", None, None)
+    sync.state = {"a": 1, "b": 1, "c": 1}
+    digest, state = Sync.decode_message(sync.encode_message())
+    assert digest == sync.digest()
+    assert state == {"a": 1, "b": 1, "c": 1}
+    sync.state["b"] = 2
+    digest, state = Sync.decode_message(sync.encode_message())
+    assert digest == sync.digest()
+    assert state == {"b": 2}
+    # Nothing changed, nothing but the digest
+    assert Sync.decode_message(sync.encode_message()) == (sync.digest(), {})
+    assert Sync.decode_message(sync.encode_message(full=True))[1] == sync.state
+
+
+def test_sync_messages_are_full_now_and_then():
+    sync = Sync("/git", None, None)
+    sync.state = {"a": 0, "b": 0}
+    sync.encode_message()
+    for timestamp in range(1, SYNC_FULL_INTERVAL + 1):
+        sync.state["a"] = timestamp
+        assert Sync.decode_message(sync.encode_message())[1] == {"a": timestamp}
+    sync.state["a"] += 1
+    assert Sync.decode_message(sync.encode_message())[1] == sync.state
@@ -1,21 +1,15 @@
 #!/usr/bin/env python3
 
 import asyncio
-from pyndn import Face, Name, Interest, Data
+from pyndn import Name, Interest, Data
+from ndngitsync.asyncface import AsyncFace
 from ndngitsync.gitfetcher import fetch_data_packet
 
 
 async def run():
-    async def face_loop():
-        nonlocal face, running
-        while running:
-            face.processEvents()
-            await asyncio.sleep(0.01)
-
-    running = True
-    face = Face()
+    face = AsyncFace()
     event_loop = asyncio.get_event_loop()
-    face_task = event_loop.create_task(face_loop())
+    face_task = event_loop.create_task(face.run())
 
     interest = Interest(Name("/localhost/gitsync/notif/temprepo/master"))
     interest.mustBeFresh = True
@@ -27,7 +21,7 @@ async def run():
     else:
         print("Failed")
 
-    running = False
+    face.stop()
     await face_task
 
 
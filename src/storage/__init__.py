@@ -1,3 +1,15 @@
+from typing import BinaryIO
+import io
+
+
+# Backends buffering writes in a batch session flush at this size or age
+WRITE_BATCH_SIZE = 4 * 1024 * 1024
+WRITE_BATCH_INTERVAL = 1.0
+# Database backends store larger values in chunks of this size, so that neither storing
+# nor streaming one holds it whole in memory
+CHUNK_SIZE = 1024 * 1024
+
+
 class IStorage:
     def put(self, key: str, data: bytes):
         raise NotImplementedError
@@ -10,3 +22,94 @@ class IStorage:
 
     def remove(self, key: str) -> bool:
         raise NotImplementedError
+
+    def put_stream(self, key: str, stream: BinaryIO):
+        """
+        Store everything read from stream. Backends able to write incrementally override this;
+        the others hold the whole value in memory while storing it.
+        """
+        self.put(key, stream.read())
+
+    def get_stream(self, key: str) -> BinaryIO:
+        """
+        Stream of the value. Unless overridden, the whole value is read into memory first.
+        """
+        return io.BytesIO(self.get(key))
+
+    def size(self, key: str) -> int:
+        """
+        Length of the value. Unless overridden, the value is read to measure it.
+        """
+        return len(self.get(key))
+
+    def put_many(self, items: dict):
+        for key, data in items.items():
+            self.put(key, data)
+
+    def get_many(self, keys) -> dict:
+        return {key: self.get(key) for key in keys if self.exists(key)}
+
+    def exists_many(self, keys) -> set:
+        return {key for key in keys if self.exists(key)}
+
+    def begin_batch(self):
+        pass
+
+    def end_batch(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+    Seekable stream over a value stored in chunks of chunk_size bytes, holding one chunk
+    at a time. read_chunk(index) returns the chunk. Wrap it in io.BufferedReader for reads
+    that do not stop at chunk boundaries.
+    """
+    def __init__(self, size: int, chunk_size: int, read_chunk):
+        super().__init__()
+        self.size = size
+        self.chunk_size = chunk_size
+        self.read_chunk = read_chunk
+        self.pos = 0
+        self.chunk_index = -1
+        self.chunk = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.pos = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        if self.pos >= self.size:
+            return 0
+        index, start = divmod(self.pos, self.chunk_size)
+        if index != self.chunk_index:
+            chunk = self.read_chunk(index)
+            if chunk is None:
+                raise IOError("Chunk {} is missing".format(index))
+            self.chunk = chunk
+            self.chunk_index = index
+        piece = self.chunk[start:start + len(buffer)]
+        buffer[:len(piece)] = piece
+        self.pos += len(piece)
+        return len(piece)
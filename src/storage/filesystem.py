@@ -1,10 +1,19 @@
+from typing import BinaryIO
+import io
 import os
+import shutil
+import tempfile
 from . import IStorage
+from .packfile import PackStore
+
+
+STREAM_COPY_SIZE = 1024 * 1024
 
 
 class FileStorage(IStorage):
     def __init__(self, path_prefix: str):
         self.path = path_prefix
+        self.packs = PackStore(os.path.join(self.path, "objects", "pack"))
 
     def path_from_hash(self, hash_name: str) -> str:
         return os.path.join(self.path, "objects", hash_name[:2], hash_name[2:])
@@ -15,13 +24,47 @@ class FileStorage(IStorage):
         with open(file_path, "wb") as f:
             f.write(data)
 
+    def put_stream(self, hash_name: str, stream: BinaryIO):
+        file_path = self.path_from_hash(hash_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write to a temporary file first so a partial object is never visible
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(stream, f, STREAM_COPY_SIZE)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get_stream(self, hash_name: str) -> BinaryIO:
+        try:
+            return open(self.path_from_hash(hash_name), "rb")
+        except FileNotFoundError:
+            raw_data = self.packs.get(hash_name)
+            if raw_data is None:
+                raise
+            return io.BytesIO(raw_data)
+
     def get(self, hash_name: str) -> bytes:
-        with open(self.path_from_hash(hash_name), "rb") as f:
-            raw_data = f.read()
+        try:
+            with open(self.path_from_hash(hash_name), "rb") as f:
+                raw_data = f.read()
+        except FileNotFoundError:
+            # Objects after git gc live in packfiles
+            raw_data = self.packs.get(hash_name)
+            if raw_data is None:
+                raise
         return raw_data
 
+    def size(self, hash_name: str) -> int:
+        try:
+            return os.path.getsize(self.path_from_hash(hash_name))
+        except FileNotFoundError:
+            return super().size(hash_name)
+
     def exists(self, hash_name: str) -> bool:
-        return os.path.exists(self.path_from_hash(hash_name))
+        return os.path.exists(self.path_from_hash(hash_name)) or self.packs.contains(hash_name)
 
     def remove(self, hash_name: str) -> bool:
         try:
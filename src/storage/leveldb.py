@@ -1,6 +1,37 @@
+from typing import BinaryIO
 import plyvel
+import io
 import os
-from . import IStorage
+import time
+import struct
+import shutil
+import asyncio
+import threading
+from . import IStorage, ChunkedReader, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL, CHUNK_SIZE
+
+
+# Values larger than CHUNK_SIZE are stored in chunks under CHUNK_KEY_PREFIX + key + NUL + index,
+# which no key of ours starts with, and the key itself holds a header with the size and count
+CHUNK_KEY_PREFIX = b"\x00chunk\x00"
+CHUNKED_VALUE_MAGIC = b"\x00gitsync chunked value\x00"
+CHUNKED_VALUE_HEADER = struct.Struct("!QI")
+
+
+def encode_chunked_header(size: int, count: int) -> bytes:
+    return CHUNKED_VALUE_MAGIC + CHUNKED_VALUE_HEADER.pack(size, count)
+
+
+def decode_chunked_header(value: bytes):
+    """
+    (size, count) if value is the header of a chunked value, or None
+    """
+    if len(value) != len(CHUNKED_VALUE_MAGIC) + CHUNKED_VALUE_HEADER.size or not value.startswith(CHUNKED_VALUE_MAGIC):
+        return None
+    return CHUNKED_VALUE_HEADER.unpack(value[len(CHUNKED_VALUE_MAGIC):])
+
+
+def chunk_key(key: bytes, index: int) -> bytes:
+    return CHUNK_KEY_PREFIX + key + b"\x00" + struct.pack("!I", index)
 
 
 class DBStorage(IStorage):
@@ -15,33 +46,195 @@ class DBStorage(IStorage):
         os.makedirs(self._uri, exist_ok=True)
         self.client = plyvel.DB(self._uri, create_if_missing=True)
 
+        # Write-behind buffer used while a batch session is open. Readers in worker
+        # threads share it with the event loop, hence the lock.
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._pending = {}
+        self._pending_size = 0
+        self._pending_since = 0.0
+        self._flush_timer = None
+
     def put(self, key: str, value: bytes):
         """
         Insert document into MongoDB, overwrite if already exists.
         """
-        self.client.put(key.encode(), value)
+        if len(value) > CHUNK_SIZE:
+            self.put_stream(key, io.BytesIO(value))
+            return
+        with self._lock:
+            if self._batch_depth == 0:
+                with self.client.write_batch() as batch:
+                    self._delete_chunks(batch, key.encode())
+                    batch.put(key.encode(), value)
+                return
+            if not self._pending:
+                self._pending_since = time.monotonic()
+                self._schedule_flush()
+            old_value = self._pending.get(key.encode())
+            if old_value is not None:
+                self._pending_size -= len(old_value)
+            self._pending[key.encode()] = value
+            self._pending_size += len(value)
+            if (self._pending_size >= WRITE_BATCH_SIZE
+                    or time.monotonic() - self._pending_since >= WRITE_BATCH_INTERVAL):
+                self.flush()
+
+    def _schedule_flush(self):
+        # Flush the tail of a batch that goes quiet; without a running loop, put() checks the age
+        try:
+            event_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flush_timer = event_loop.call_later(WRITE_BATCH_INTERVAL, self.flush)
+
+    def put_stream(self, key: str, stream: BinaryIO):
+        """
+        Store a value read from stream, in chunks if it is larger than CHUNK_SIZE
+        """
+        chunk = stream.read(CHUNK_SIZE)
+        next_chunk = stream.read(CHUNK_SIZE)
+        if not next_chunk:
+            self.put(key, chunk)
+            return
+        raw_key = key.encode()
+        with self._lock:
+            value = self._pending.pop(raw_key, None)
+            if value is not None:
+                self._pending_size -= len(value)
+        size = 0
+        count = 0
+        while chunk:
+            self.client.put(chunk_key(raw_key, count), chunk)
+            size += len(chunk)
+            count += 1
+            chunk, next_chunk = next_chunk, stream.read(CHUNK_SIZE)
+        with self.client.write_batch() as batch:
+            self._delete_chunks(batch, raw_key, count)
+            batch.put(raw_key, encode_chunked_header(size, count))
+
+    def _delete_chunks(self, batch, raw_key: bytes, first: int = 0):
+        """
+        Delete the chunks of the value at raw_key from index first on
+        """
+        for key in self.client.iterator(prefix=CHUNK_KEY_PREFIX + raw_key + b"\x00", include_value=False):
+            if struct.unpack("!I", key[-4:])[0] >= first:
+                batch.delete(key)
+
+    def _get_raw(self, key: str) -> bytes:
+        with self._lock:
+            value = self._pending.get(key.encode())
+        if value is not None:
+            return value
+        return self.client.get(key.encode())
 
     def get(self, key: str) -> bytes:
         """
         Get document from MongoDB
         """
-        return self.client.get(key.encode())
+        value = self._get_raw(key)
+        header = decode_chunked_header(value) if value is not None else None
+        if header is None:
+            return value
+        return b"".join(self.client.get(chunk_key(key.encode(), index)) for index in range(header[1]))
+
+    def get_stream(self, key: str) -> BinaryIO:
+        """
+        Stream of the value, reading a chunked one a chunk at a time
+        """
+        value = self._get_raw(key)
+        header = decode_chunked_header(value) if value is not None else None
+        if header is None:
+            return io.BytesIO(value)
+        raw_key = key.encode()
+        return io.BufferedReader(ChunkedReader(header[0], CHUNK_SIZE,
+                                               lambda index: self.client.get(chunk_key(raw_key, index))))
+
+    def size(self, key: str) -> int:
+        value = self._get_raw(key)
+        if value is None:
+            raise KeyError(key)
+        header = decode_chunked_header(value)
+        return header[0] if header is not None else len(value)
 
     def exists(self, key: str) -> bool:
         """
         Return whether document exists
         """
+        with self._lock:
+            if key.encode() in self._pending:
+                return True
         return self.client.get(key.encode()) is not None
 
     def remove(self, key: str) -> bool:
         """
         Return whether removal is successful
         """
-        self.client.delete(key.encode())
+        with self._lock:
+            value = self._pending.pop(key.encode(), None)
+            if value is not None:
+                self._pending_size -= len(value)
+            with self.client.write_batch() as batch:
+                self._delete_chunks(batch, key.encode())
+                batch.delete(key.encode())
         return True
 
-    def keys(self):
+    def keys(self, prefix: str = ""):
+        """
+        Return a set of "primary" keys, only those starting with prefix if given
+        """
+        self.flush()
+        return (key.decode() for key in self.client.iterator(prefix=prefix.encode(), include_value=False)
+                if not key.startswith(CHUNK_KEY_PREFIX))
+
+    @staticmethod
+    def collection_exists(db: str, collection: str) -> bool:
+        return os.path.isdir(os.path.join(os.path.expanduser('~/.' + db), collection))
+
+    def drop(self):
         """
-        Return a set of "primary" keys
+        Close and delete the whole collection
         """
-        return (item[0].decode() for item in self.client)
+        with self._lock:
+            self._pending.clear()
+            self._pending_size = 0
+            self._cancel_flush_timer()
+            self.client.close()
+        shutil.rmtree(self._uri, ignore_errors=True)
+
+    def begin_batch(self):
+        """
+        Buffer writes until the outermost batch ends, or the buffer grows too large or old
+        """
+        with self._lock:
+            self._batch_depth += 1
+
+    def end_batch(self):
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def flush(self):
+        """
+        Commit buffered writes with one LevelDB write batch
+        """
+        with self._lock:
+            self._cancel_flush_timer()
+            if not self._pending:
+                return
+            with self.client.write_batch() as batch:
+                for key, value in self._pending.items():
+                    self._delete_chunks(batch, key)
+                    batch.put(key, value)
+            self._pending.clear()
+            self._pending_size = 0
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def close(self):
+        self.flush()
+        self.client.close()
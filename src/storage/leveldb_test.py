@@ -0,0 +1,141 @@
+import asyncio
+import io
+import os
+import pytest
+from storage import leveldb
+from storage.leveldb import DBStorage
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # Databases live under ~/.<db>
+    monkeypatch.setenv("HOME", str(tmp_path))
+    storage = DBStorage("gitsync_test", "objects")
+    yield storage
+    storage.drop()
+
+
+def stored(storage: DBStorage, key: str) -> bytes:
+    """
+    Value in LevelDB itself, bypassing the write-behind buffer
+    """
+    return storage.client.get(key.encode())
+
+
+def test_reads_see_buffered_writes(storage):
+    storage.put("a", b"old")
+    storage.begin_batch()
+    storage.put("a", b"1")
+    storage.put("b", b"2")
+    assert storage.get("a") == b"1"
+    assert storage.exists("b")
+    assert stored(storage, "a") == b"old"
+    assert stored(storage, "b") is None
+    # Nested batches flush when the outermost one ends
+    storage.begin_batch()
+    storage.end_batch()
+    assert stored(storage, "b") is None
+    storage.end_batch()
+    assert stored(storage, "a") == b"1"
+    assert stored(storage, "b") == b"2"
+
+
+def test_removing_a_buffered_key(storage):
+    storage.put("a", b"old")
+    storage.begin_batch()
+    storage.put("a", b"1")
+    storage.put("b", b"2")
+    assert storage.remove("a")
+    assert storage.remove("b")
+    assert storage.get("a") is None
+    assert not storage.exists("b")
+    storage.end_batch()
+    assert stored(storage, "a") is None
+    assert stored(storage, "b") is None
+
+
+def test_flush_when_buffer_is_full(storage, monkeypatch):
+    monkeypatch.setattr(leveldb, "WRITE_BATCH_SIZE", 10)
+    storage.begin_batch()
+    storage.put("a", b"12345")
+    assert stored(storage, "a") is None
+    storage.put("b", b"67890")
+    assert stored(storage, "a") == b"12345"
+    assert stored(storage, "b") == b"67890"
+    storage.end_batch()
+
+
+def test_flush_when_batch_goes_quiet(storage, monkeypatch):
+    monkeypatch.setattr(leveldb, "WRITE_BATCH_INTERVAL", 0.05)
+
+    async def run():
+        storage.begin_batch()
+        storage.put("a", b"1")
+        assert stored(storage, "a") is None
+        await asyncio.sleep(0.1)
+        return stored(storage, "a")
+
+    assert asyncio.run(run()) == b"1"
+    storage.end_batch()
+
+
+def test_close_flushes(storage):
+    storage.begin_batch()
+    storage.put("a", b"1")
+    storage.close()
+    reopened = DBStorage("gitsync_test", "objects")
+    assert reopened.get("a") == b"1"
+    reopened.close()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(leveldb, "CHUNK_SIZE", 1000)
+
+
+def chunk_count(storage: DBStorage) -> int:
+    return len(list(storage.client.iterator(prefix=leveldb.CHUNK_KEY_PREFIX, include_value=False)))
+
+
+def test_large_values_are_stored_in_chunks(storage, small_chunks):
+    value = os.urandom(3500)
+    storage.put_stream("a", io.BytesIO(value))
+    assert len(stored(storage, "a")) < 100
+    assert chunk_count(storage) == 4
+    assert storage.get("a") == value
+    assert storage.size("a") == 3500
+    assert list(storage.keys()) == ["a"]
+    with storage.get_stream("a") as stream:
+        stream.seek(900)
+        assert stream.read(1200) == value[900:2100]
+        assert stream.read() == value[2100:]
+
+
+def test_overwriting_drops_unused_chunks(storage, small_chunks):
+    value = os.urandom(3500)
+    storage.put("a", value)
+    storage.put("a", value[:2500])
+    assert chunk_count(storage) == 3
+    assert storage.get("a") == value[:2500]
+    storage.put("a", b"small")
+    assert chunk_count(storage) == 0
+    assert storage.get("a") == b"small"
+    # Also when buffered
+    storage.put("a", value)
+    storage.begin_batch()
+    storage.put("a", b"small")
+    storage.end_batch()
+    assert chunk_count(storage) == 0
+    storage.put("b", value)
+    storage.remove("b")
+    assert chunk_count(storage) == 0
+    assert storage.get("b") is None
+
+
+def test_large_value_replaces_buffered_write(storage, small_chunks):
+    value = os.urandom(2500)
+    storage.begin_batch()
+    storage.put("a", b"old")
+    storage.put("a", value)
+    storage.end_batch()
+    assert storage.get("a") == value
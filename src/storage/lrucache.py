@@ -0,0 +1,66 @@
+from collections import OrderedDict
+
+
+class LruCache:
+    """
+    LRU cache bounded by the total size of its values, in bytes.
+    on_evict, if given, is called with each value evicted, removed or replaced, to release it.
+    """
+    def __init__(self, max_size: int, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size: int):
+        self.remove(key)
+        if size > self.max_size:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (evicted, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+    def remove(self, key) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        if self.on_evict is not None:
+            self.on_evict(entry[0])
+        return True
+
+    def clear(self):
+        if self.on_evict is not None:
+            for value, _ in self.entries.values():
+                self.on_evict(value)
+        self.entries.clear()
+        self.size = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,8 +1,31 @@
-import pymongo
-from pymongo import MongoClient
-from . import IStorage
+from typing import BinaryIO, Dict, Iterable, Set
+import io
+import re
+import time
+import asyncio
+import threading
+from pymongo import MongoClient, UpdateOne
+from . import IStorage, ChunkedReader, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL, CHUNK_SIZE
 
 
+MONGO_URI = 'mongodb://localhost:27017/'
+CHUNKS_COLL_SUFFIX = "~chunks"
+
+# One pooled client per server, shared by all collections
+_clients = {}
+
+
+def get_client(uri: str) -> MongoClient:
+    client = _clients.get(uri)
+    if client is None:
+        client = MongoClient(uri)
+        _clients[uri] = client
+    return client
+
+
+# Values larger than CHUNK_SIZE are stored in documents {key, n, value} of a chunks
+# collection, and the document of the key holds their total size and count instead of
+# the value, so no value is limited to the 16 MB BSON document size.
 class DBStorage(IStorage):
     def __init__(self, db: str, collection: str):
         """
@@ -10,68 +33,248 @@ class DBStorage(IStorage):
         """
         self._db = db
         self._collection = collection
-        self._uri = 'mongodb://localhost:27017/'
+        self._uri = MONGO_URI
 
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        c_collection.create_index('key', unique=True)
+        self.client = get_client(self._uri)
+        self.c_collection = self.client[self._db][self._collection]
+        self.c_collection.create_index('key', unique=True)
+        self.c_chunks = self.client[self._db][self._collection + CHUNKS_COLL_SUFFIX]
+        self.c_chunks.create_index([('key', 1), ('n', 1)], unique=True)
+
+        # Write-behind buffer used while a batch session is open, shared with readers
+        # in worker threads
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._pending = {}
+        self._pending_size = 0
+        self._pending_since = 0.0
+        self._flush_timer = None
 
     def put(self, key: str, value: bytes):
         """
         Insert document into MongoDB, overwrite if already exists.
         """
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        document = {
-            "key": key,
-            "value": value
-        }
+        if len(value) > CHUNK_SIZE:
+            self.put_stream(key, io.BytesIO(value))
+            return
+        with self._lock:
+            if self._batch_depth > 0:
+                self._buffer(key, value)
+                return
+        self._write_many({key: value})
+
+    def put_stream(self, key: str, stream: BinaryIO):
+        """
+        Store a value read from stream, in chunks if it is larger than CHUNK_SIZE
+        """
+        chunk = stream.read(CHUNK_SIZE)
+        next_chunk = stream.read(CHUNK_SIZE)
+        if not next_chunk:
+            self.put(key, chunk)
+            return
+        with self._lock:
+            value = self._pending.pop(key, None)
+            if value is not None:
+                self._pending_size -= len(value)
+        size = 0
+        count = 0
+        while chunk:
+            self.c_chunks.update_one({"key": key, "n": count}, {"$set": {"value": chunk}}, upsert=True)
+            size += len(chunk)
+            count += 1
+            chunk, next_chunk = next_chunk, stream.read(CHUNK_SIZE)
+        self.c_chunks.delete_many({"key": key, "n": {"$gte": count}})
+        self.c_collection.update_one({"key": key}, {"$set": {"size": size, "chunks": count},
+                                                    "$unset": {"value": ""}}, upsert=True)
+
+    def _read_chunk(self, key: str, index: int) -> bytes:
+        doc = self.c_chunks.find_one({"key": key, "n": index}, {"value": True, "_id": False})
+        return doc["value"] if doc is not None else None
+
+    def _join_chunks(self, key: str) -> bytes:
+        return b"".join(doc["value"] for doc in self.c_chunks.find({"key": key}, {"value": True, "_id": False})
+                        .sort("n", 1))
+
+    def _buffer(self, key: str, value: bytes):
+        if not self._pending:
+            self._pending_since = time.monotonic()
+            self._schedule_flush()
+        old_value = self._pending.get(key)
+        if old_value is not None:
+            self._pending_size -= len(old_value)
+        self._pending[key] = value
+        self._pending_size += len(value)
+        if (self._pending_size >= WRITE_BATCH_SIZE
+                or time.monotonic() - self._pending_since >= WRITE_BATCH_INTERVAL):
+            self.flush()
+
+    def _schedule_flush(self):
+        # Flush the tail of a batch that goes quiet; without a running loop, put() checks the age
         try:
-            c_collection.insert_one(document).inserted_id
-        except pymongo.errors.DuplicateKeyError:
-            c_collection.update_one({"key": key}, {"$set": {"value": value}})
+            event_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flush_timer = event_loop.call_later(WRITE_BATCH_INTERVAL, self.flush)
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
 
     def get(self, key: str) -> bytes:
         """
         Get document from MongoDB
         """
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        ret = c_collection.find_one({"key": key})
+        with self._lock:
+            value = self._pending.get(key)
+        if value is not None:
+            return value
+        ret = self.c_collection.find_one({"key": key}, {"value": True, "chunks": True, "_id": False})
         if ret:
-            return ret["value"]
+            return self._join_chunks(key) if "chunks" in ret else ret["value"]
         else:
             return None
 
+    def get_stream(self, key: str) -> BinaryIO:
+        """
+        Stream of the value, reading a chunked one a chunk at a time
+        """
+        with self._lock:
+            value = self._pending.get(key)
+        if value is not None:
+            return io.BytesIO(value)
+        ret = self.c_collection.find_one({"key": key}, {"value": True, "size": True, "chunks": True, "_id": False})
+        if ret is None:
+            return io.BytesIO(b"")
+        if "chunks" not in ret:
+            return io.BytesIO(ret["value"])
+        return io.BufferedReader(ChunkedReader(ret["size"], CHUNK_SIZE, lambda index: self._read_chunk(key, index)))
+
     def exists(self, key: str) -> bool:
         """
         Return whether document exists
         """
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        if c_collection.find_one({"key": key}):
-            return True
-        else:
-            return False
+        with self._lock:
+            if key in self._pending:
+                return True
+        return self.c_collection.find_one({"key": key}, {"key": True, "_id": False}) is not None
+
+    def size(self, key: str) -> int:
+        with self._lock:
+            value = self._pending.get(key)
+        if value is not None:
+            return len(value)
+        ret = self.c_collection.find_one({"key": key}, {"size": {"$ifNull": ["$size", {"$binarySize": "$value"}]},
+                                                        "_id": False})
+        if ret is None:
+            raise KeyError(key)
+        return ret["size"]
 
     def remove(self, key: str) -> bool:
         """
         Return whether removal is successful
         """
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        return c_collection.delete_one({"key": key}).deleted_count > 0
+        with self._lock:
+            value = self._pending.pop(key, None)
+            if value is not None:
+                self._pending_size -= len(value)
+        self.c_chunks.delete_many({"key": key})
+        return self.c_collection.delete_one({"key": key}).deleted_count > 0 or value is not None
+
+    def keys(self, prefix: str = ""):
+        """
+        Return a set of "primary" keys, only those starting with prefix if given
+        """
+        self.flush()
+        query = {"key": {"$regex": "^" + re.escape(prefix)}} if prefix else {}
+        return (doc["key"] for doc in self.c_collection.find(query, {"key": True, "_id": False}))
+
+    @staticmethod
+    def collection_exists(db: str, collection: str) -> bool:
+        return collection in get_client(MONGO_URI)[db].list_collection_names()
+
+    def drop(self):
+        """
+        Delete the whole collection
+        """
+        with self._lock:
+            self._pending.clear()
+            self._pending_size = 0
+            self._cancel_flush_timer()
+        self.c_collection.drop()
+        self.c_chunks.drop()
+
+    def put_many(self, items: Dict[str, bytes]):
+        """
+        Insert documents in bulk, overwrite those which already exist.
+        """
+        with self._lock:
+            large = {key: value for key, value in items.items() if len(value) > CHUNK_SIZE}
+            if self._batch_depth > 0:
+                for key, value in items.items():
+                    if key not in large:
+                        self._buffer(key, value)
+            else:
+                self._write_many({key: value for key, value in items.items() if key not in large})
+        for key, value in large.items():
+            self.put_stream(key, io.BytesIO(value))
+
+    def _write_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+        # Chunks of values stored before are dropped with them
+        self.c_chunks.delete_many({"key": {"$in": list(items)}})
+        self.c_collection.bulk_write([UpdateOne({"key": key}, {"$set": {"value": value},
+                                                               "$unset": {"size": "", "chunks": ""}}, upsert=True)
+                                      for key, value in items.items()], ordered=False)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        """
+        Get documents in bulk, missing keys are left out
+        """
+        keys = list(keys)
+        with self._lock:
+            ret = {key: self._pending[key] for key in keys if key in self._pending}
+        remaining = [key for key in keys if key not in ret]
+        if remaining:
+            for doc in self.c_collection.find({"key": {"$in": remaining}}, {"_id": False}):
+                ret[doc["key"]] = self._join_chunks(doc["key"]) if "chunks" in doc else doc["value"]
+        return ret
+
+    def exists_many(self, keys: Iterable[str]) -> Set[str]:
+        """
+        Return the subset of keys which exist
+        """
+        keys = list(keys)
+        with self._lock:
+            ret = {key for key in keys if key in self._pending}
+        remaining = [key for key in keys if key not in ret]
+        if remaining:
+            ret.update(doc["key"] for doc in self.c_collection.find({"key": {"$in": remaining}},
+                                                                   {"key": True, "_id": False}))
+        return ret
+
+    def begin_batch(self):
+        """
+        Buffer writes until the outermost batch ends, or the buffer grows too large or old
+        """
+        with self._lock:
+            self._batch_depth += 1
+
+    def end_batch(self):
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
 
-    def keys(self):
+    def flush(self):
         """
-        Return a set of "primary" keys
+        Commit buffered writes with one bulk upsert
         """
-        client = MongoClient(self._uri)
-        c_db = client[self._db]
-        c_collection = c_db[self._collection]
-        return (doc["key"] for doc in c_collection.find())
+        with self._lock:
+            self._cancel_flush_timer()
+            if not self._pending:
+                return
+            self._write_many(self._pending)
+            self._pending = {}
+            self._pending_size = 0
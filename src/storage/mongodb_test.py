@@ -0,0 +1,98 @@
+import asyncio
+import io
+import os
+import pytest
+import pymongo
+from storage import mongodb
+from storage.mongodb import DBStorage
+
+
+@pytest.fixture
+def storage():
+    probe = pymongo.MongoClient(mongodb.MONGO_URI, serverSelectionTimeoutMS=500)
+    try:
+        probe.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB is not running")
+    finally:
+        probe.close()
+    storage = DBStorage("gitsync_test", "objects")
+    storage.drop()
+    yield storage
+    storage.drop()
+
+
+def test_put_get_remove(storage):
+    storage.put("a", b"1")
+    storage.put("a", b"2")
+    assert storage.get("a") == b"2"
+    assert storage.exists("a")
+    assert storage.remove("a")
+    assert not storage.exists("a")
+    assert storage.get("a") is None
+
+
+def test_batch_flushes_at_end(storage):
+    storage.begin_batch()
+    storage.put_many({"a": b"1", "b": b"2"})
+    storage.begin_batch()
+    storage.put("c", b"3")
+    storage.end_batch()
+    assert storage.exists_many(["a", "c", "d"]) == {"a", "c"}
+    # Bulk writes are buffered too
+    assert storage.c_collection.count_documents({}) == 0
+    storage.end_batch()
+    assert storage.c_collection.count_documents({}) == 3
+    assert storage.get_many(["a", "b", "d"]) == {"a": b"1", "b": b"2"}
+    assert sorted(storage.keys()) == ["a", "b", "c"]
+
+
+def test_put_many_overwrites(storage):
+    storage.put("a", b"1")
+    storage.put_many({"a": b"2", "b": b"3"})
+    assert storage.get_many(["a", "b"]) == {"a": b"2", "b": b"3"}
+    assert storage.c_collection.count_documents({}) == 2
+
+
+def test_batch_flushes_when_quiet(storage):
+    async def run():
+        storage.begin_batch()
+        storage.put("a", b"1")
+        await asyncio.sleep(mongodb.WRITE_BATCH_INTERVAL * 1.5)
+        return storage.c_collection.count_documents({"key": "a"})
+
+    assert asyncio.run(run()) == 1
+    storage.end_batch()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(mongodb, "CHUNK_SIZE", 1000)
+
+
+def test_large_values_are_stored_in_chunks(storage, small_chunks):
+    value = os.urandom(3500)
+    storage.put_stream("a", io.BytesIO(value))
+    assert storage.c_chunks.count_documents({"key": "a"}) == 4
+    assert storage.get("a") == value
+    assert storage.get_many(["a"]) == {"a": value}
+    assert storage.size("a") == 3500
+    with storage.get_stream("a") as stream:
+        stream.seek(900)
+        assert stream.read(1200) == value[900:2100]
+        assert stream.read() == value[2100:]
+
+
+def test_overwriting_drops_unused_chunks(storage, small_chunks):
+    value = os.urandom(3500)
+    storage.put("a", value)
+    storage.put("a", value[:2500])
+    assert storage.c_chunks.count_documents({}) == 3
+    assert storage.get("a") == value[:2500]
+    storage.put_many({"a": b"small"})
+    assert storage.c_chunks.count_documents({}) == 0
+    assert storage.get("a") == b"small"
+    assert storage.size("a") == 5
+    storage.put("b", value)
+    storage.remove("b")
+    assert storage.c_chunks.count_documents({}) == 0
@@ -0,0 +1,266 @@
+from typing import Optional, Tuple
+import os
+import mmap
+import glob
+import zlib
+import struct
+import threading
+from .lrucache import LruCache
+
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+TYPE_NAMES = {OBJ_COMMIT: b"commit", OBJ_TREE: b"tree", OBJ_BLOB: b"blob", OBJ_TAG: b"tag"}
+
+IDX_MAGIC = b"\377tOc"
+HASH_LENGTH = 20
+FANOUT_SIZE = 256 * 4
+INFLATE_CHUNK_SIZE = 64 * 1024
+OBJECT_CACHE_SIZE = 32 * 1024 * 1024
+BASE_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    def read_size(pos: int) -> Tuple[int, int]:
+        size = 0
+        shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return size, pos
+
+    src_size, pos = read_size(0)
+    dst_size, pos = read_size(pos)
+    if src_size != len(base):
+        raise ValueError("Delta base size mismatch")
+    ret = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base
+            offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if cmd & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            ret += base[offset:offset + size]
+        elif cmd:
+            # Insert literal data
+            ret += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise ValueError("Invalid delta opcode")
+    if len(ret) != dst_size:
+        raise ValueError("Delta result size mismatch")
+    return bytes(ret)
+
+
+class PackFile:
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[:4] == IDX_MAGIC:
+            if struct.unpack_from("!I", self.idx, 4)[0] != 2:
+                raise ValueError("Unsupported pack index version: " + idx_path)
+            self.version = 2
+            self.fanout_pos = 8
+        else:
+            self.version = 1
+            self.fanout_pos = 0
+        self.fanout = struct.unpack_from("!256I", self.idx, self.fanout_pos)
+        self.count = self.fanout[255]
+        table_pos = self.fanout_pos + FANOUT_SIZE
+        if self.version == 2:
+            self.hash_pos = table_pos
+            self.hash_stride = HASH_LENGTH
+            self.offset_pos = table_pos + self.count * (HASH_LENGTH + 4)
+            self.large_offset_pos = self.offset_pos + self.count * 4
+        else:
+            # v1 entries are a 4-byte offset followed by the hash
+            self.hash_pos = table_pos + 4
+            self.hash_stride = HASH_LENGTH + 4
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def find(self, hash_value: bytes) -> Optional[int]:
+        """
+        Binary search within the fan-out bucket, return the pack offset
+        """
+        first = hash_value[0]
+        lo = self.fanout[first - 1] if first > 0 else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.hash_pos + mid * self.hash_stride
+            cur = self.idx[pos:pos + HASH_LENGTH]
+            if cur < hash_value:
+                lo = mid + 1
+            elif cur > hash_value:
+                hi = mid
+            else:
+                return self.offset_at(mid)
+        return None
+
+    def offset_at(self, index: int) -> int:
+        if self.version == 1:
+            return struct.unpack_from("!I", self.idx, self.hash_pos + index * self.hash_stride - 4)[0]
+        offset = struct.unpack_from("!I", self.idx, self.offset_pos + index * 4)[0]
+        if offset & 0x80000000:
+            offset = struct.unpack_from("!Q", self.idx, self.large_offset_pos + (offset & 0x7fffffff) * 8)[0]
+        return offset
+
+    def inflate(self, pos: int, size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        ret = []
+        while not decompressor.eof and pos < len(self.pack):
+            ret.append(decompressor.decompress(self.pack[pos:pos + INFLATE_CHUNK_SIZE]))
+            pos += INFLATE_CHUNK_SIZE
+        data = b"".join(ret)
+        if len(data) != size:
+            raise ValueError("Pack object size mismatch")
+        return data
+
+    def read_header(self, offset: int) -> Tuple[int, int, int]:
+        c = self.pack[offset]
+        offset += 1
+        obj_type = (c >> 4) & 0x07
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = self.pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return obj_type, size, offset
+
+    def read_at(self, offset: int, store) -> Tuple[int, bytes]:
+        """
+        Read the object at offset, resolving deltas. store looks up REF_DELTA bases by hash.
+        """
+        # Walk down the delta chain, then apply deltas back up
+        deltas = []
+        while True:
+            cached = store.base_cache.get((self.pack_path, offset))
+            if cached is not None:
+                obj_type, data = cached
+                break
+            obj_type, size, pos = self.read_header(offset)
+            if obj_type == OBJ_OFS_DELTA:
+                c = self.pack[pos]
+                pos += 1
+                base_distance = c & 0x7f
+                while c & 0x80:
+                    c = self.pack[pos]
+                    pos += 1
+                    base_distance = ((base_distance + 1) << 7) | (c & 0x7f)
+                deltas.append((offset, self.inflate(pos, size)))
+                offset -= base_distance
+            elif obj_type == OBJ_REF_DELTA:
+                base_hash = bytes(self.pack[pos:pos + HASH_LENGTH])
+                deltas.append((offset, self.inflate(pos + HASH_LENGTH, size)))
+                base = store.read(base_hash)
+                if base is None:
+                    raise ValueError("Missing delta base " + base_hash.hex())
+                obj_type, data = base
+                break
+            elif obj_type in TYPE_NAMES:
+                data = self.inflate(pos, size)
+                break
+            else:
+                raise ValueError("Unknown pack object type %d" % obj_type)
+        for delta_offset, delta in reversed(deltas):
+            data = apply_delta(data, delta)
+            store.base_cache.put((self.pack_path, delta_offset), (obj_type, data), len(data))
+        return obj_type, data
+
+
+class PackStore:
+    """
+    Read-only view of objects/pack, returning objects in zlib loose form.
+    Worker threads read it alongside the event loop: the caches and the set of open packs
+    are guarded by a lock, so a rescan never closes a pack while it is read.
+    """
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self.packs = {}
+        self.mtime = None
+        self.object_cache = LruCache(OBJECT_CACHE_SIZE)
+        self.base_cache = LruCache(BASE_CACHE_SIZE)
+        self.lock = threading.RLock()
+
+    def rescan(self):
+        with self.lock:
+            try:
+                mtime = os.stat(self.pack_dir).st_mtime_ns
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            idx_paths = set(glob.glob(os.path.join(self.pack_dir, "*.idx")))
+            for path in list(self.packs):
+                if path not in idx_paths:
+                    self.packs.pop(path).close()
+            for path in idx_paths - set(self.packs):
+                try:
+                    self.packs[path] = PackFile(path)
+                except (OSError, ValueError):
+                    continue
+
+    def locate(self, hash_value: bytes) -> Optional[Tuple[PackFile, int]]:
+        for rescan in (False, True):
+            if rescan or self.mtime is None:
+                self.rescan()
+            for pack in self.packs.values():
+                offset = pack.find(hash_value)
+                if offset is not None:
+                    return pack, offset
+        return None
+
+    def read(self, hash_value: bytes) -> Optional[Tuple[int, bytes]]:
+        location = self.locate(hash_value)
+        if location is None:
+            return None
+        pack, offset = location
+        return pack.read_at(offset, self)
+
+    def contains(self, hash_name: str) -> bool:
+        with self.lock:
+            if self.object_cache.get(hash_name) is not None:
+                return True
+            return self.locate(bytes.fromhex(hash_name)) is not None
+
+    def get(self, hash_name: str) -> Optional[bytes]:
+        with self.lock:
+            raw_data = self.object_cache.get(hash_name)
+            if raw_data is not None:
+                return raw_data
+            obj = self.read(bytes.fromhex(hash_name))
+            if obj is None:
+                return None
+            obj_type, data = obj
+            raw_data = zlib.compress(TYPE_NAMES[obj_type] + b" " + str(len(data)).encode() + b"\x00" + data)
+            self.object_cache.put(hash_name, raw_data, len(raw_data))
+            return raw_data
@@ -0,0 +1,137 @@
+import os
+import shutil
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from storage.filesystem import FileStorage
+from storage.lrucache import LruCache
+from storage.packfile import apply_delta
+
+
+def git(repo: str, *args: str) -> bytes:
+    return subprocess.run(["git", "-C", repo] + list(args), check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL).stdout
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """
+    A repo with a file edited over several commits, so packing it produces deltas
+    """
+    if shutil.which("git") is None:
+        pytest.skip("git is not installed")
+    repo = str(tmp_path / "repo")
+    os.mkdir(repo)
+    git(repo, "init", "-q")
+    git(repo, "config", "user.name", "a")
+    git(repo, "config", "user.email", "a@a")
+    lines = ["line %d of some text that stays the same\n" % i for i in range(2000)]
+    for version in range(6):
+        lines[version * 300] = "changed in version %d\n" % version
+        with open(os.path.join(repo, "file.txt"), "w") as f:
+            f.writelines(lines)
+        git(repo, "add", "file.txt")
+        git(repo, "commit", "-q", "-m", "version %d" % version)
+    return repo
+
+
+def all_objects(repo: str) -> dict:
+    """
+    Object id -> loose object content, as git reads it
+    """
+    ret = {}
+    for line in git(repo, "cat-file", "--batch-all-objects", "--batch-check").decode().splitlines():
+        hash_name, content_type, _ = line.split()
+        content = git(repo, "cat-file", content_type, hash_name)
+        ret[hash_name] = content_type.encode() + b" %d\x00" % len(content) + content
+    return ret
+
+
+def delta_cnt(repo: str) -> int:
+    pack = [name for name in os.listdir(os.path.join(repo, ".git", "objects", "pack")) if name.endswith(".idx")]
+    output = git(repo, "verify-pack", "-v", os.path.join(repo, ".git", "objects", "pack", pack[0])).decode()
+    # Deltified entries list their depth and base after the offset
+    return sum(1 for line in output.splitlines() if len(line.split()) == 7)
+
+
+@pytest.mark.parametrize("config", [
+    [],
+    ["-c", "repack.useDeltaBaseOffset=false"],
+    ["-c", "pack.indexVersion=1"],
+], ids=["ofs-delta", "ref-delta", "index-v1"])
+def test_packed_objects_read_like_loose_ones(repo, config):
+    expected = all_objects(repo)
+    git(repo, *config, "repack", "-a", "-d", "-q", "-f", "--depth=50")
+    git(repo, "prune-packed")
+    assert delta_cnt(repo) > 0
+    storage = FileStorage(os.path.join(repo, ".git"))
+    for hash_name, data in expected.items():
+        assert not os.path.exists(storage.path_from_hash(hash_name))
+        assert storage.exists(hash_name)
+        assert zlib.decompress(storage.get(hash_name)) == data
+    assert not storage.exists("ab" * 20)
+
+
+def test_pack_added_after_first_read_is_found(repo):
+    git(repo, "repack", "-a", "-d", "-q")
+    git(repo, "prune-packed")
+    storage = FileStorage(os.path.join(repo, ".git"))
+    assert storage.exists(git(repo, "rev-parse", "HEAD").decode().strip())
+    with open(os.path.join(repo, "new.txt"), "w") as f:
+        f.write("new")
+    git(repo, "add", "new.txt")
+    git(repo, "commit", "-q", "-m", "new")
+    head = git(repo, "rev-parse", "HEAD").decode().strip()
+    expected = zlib.decompress(storage.get(head))
+    # The new objects go into a second pack
+    git(repo, "repack", "-d", "-q")
+    git(repo, "prune-packed")
+    assert not os.path.exists(storage.path_from_hash(head))
+    assert zlib.decompress(storage.get(head)) == expected
+    assert len(storage.packs.packs) == 2
+
+
+def test_concurrent_reads(repo):
+    expected = all_objects(repo)
+    git(repo, "repack", "-a", "-d", "-q", "-f", "--depth=50")
+    git(repo, "prune-packed")
+    storage = FileStorage(os.path.join(repo, ".git"))
+    # Small caches keep evicting under the readers
+    storage.packs.object_cache = LruCache(4096)
+    storage.packs.base_cache = LruCache(4096)
+
+    def read_all(_):
+        return all(zlib.decompress(storage.get(hash_name)) == data for hash_name, data in expected.items())
+
+    def rescan(_):
+        for _ in range(50):
+            storage.packs.mtime = None
+            storage.packs.rescan()
+        return True
+
+    with ThreadPoolExecutor(8) as executor:
+        assert all(executor.map(lambda i: rescan(i) if i % 4 == 0 else read_all(i), range(16)))
+
+
+def test_apply_delta():
+    base = b"0123456789" * 10
+    # Source and target size, copy 10 bytes at offset 5, insert "ab", copy 3 at offset 0
+    delta = bytes([100, 15, 0x80 | 0x01 | 0x10, 5, 10, 2]) + b"ab" + bytes([0x80 | 0x10, 3])
+    assert apply_delta(base, delta) == b"5678901234ab012"
+
+
+def test_apply_delta_copies_64k_when_size_is_zero():
+    base = bytes(range(256)) * 256
+    delta = bytes([0x80, 0x80, 0x04, 0x80, 0x80, 0x04, 0x80])
+    assert apply_delta(base, delta) == base
+
+
+@pytest.mark.parametrize("delta", [
+    bytes([99, 1, 0x80 | 0x10, 1]),
+    bytes([100, 2, 0x80 | 0x10, 1]),
+    bytes([100, 1, 0]),
+], ids=["base-size", "result-size", "opcode"])
+def test_apply_delta_rejects_malformed(delta):
+    with pytest.raises(ValueError):
+        apply_delta(b"x" * 100, delta)
@@ -0,0 +1,55 @@
+from typing import BinaryIO
+from . import IStorage
+
+
+class PrefixedStorage(IStorage):
+    """
+    View of the keys of base starting with prefix, with the prefix stripped.
+    Lets many small keyspaces share one database.
+    """
+    def __init__(self, base: IStorage, prefix: str):
+        self.base = base
+        self.prefix = prefix
+
+    def put(self, key: str, value: bytes):
+        self.base.put(self.prefix + key, value)
+
+    def get(self, key: str) -> bytes:
+        return self.base.get(self.prefix + key)
+
+    def put_stream(self, key: str, stream: BinaryIO):
+        self.base.put_stream(self.prefix + key, stream)
+
+    def get_stream(self, key: str) -> BinaryIO:
+        return self.base.get_stream(self.prefix + key)
+
+    def exists(self, key: str) -> bool:
+        return self.base.exists(self.prefix + key)
+
+    def remove(self, key: str) -> bool:
+        return self.base.remove(self.prefix + key)
+
+    def size(self, key: str) -> int:
+        return self.base.size(self.prefix + key)
+
+    def keys(self):
+        return (key[len(self.prefix):] for key in self.base.keys(self.prefix))
+
+    def put_many(self, items: dict):
+        self.base.put_many({self.prefix + key: value for key, value in items.items()})
+
+    def get_many(self, keys) -> dict:
+        return {key[len(self.prefix):]: value
+                for key, value in self.base.get_many(self.prefix + key for key in keys).items()}
+
+    def exists_many(self, keys) -> set:
+        return {key[len(self.prefix):] for key in self.base.exists_many(self.prefix + key for key in keys)}
+
+    def begin_batch(self):
+        self.base.begin_batch()
+
+    def end_batch(self):
+        self.base.end_batch()
+
+    def flush(self):
+        self.base.flush()
@@ -0,0 +1,29 @@
+import pytest
+from storage.leveldb import DBStorage
+from storage.prefixed import PrefixedStorage
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    # Databases live under ~/.<db>
+    monkeypatch.setenv("HOME", str(tmp_path))
+    base = DBStorage("gitsync_test", "refs")
+    yield base
+    base.drop()
+
+
+def test_keyspaces_are_isolated(base):
+    a = PrefixedStorage(base, "a/")
+    ab = PrefixedStorage(base, "ab/")
+    a.put("master", b"1")
+    ab.put("master", b"2")
+    ab.put_many({"dev": b"3"})
+    assert list(a.keys()) == ["master"]
+    assert sorted(ab.keys()) == ["dev", "master"]
+    assert a.get("master") == b"1"
+    assert not a.exists("dev")
+    assert a.get_many(["master", "dev"]) == {"master": b"1"}
+    assert ab.exists_many(["master", "dev", "other"]) == {"master", "dev"}
+    assert a.remove("master")
+    assert ab.get("master") == b"2"
+    assert sorted(base.keys()) == ["ab/dev", "ab/master"]